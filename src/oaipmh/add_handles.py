@@ -1,12 +1,18 @@
 import logging
 import re
 import sys
-from csv import DictReader, DictWriter
-from typing import TextIO
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from csv import DictReader, DictWriter, reader as csv_reader, writer as csv_writer
+from typing import Iterable, Iterator, Optional, TextIO
 
 import click
 import requests
 import yaml
+from requests.adapters import HTTPAdapter
+from urllib3 import Retry
 
 from oaipmh import __version__
 
@@ -17,6 +23,217 @@ class RequestFailure(Exception):
     pass
 
 
+class RateLimiter:
+    """
+    Thread-safe limiter that spaces calls to `wait()` at least `1 / rate`
+    seconds apart. A rate of 0 means no limit.
+    """
+    def __init__(self, rate: float = 0):
+        self.interval = 1 / rate if rate else 0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class Checkpoint:
+    """
+    Append-only CSV file of the handles minted or found so far, one
+    "repo_id,handle" line per item, written as soon as each handle is
+    known. Rerunning with the same checkpoint file reuses these handles
+    without contacting the handle service.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.handles: dict[str, str] = {}
+        try:
+            with open(path, newline='') as fh:
+                for line in csv_reader(fh):
+                    if len(line) == 2 and line[1]:
+                        self.handles[line[0]] = line[1]
+        except FileNotFoundError:
+            pass
+        self._fh = open(path, 'a', newline='')
+        self._writer = csv_writer(self._fh)
+        self._lock = threading.Lock()
+        logger.info(f'Checkpoint {path}: {len(self.handles)} handle(s) already known')
+
+    def get(self, repo_id: str) -> Optional[str]:
+        return self.handles.get(repo_id)
+
+    def put(self, repo_id: str, handle: str):
+        """
+        :raises ValueError: if the handle is empty, since the item would
+        never get one on a later run
+        """
+        if not handle:
+            raise ValueError(f'Refusing to record an empty handle for {repo_id}')
+        with self._lock:
+            self.handles[repo_id] = handle
+            self._writer.writerow([repo_id, handle])
+            self._fh.flush()
+
+    def close(self):
+        with self._lock:
+            self._fh.close()
+
+
+def create_session(pool_size: int = 10, retries: int = 3, backoff: float = 0.5) -> requests.Session:
+    """
+    Create a session for the handle service, with a connection pool sized
+    for the number of minting workers. Since minting is not idempotent,
+    requests are only retried (with exponential backoff, and honoring any
+    `Retry-After` header) when the service cannot have processed them:
+    connection errors, and 429 and 503 responses.
+    """
+    session = requests.Session()
+    retry = Retry(
+        total=retries,
+        read=0,
+        backoff_factor=backoff,
+        status_forcelist=(429, 503),
+        allowed_methods=None,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_maxsize=pool_size, pool_block=True, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class HandleMinter:
+    """
+    Adds handles to a stream of CSV rows, minting them concurrently. Rows
+    are yielded in input order as soon as they (and every row before them)
+    are done, with at most a bounded number of rows in flight, so memory
+    use does not grow with the size of the input. If lookup is turned on,
+    the handle service is asked for an existing handle for each item
+    before minting a new one. A row that fails to get a handle is logged,
+    counted, and passed through without one.
+    """
+    def __init__(
+            self,
+            config: dict,
+            workers: int = 8,
+            rate: float = 0,
+            retries: int = 3,
+            checkpoint: Optional[Checkpoint] = None,
+            timeout: float = 30,
+            lookup: bool = False,
+    ):
+        """
+        :param config: configuration, with the `HANDLE_URL`, `BASE_URL`,
+        `PUBLIC_BASE_URL`, and `AUTH` keys
+        :param workers: maximum number of concurrent minting requests
+        :param rate: maximum number of requests (lookups and mints) per second; 0 for no limit
+        :param retries: number of times to retry a request that the handle service did not process
+        :param checkpoint: checkpoint to reuse and record minted handles in
+        :param timeout: timeout for each request, in seconds
+        :param lookup: whether to look for an existing handle before minting one
+        """
+        self.config = config
+        self.workers = workers
+        self.checkpoint = checkpoint
+        self.timeout = timeout
+        self.lookup = lookup
+        self.session = create_session(pool_size=workers, retries=retries)
+        self.rate_limiter = RateLimiter(rate)
+        self.minted = 0
+        self.found = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def process(self, rows: Iterable[dict]) -> Iterator[dict]:
+        window = self.workers * 4
+        pending: deque[tuple[dict, Optional[Future]]] = deque()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='mint') as executor:
+            for row in rows:
+                pending.append((row, self.submit(executor, row)))
+                while len(pending) >= window:
+                    yield self.complete(*pending.popleft())
+            while pending:
+                yield self.complete(*pending.popleft())
+
+    def submit(self, executor: ThreadPoolExecutor, row: dict) -> Optional[Future]:
+        """Submit the minting of a handle for the row, or return None if it does not need one."""
+        if row.get('Handle'):
+            self.skipped += 1
+            return None
+        repo_id = self.get_repo_id(row['URI'])
+        if self.checkpoint is not None:
+            handle = self.checkpoint.get(repo_id)
+            if handle is not None:
+                row['Handle'] = handle
+                self.skipped += 1
+                return None
+        return executor.submit(self.get_handle, repo_id)
+
+    def complete(self, row: dict, future: Optional[Future]) -> dict:
+        if future is None:
+            return row
+        try:
+            row['Handle'], minted = future.result()
+        except (RequestFailure, RuntimeError, requests.RequestException) as e:
+            self.failed += 1
+            row['Handle'] = ''
+            logger.error(f'Unable to get a handle for {row["URI"]}: {e}')
+        else:
+            if minted:
+                self.minted += 1
+            else:
+                self.found += 1
+        return row
+
+    def get_repo_id(self, uri: str) -> str:
+        return uri.replace(self.config['BASE_URL'], '')
+
+    def get_handle(self, repo_id: str) -> tuple[str, bool]:
+        """
+        Get the existing handle for an item, or mint a new one.
+
+        :return: tuple of the handle, and whether it was newly minted
+        """
+        handle = None
+        if self.lookup:
+            self.rate_limiter.wait()
+            handle = find_handle(self.config, session=self.session, timeout=self.timeout, repo_id=repo_id)
+        minted = handle is None
+        if minted:
+            handle = self.mint(repo_id)
+        if not handle:
+            raise RequestFailure('The handle service did not return a handle')
+        if self.checkpoint is not None:
+            self.checkpoint.put(repo_id, handle)
+        return handle, minted
+
+    def mint(self, fcrepo_path: str) -> str:
+        # extract relpath and uuid from fcrepo path
+        relpath, item_uuid = extract_from_path(fcrepo_path)
+
+        # create url for http request
+        public_url = self.config['PUBLIC_BASE_URL'] + item_uuid + f"?relpath={relpath}"
+
+        # Send http Request to Umd-Handle-API to mint handle
+        self.rate_limiter.wait()
+        return mint_handle(
+            self.config,
+            session=self.session,
+            timeout=self.timeout,
+            prefix='1903.1',
+            url=public_url,
+            repo='fcrepo',
+            repo_id=fcrepo_path,
+        )
+
+
 @click.command()
 @click.option(
     '--input-file', '-i',
@@ -36,55 +253,84 @@ class RequestFailure(Exception):
     type=click.File(mode='r'),
     required=True
 )
+@click.option(
+    '--checkpoint-file',
+    help='File to record handles in as they are minted or found. Rerunning with the same file '
+         'reuses them without contacting the handle service.',
+    type=click.Path(dir_okay=False),
+)
+@click.option(
+    '--workers', '-w',
+    help='Number of handles to mint concurrently. Default is 8.',
+    type=int,
+    default=8,
+)
+@click.option(
+    '--rate',
+    help='Maximum number of requests to the handle service per second, counting both lookups and minting '
+         'requests. Default is 0 (no limit).',
+    type=float,
+    default=0,
+)
+@click.option(
+    '--retries',
+    help='Number of times to retry a request that the handle service did not process. Default is 3.',
+    type=int,
+    default=3,
+)
+@click.option(
+    '--lookup/--no-lookup',
+    help='Whether to look for an existing handle for each item before minting a new one. This adds a '
+         'request for every item that is not in the checkpoint file. Default is not to look, so without '
+         'a checkpoint file, rerunning an interrupted batch mints duplicate handles.',
+    default=False,
+)
 @click.version_option(__version__, '--version', '-V')
 @click.help_option('--help', '-h')
-def main(input_file: TextIO, output_file: TextIO, config_file: TextIO):
+def main(
+        input_file: TextIO,
+        output_file: TextIO,
+        config_file: TextIO,
+        checkpoint_file: Optional[str],
+        workers: int,
+        rate: float,
+        retries: int,
+        lookup: bool,
+):
+    config = yaml.safe_load(config_file)
+    reader = DictReader(input_file)
+    checkpoint = Checkpoint(checkpoint_file) if checkpoint_file else None
+    if checkpoint is None and not lookup:
+        logger.warning(
+            'Without --checkpoint-file or --lookup, rerunning this batch will mint duplicate handles '
+            'for the rows that are already done'
+        )
+    minter = HandleMinter(config, workers=workers, rate=rate, retries=retries, checkpoint=checkpoint, lookup=lookup)
     try:
-        config = yaml.safe_load(config_file)
-        reader = DictReader(input_file)
-        exports = create_handles(reader, config)
-
         # ensure that there is a Handle header in the output file
-        fieldnames = list(reader.fieldnames)
+        fieldnames = list(reader.fieldnames or [])
         if 'Handle' not in fieldnames:
             fieldnames.append('Handle')
 
-        # Write out to file or stdout
+        # Write out to file or stdout, as each row is done
         writer = DictWriter(output_file, fieldnames=fieldnames)
         writer.writeheader()
-        for row in exports:
+        for row in minter.process(reader):
             writer.writerow(row)
-    except RequestFailure as e:
-        logger.error(str(e))
+            output_file.flush()
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+    logger.info(
+        f'{minter.minted} handle(s) minted, {minter.found} existing handle(s) found, '
+        f'{minter.skipped} row(s) skipped, {minter.failed} failure(s)'
+    )
+    if minter.failed:
+        raise SystemExit(1)
 
 
 def create_handles(reader: DictReader, config: dict) -> list:
-    exports = []
-    for row in reader:
-        if 'Handle' not in row or row['Handle'] is None:
-            fcrepo_path = row['URI'].replace(config['BASE_URL'], '')
-
-            # extract relpath and uuid from fcrepo path
-            relpath, item_uuid = extract_from_path(fcrepo_path)
-
-            # create url for http request
-            public_url = config['PUBLIC_BASE_URL'] + item_uuid + f"?relpath={relpath}"
-
-            # Send http Request to Umd-Handle-API to mint handle
-            handle = mint_handle(config,
-                                 prefix='1903.1',
-                                 url=public_url,
-                                 repo='fcrepo',
-                                 repo_id=fcrepo_path
-                                 )
-
-            # Store handle
-            row['Handle'] = handle
-            exports.append(row)
-        else:
-            exports.append(row)
-
-    return exports
+    return list(HandleMinter(config).process(reader))
 
 
 PATH_PATTERN = re.compile(r'(.*?)/(..)/(..)/(..)/(..)/(\2\3\4\5-....-....-....-............)')
@@ -99,10 +345,50 @@ def extract_from_path(fcrepo_path: str) -> tuple[str, str]:
     return relpath, item_uuid
 
 
-def mint_handle(config: dict, **json) -> str:
+def find_handle(
+        config: dict,
+        session: Optional[requests.Session] = None,
+        timeout: Optional[float] = None,
+        repo: str = 'fcrepo',
+        repo_id: str = '',
+) -> Optional[str]:
+    """
+    Look up the existing handle for a repository item.
+
+    :return: the handle URL, or None if the item does not have a handle
+    :raises RequestFailure: if the handle service returns an error
+    """
+    endpoint = '/handles/exists'
+    headers = {'Authorization': f'Bearer {config["AUTH"]}'}
+    get = session.get if session is not None else requests.get
+    response = get(
+        config['HANDLE_URL'] + endpoint,
+        params={'repo': repo, 'repo_id': repo_id},
+        headers=headers,
+        timeout=timeout,
+    )
+
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        raise RequestFailure(f"Got a {response.status_code} error code, check the configuration file.")
+
+    result = response.json()
+    if not result.get('exists'):
+        return None
+    return result.get('handle_url')
+
+
+def mint_handle(
+        config: dict,
+        session: Optional[requests.Session] = None,
+        timeout: Optional[float] = None,
+        **json,
+) -> str:
     endpoint = '/handles'
     headers = {'Authorization': f'Bearer {config["AUTH"]}'}
-    response = requests.post(config['HANDLE_URL'] + endpoint, json=json, headers=headers)
+    post = session.post if session is not None else requests.post
+    response = post(config['HANDLE_URL'] + endpoint, json=json, headers=headers, timeout=timeout)
 
     if response.status_code != 200:
         raise RequestFailure(f"Got a {response.status_code} error code, check the configuration file.")
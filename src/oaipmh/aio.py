@@ -0,0 +1,268 @@
+import asyncio
+import logging
+import os
+import time
+from http import HTTPStatus
+from typing import Any, Mapping, Optional
+
+import httpx
+from oai_repo import OAIRepository, OAIRepoExternalException
+from oai_repo.exceptions import OAIError
+
+from oaipmh.config import EnvAttribute
+from oaipmh.dataprovider import DataProvider, ListPaging, Page
+from oaipmh.oai import OAIIdentifier
+from oaipmh.solr import Index, SEARCH_PARAMS
+from oaipmh.web import LIST_VERBS
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncIndex:
+    """
+    Asynchronous counterpart to `Index`. It runs the same searches (built by
+    the wrapped index, so the results are identical) against the Solr
+    select handler using an `httpx.AsyncClient`, and shares the wrapped
+    index's set registry and document cache.
+    """
+    def __init__(self, index: Index, client: httpx.AsyncClient, solr_url: str):
+        self.index = index
+        self.client = client
+        self.select_url = solr_url.rstrip('/') + '/select'
+
+    async def search(self, query_name: str = 'search', **params) -> dict[str, Any]:
+        """
+        :param query_name: name to report the query's timing under (see `Index.record_query()`)
+        :return: decoded JSON response from Solr
+        :raises OAIRepoExternalException: if Solr could not be reached or returned an error
+        """
+        start = time.perf_counter()
+        try:
+            response = await self.client.get(self.select_url, params={**SEARCH_PARAMS, **params})
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            self.index.record_query(query_name, time.perf_counter() - start, error=True)
+            logger.error(f'Solr search failed: {e}')
+            raise OAIRepoExternalException('Unable to connect to Solr') from e
+        self.index.record_query(query_name, time.perf_counter() - start)
+        return response.json()
+
+    async def get_sets(self) -> dict[str, dict[str, str]]:
+        if not self.index.set_registry.is_loaded:
+            # the first load is synchronous, so keep it off the event loop
+            return await asyncio.to_thread(self.index.get_sets)
+        return self.index.get_sets()
+
+    async def get_docs(
+            self,
+            filter_from: Optional[str] = None,
+            filter_until: Optional[str] = None,
+            filter_set: Optional[str] = None,
+            start: Optional[int] = 0,
+            rows: Optional[int] = 25,
+            cursor_mark: Optional[str] = None,
+            metadata_prefix: Optional[str] = None,
+            fields: Optional[list[str]] = None,
+            by_datestamp: bool = False,
+    ) -> tuple[list[dict[str, Any]], int, Optional[str]]:
+        """
+        :return: tuple of the documents, the total number of hits, and the
+        cursor mark for the next page (if `cursor_mark` was given)
+        """
+        await self.get_sets()
+        query = self.index.get_docs_query(
+            filter_from, filter_until, filter_set, start, rows, cursor_mark, fields, metadata_prefix, by_datestamp
+        )
+        data = await self.search(query_name='get_docs', **query)
+        return data['response']['docs'], data['response']['numFound'], data.get('nextCursorMark')
+
+    async def get_doc(self, handle: str) -> Optional[dict[str, Any]]:
+        """Return the Solr document for the given handle, or None if there is no such document."""
+        doc = self.index.doc_cache.get(handle)
+        if doc is not None:
+            return doc
+        data = await self.search(query_name='get_doc', **self.index.get_doc_query(handle))
+        docs = data['response']['docs']
+        if not docs:
+            return None
+        self.index.doc_cache.put(handle, docs[0])
+        return docs[0]
+
+    async def get_sets_for_handles(self, handles: list[str]) -> dict[str, dict[str, dict[str, str]]]:
+        sets = await self.get_sets()
+        query = self.index.get_sets_for_handles_query(handles, sets)
+        if query is None:
+            return {handle: {} for handle in handles}
+        data = await self.search(query_name='get_sets_for_handles', **query)
+        return self.index.parse_set_facets(handles, data.get('facets', {}), sets)
+
+
+class AsyncDataProvider:
+    """
+    Retrieves everything that a GetRecord, ListIdentifiers, or ListRecords
+    request needs from Solr and fcrepo, with all the fcrepo requests for a
+    page in flight at once, and packages it as a `Page` for the synchronous
+    `DataProvider` to process the request with. Since oai_repo is
+    synchronous, the request itself is still processed in a worker thread,
+    but that thread no longer waits on any upstream requests.
+    """
+    max_connections: int = EnvAttribute('ASYNC_MAX_CONNECTIONS', 100)
+
+    def __init__(self, data_provider: DataProvider, solr_url: str, client: Optional[httpx.AsyncClient] = None):
+        """
+        :param data_provider: data provider that will process the requests
+        :param solr_url: URL of the Solr core
+        :param client: HTTP client to use for Solr and fcrepo requests; if not
+        given, one is created using the fcrepo client's timeouts and number of
+        retries (although the transport only retries connection errors, not
+        error responses)
+        """
+        self.data_provider = data_provider
+        session = data_provider.session
+        if client is None:
+            client = httpx.AsyncClient(
+                timeout=httpx.Timeout(session.read_timeout, connect=session.connect_timeout),
+                transport=httpx.AsyncHTTPTransport(
+                    retries=session.retries,
+                    limits=httpx.Limits(max_connections=self.max_connections),
+                ),
+            )
+        self.client = client
+        self.index = AsyncIndex(data_provider.index, client, solr_url)
+        self._fetch_limit = asyncio.Semaphore(self.max_connections)
+        token = os.environ.get('FCREPO_JWT_TOKEN')
+        self._auth_headers = {'Authorization': f'Bearer {token}'} if token else {}
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def fetch_rdf(self, uri: str) -> str:
+        """
+        Asynchronous counterpart to `DataProvider.fetch_rdf()`, using the same
+        resource cache and recording the requests in the same statistics.
+
+        :raises OAIRepoExternalException: if the resource could not be retrieved
+        """
+        resource_cache = self.data_provider.resource_cache
+        # the caches are SQLite databases, so keep their lookups off the event loop
+        cached = await asyncio.to_thread(resource_cache.get, uri) if resource_cache is not None else None
+        headers = {**self.data_provider.get_rdf_request_headers(cached), **self._auth_headers}
+        stats = self.data_provider.session.stats
+        async with self._fetch_limit:
+            start = time.perf_counter()
+            try:
+                response = await self.client.get(uri, headers=headers)
+            except httpx.HTTPError as e:
+                stats.record(time.perf_counter() - start, None)
+                logger.error(f'GET {uri} -> {e}')
+                raise OAIRepoExternalException('Unable to retrieve resource from fcrepo') from e
+            stats.record(time.perf_counter() - start, response.status_code)
+        if cached is not None and response.status_code == HTTPStatus.NOT_MODIFIED:
+            await asyncio.to_thread(resource_cache.touch, uri)
+            return cached.content
+        if response.is_success:
+            await asyncio.to_thread(self.data_provider.store_rdf, uri, response)
+            return response.text
+        else:
+            logger.error(f'GET {uri} -> {response.status_code} {response.reason_phrase}')
+            raise OAIRepoExternalException('Unable to retrieve resource from fcrepo')
+
+    async def fetch_all_rdf(self, uris: Mapping[str, str]) -> dict[str, str]:
+        """
+        Fetch the given resources concurrently. Resources that could not be
+        retrieved are left out of the result, so that the data provider
+        retries them (and reports the error) when processing the request.
+
+        :param uris: dictionary mapping handles to the URIs to fetch
+        :return: dictionary mapping handles to RDF/XML text
+        """
+        results = await asyncio.gather(*(self.fetch_rdf(uri) for uri in uris.values()), return_exceptions=True)
+        return {
+            handle: result for handle, result in zip(uris.keys(), results)
+            if not isinstance(result, BaseException)
+        }
+
+    async def prepare(
+            self,
+            args: Mapping[str, str],
+            cursor_mark: Optional[str] = None,
+            deleted_offset: int = 0,
+    ) -> Optional[Page]:
+        """
+        Retrieve the documents, set memberships, and RDF/XML that the request
+        with the given arguments will need.
+
+        :param args: OAI-PMH request arguments, without any cursor mark or deleted record offset
+        :param cursor_mark: Solr cursor mark from the request's resumption token
+        :param deleted_offset: number of deleted records already listed, from the request's resumption token
+        :return: prepared page, or None if the request does not need one or
+        is invalid (in which case the data provider reports the error)
+        """
+        verb = args.get('verb')
+        try:
+            if verb == 'GetRecord':
+                return await self._prepare_record(args)
+            if verb in LIST_VERBS:
+                return await self._prepare_list(args, cursor_mark, deleted_offset)
+        except (OAIError, ValueError, KeyError):
+            return None
+        except OAIRepoExternalException as e:
+            logger.warning(f'Unable to prepare {verb} request: {e}')
+            return None
+        return None
+
+    async def _prepare_record(self, args: Mapping[str, str]) -> Optional[Page]:
+        request = OAIRepository.create_request(dict(args))
+        if not self.data_provider.is_valid_identifier(request.identifier):
+            return None
+        handle = OAIIdentifier.parse(request.identifier).local_identifier
+        if await asyncio.to_thread(self.data_provider.get_tombstone, handle) is not None:
+            # a deleted record needs nothing from Solr or fcrepo
+            return None
+        doc = await self.index.get_doc(handle)
+        if doc is None or not self.data_provider.index.has_format(doc, request.metadataprefix):
+            return None
+        docs = {handle: doc}
+        uris = await asyncio.to_thread(self.data_provider._get_uncached_uris, docs, request.metadataprefix)
+        sets, rdf = await asyncio.gather(self.index.get_sets_for_handles([handle]), self.fetch_all_rdf(uris))
+        page = Page(docs=docs, sets=sets)
+        page.set_rdf(rdf)
+        return page
+
+    async def _prepare_list(self, args: Mapping[str, str], cursor_mark: Optional[str], deleted_offset: int) -> Page:
+        request = OAIRepository.create_request(dict(args))
+        repo = OAIRepository(self.data_provider)
+        # same cursor arithmetic as oai_repo's ListIdentifiers response
+        cursor = request.token.cursor + self.data_provider.limit if request.token.cursor is not None else 0
+        filters = (
+            repo.valid_date(request.filter_from),
+            repo.valid_date(request.filter_until),
+            request.filter_set,
+        )
+        # same paging as DataProvider.list_identifiers()
+        paging = ListPaging(
+            self.data_provider.index, self.data_provider.limit, request.metadata_prefix, cursor,
+            cursor_mark=cursor_mark,
+            deleted_offset=deleted_offset,
+            with_deleted=self.data_provider.tombstones is not None,
+        )
+        if paging.with_deleted:
+            tombstones, deleted_hits = await asyncio.to_thread(
+                self.data_provider.get_deleted, *filters, offset=paging.deleted_offset
+            )
+        else:
+            tombstones, deleted_hits = [], 0
+        docs, hits, next_cursor_mark = await self.index.get_docs(*filters, **paging.search_params)
+        paging.merge(docs, hits, next_cursor_mark, tombstones, deleted_hits)
+        if paging.resume_params is not None:
+            _, _, paging.next_cursor_mark = await self.index.get_docs(*filters, **paging.resume_params)
+        if request.verb == 'ListRecords':
+            uris = await asyncio.to_thread(self.data_provider._get_uncached_uris, paging.docs, request.metadata_prefix)
+        else:
+            uris = {}
+        sets, rdf = await asyncio.gather(
+            self.index.get_sets_for_handles(list(paging.docs.keys())), self.fetch_all_rdf(uris)
+        )
+        page = paging.page(sets, prepared=True)
+        page.set_rdf(rdf)
+        return page
@@ -0,0 +1,257 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from io import BytesIO
+from typing import Any, Callable, Optional
+from urllib.parse import parse_qsl
+
+import click
+from dotenv import load_dotenv
+from flask import Flask
+
+from oaipmh import __version__
+from oaipmh.aio import AsyncDataProvider
+from oaipmh.oai import pop_cursor_mark, pop_deleted_offset
+from oaipmh.web import PREPARED_PAGE_KEY, create_app as create_wsgi_app
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+OAI_ENDPOINT_PATH = '/oai/api'
+
+# maximum number of response messages waiting to be sent for a request; when
+# the client is slower than the application, the worker thread waits for room
+RESPONSE_QUEUE_SIZE = 16
+
+
+def get_environ(scope: dict[str, Any], body: bytes) -> dict[str, Any]:
+    """Build a WSGI environ dictionary from an ASGI HTTP connection scope."""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f'HTTP/{scope["http_version"]}',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope['headers']:
+        name = name.decode('latin-1')
+        value = value.decode('latin-1')
+        if name == 'content-type':
+            key = 'CONTENT_TYPE'
+        elif name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+def get_args(query_string: bytes) -> dict[str, str]:
+    """Parse the query string the way Flask's `request.args.get()` does (the first value wins)."""
+    args = {}
+    for name, value in parse_qsl(query_string.decode('latin-1'), keep_blank_values=True):
+        args.setdefault(name, value)
+    return args
+
+
+class AsyncApp:
+    """
+    ASGI application that serves the Flask application. For OAI-PMH requests,
+    the Solr and fcrepo requests are made concurrently on the event loop
+    by the `AsyncDataProvider` before the request is handed to the Flask
+    application, which runs in a pool of worker threads. Each response body
+    is produced by the same worker thread that handled the request, and is
+    passed back to the event loop one chunk at a time.
+    """
+    def __init__(self, wsgi_app: Flask, async_data_provider: AsyncDataProvider, threads: int = 4):
+        self.wsgi_app = wsgi_app
+        self.data_provider = async_data_provider
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='oai-worker')
+
+    async def __call__(self, scope: dict[str, Any], receive: Callable, send: Callable):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive: Callable, send: Callable):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.data_provider.aclose()
+                self._executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope: dict[str, Any], receive: Callable, send: Callable):
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+
+        environ = get_environ(scope, body)
+        # a conditional request may well end in a 304 response, which needs
+        # nothing from fcrepo, so leave it to the data provider to make any
+        # upstream requests that it does need
+        conditional = 'HTTP_IF_NONE_MATCH' in environ or 'HTTP_IF_MODIFIED_SINCE' in environ
+        if scope['path'] == OAI_ENDPOINT_PATH and not conditional:
+            args = get_args(scope['query_string'])
+            cursor_mark = pop_cursor_mark(args)
+            deleted_offset = pop_deleted_offset(args)
+            environ[PREPARED_PAGE_KEY] = await self.data_provider.prepare(args, cursor_mark, deleted_offset)
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=RESPONSE_QUEUE_SIZE)
+        disconnected = threading.Event()
+        worker = loop.run_in_executor(self._executor, self.run_wsgi, environ, loop, queue, disconnected)
+        started = False
+        try:
+            while True:
+                message = await queue.get()
+                if message is None:
+                    break
+                started = started or message['type'] == 'http.response.start'
+                await send(message)
+        except BaseException:
+            # stop the worker thread at its next write, and discard whatever it
+            # puts on the queue until then, so that it is not left waiting for room
+            disconnected.set()
+            asyncio.ensure_future(discard_response(queue, worker))
+            raise
+        try:
+            # re-raise any error from the worker thread
+            await worker
+        finally:
+            if not started:
+                # the application failed before starting the response
+                await send({
+                    'type': 'http.response.start',
+                    'status': HTTPStatus.INTERNAL_SERVER_ERROR,
+                    'headers': [(b'content-type', b'text/plain; charset=utf-8')],
+                })
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+    def run_wsgi(
+            self,
+            environ: dict[str, Any],
+            loop: asyncio.AbstractEventLoop,
+            queue: asyncio.Queue,
+            disconnected: threading.Event,
+    ):
+        """
+        Run the WSGI application in a worker thread, putting the ASGI messages
+        for the response on the queue, followed by None. Each message waits
+        for room on the queue, so the response is produced no faster than it
+        is sent.
+
+        :raises ConnectionAbortedError: if the response could not be sent
+        """
+        def put(message: Optional[dict[str, Any]]):
+            asyncio.run_coroutine_threadsafe(queue.put(message), loop).result()
+
+        def write(chunk: bytes):
+            if disconnected.is_set():
+                raise ConnectionAbortedError('Unable to send the response')
+            if chunk:
+                put({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+
+        def start_response(status: str, headers: list[tuple[str, str]], exc_info=None):
+            put({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+            })
+            return write
+
+        try:
+            result = self.wsgi_app(environ, start_response)
+            try:
+                for chunk in result:
+                    write(chunk)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        finally:
+            put(None)
+
+
+async def discard_response(queue: asyncio.Queue, worker: asyncio.Future):
+    """Take the messages from the queue until the worker thread is done with it."""
+    while await queue.get() is not None:
+        pass
+    try:
+        await worker
+    except Exception as e:
+        logger.debug(f'Response abandoned: {e}')
+
+
+def create_app(solr_config_file=None, threads: Optional[int] = None) -> AsyncApp:
+    """
+    :param solr_config_file: configuration file for the Solr index
+    :param threads: number of worker threads; defaults to `SERVER_THREADS`, or 4
+    """
+    wsgi_app = create_wsgi_app(solr_config_file=solr_config_file)
+    data_provider = wsgi_app.extensions['oaipmh.data_provider']
+    if threads is None:
+        threads = data_provider.server_threads
+    return AsyncApp(
+        wsgi_app=wsgi_app,
+        async_data_provider=AsyncDataProvider(data_provider, solr_url=os.environ['SOLR_URL']),
+        threads=threads,
+    )
+
+
+@click.command()
+@click.option(
+    '--listen',
+    default='0.0.0.0:5000',
+    help='Address and port to listen on. Default is "0.0.0.0:5000".',
+    metavar='[ADDRESS]:PORT',
+)
+@click.option(
+    '--threads',
+    type=int,
+    default=4,
+    envvar='SERVER_THREADS',
+    help='Number of worker threads to process requests with. Default is 4. May also be set using SERVER_THREADS.',
+)
+@click.option(
+    '--solr-config', 'solr_config_file',
+    type=click.File(),
+    help='Configuration file for the Solr index.',
+)
+@click.version_option(__version__, '--version', '-V')
+@click.help_option('--help', '-h')
+def run(listen, threads, solr_config_file):
+    # uvicorn is only needed to run this server, not to use the ASGI application
+    import uvicorn
+
+    logger.info(f'Starting umd-fcrepo-oaipmh/{__version__} (async)')
+    os.environ['SERVER_THREADS'] = str(threads)
+    host, _, port = listen.rpartition(':')
+    try:
+        app = create_app(solr_config_file=solr_config_file, threads=threads)
+        uvicorn.run(app, host=host or '0.0.0.0', port=int(port), server_header=False)
+    except (OSError, RuntimeError) as e:
+        logger.error(f'Exiting: {e}')
+        raise SystemExit(1) from e
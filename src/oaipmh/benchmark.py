@@ -0,0 +1,657 @@
+import base64
+import io
+import json
+import logging
+import os
+import re
+import resource
+import sys
+import threading
+import time
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta, timezone
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Iterator, Optional, TextIO
+from urllib.parse import parse_qs, urlsplit
+from xml.sax.saxutils import escape
+
+import click
+import yaml
+from flask import Flask
+from lxml import etree
+
+from oaipmh import __version__
+from oaipmh.solr import DEFAULT_SOLR_CONFIG
+
+logger = logging.getLogger(__name__)
+
+OAI_NS = '{http://www.openarchives.org/OAI/2.0/}'
+
+HANDLE_PREFIX = '1903.1'
+SET_FIELD = 'collection'
+
+
+def generate_docs(count: int, sets: int, fcrepo_url: str) -> list[dict[str, Any]]:
+    """
+    Generate synthetic Solr documents, with last modified timestamps one
+    minute apart, each in one of the given number of sets.
+    """
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    docs = []
+    for n in range(count):
+        doc = {
+            'id': f'{fcrepo_url}/pcdm/{n:08d}',
+            'handle': f'{HANDLE_PREFIX}/{n}',
+            'last_modified': (start + timedelta(minutes=n)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        }
+        if sets:
+            doc[SET_FIELD] = f'Collection {n % sets}'
+        docs.append(doc)
+    return docs
+
+
+def get_solr_config(sets: int, cursor_paging: bool = False) -> dict[str, Any]:
+    return {
+        **DEFAULT_SOLR_CONFIG,
+        'cursor_paging': cursor_paging,
+        'sets': [
+            {'spec': f'collection_{n}', 'name': f'Collection {n}', 'filter': f'{SET_FIELD}:"Collection {n}"'}
+            for n in range(sets)
+        ],
+    }
+
+
+def generate_rdf(uri: str, subjects: int = 5) -> str:
+    """Generate the RDF/XML description of a PCDM object with a title, identifier, and subjects."""
+    number = uri.rsplit('/', 1)[-1]
+    subject_uris = [f'http://id.loc.gov/authorities/subjects/sh{n:08d}' for n in range(subjects)]
+    lines = [
+        '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"'
+        ' xmlns:rdfs="http://www.w3.org/2000/01/rdf-schema#"'
+        ' xmlns:dc="http://purl.org/dc/elements/1.1/"'
+        ' xmlns:dcterms="http://purl.org/dc/terms/"'
+        ' xmlns:pcdm="http://pcdm.org/models#">',
+        f'  <rdf:Description rdf:about="{escape(uri)}">',
+        '    <rdf:type rdf:resource="http://pcdm.org/models#Object"/>',
+        f'    <dcterms:title>Benchmark object {number}</dcterms:title>',
+        f'    <dcterms:identifier>benchmark-{number}</dcterms:identifier>',
+        '    <dc:date>2020-01-01</dc:date>',
+        '    <dc:language>English</dc:language>',
+        '    <dcterms:description>A synthetic object generated for benchmarking.</dcterms:description>',
+    ]
+    lines.extend(f'    <dcterms:subject rdf:resource="{s}"/>' for s in subject_uris)
+    lines.append('  </rdf:Description>')
+    for n, subject_uri in enumerate(subject_uris):
+        lines.extend([
+            f'  <rdf:Description rdf:about="{subject_uri}">',
+            f'    <rdfs:label>Subject {n}</rdfs:label>',
+            '  </rdf:Description>',
+        ])
+    lines.append('</rdf:RDF>')
+    return '\n'.join(lines)
+
+
+class FakeSolr:
+    """
+    Answers the Solr select queries that `oaipmh.solr.Index` makes, from an
+    in-memory list of documents: equality, wildcard, OR-list, range, and
+    `{!terms}` filters; sorting; start/rows and cursor mark paging; field
+    lists; and the query facets with nested terms facets used to look up
+    set membership. Cursor marks encode the offset of the next page.
+
+    Like Solr's filterCache, the documents matching each filter query are
+    kept, keyed by the query, unless it has the `cache=false` local param,
+    and the hits and misses are counted.
+    """
+    FILTERS: list[tuple[re.Pattern, str]] = [
+        (re.compile(r'^\*:\*$'), 'all'),
+        (re.compile(r'^\{!terms f=(\w+)[^}]*}(.*)$'), 'terms'),
+        (re.compile(r'^(\w+):\*$'), 'exists'),
+        (re.compile(r'^(\w+):\[(\S+) TO (\S+)]$'), 'range'),
+        (re.compile(r'^(\w+):\((.*)\)$'), 'any'),
+        (re.compile(r'^(\w+):"((?:[^"\\]|\\.)*)"$'), 'equals'),
+        (re.compile(r'^(\w+):(\S+)$'), 'equals'),
+    ]
+
+    LOCAL_PARAMS = re.compile(r'^\{!([^}]*)}(.*)$')
+
+    def __init__(self, docs: list[dict[str, Any]]):
+        self.docs = docs
+        self.filter_cache: dict[str, list[int]] = {}
+        self.filter_cache_hits = 0
+        self.filter_cache_misses = 0
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.filter_cache.clear()
+            self.filter_cache_hits = 0
+            self.filter_cache_misses = 0
+
+    def filter_docs(self, filter_queries: list[str]) -> list[dict[str, Any]]:
+        """Return the documents, in index order, that match all the filter queries."""
+        matching: Optional[set[int]] = None
+        uncached = []
+        for query in filter_queries:
+            match = self.LOCAL_PARAMS.match(query.strip())
+            if match is not None and 'cache=false' in match[1].split():
+                # local params with no query parser apply to the rest of the query
+                uncached.append(self.parse_filter(match[2] if match[1] == 'cache=false' else query))
+                continue
+            with self._lock:
+                ids = self.filter_cache.get(query)
+                if ids is not None:
+                    self.filter_cache_hits += 1
+                else:
+                    self.filter_cache_misses += 1
+            if ids is None:
+                matches = self.parse_filter(query)
+                ids = [n for n, doc in enumerate(self.docs) if matches(doc)]
+                with self._lock:
+                    self.filter_cache[query] = ids
+            matching = set(ids) if matching is None else matching.intersection(ids)
+        # uncached filters are only checked against the documents that match the cached ones
+        candidates = range(len(self.docs)) if matching is None else sorted(matching)
+        return [self.docs[n] for n in candidates if all(f(self.docs[n]) for f in uncached)]
+
+    def parse_filter(self, query: str) -> Callable[[dict[str, Any]], bool]:
+        for pattern, kind in self.FILTERS:
+            match = pattern.match(query.strip())
+            if match is None:
+                continue
+            if kind == 'all':
+                return lambda doc: True
+            if kind == 'terms':
+                field_name, values = match[1], set(match[2].split(','))
+                return lambda doc: doc.get(field_name) in values
+            if kind == 'exists':
+                return lambda doc: match[1] in doc
+            if kind == 'range':
+                field_name, low, high = match[1], match[2], match[3]
+                return lambda doc: (
+                    field_name in doc
+                    and (low == '*' or doc[field_name] >= low)
+                    and (high == '*' or doc[field_name] <= high)
+                )
+            if kind == 'any':
+                values = {v.replace('\\"', '"') for v in re.findall(r'"((?:[^"\\]|\\.)*)"', match[2])}
+                return lambda doc: doc.get(match[1]) in values
+            value = match[2].replace('\\"', '"')
+            return lambda doc: doc.get(match[1]) == value
+        raise ValueError(f'Unsupported query: {query}')
+
+    def select(self, params: dict[str, list[str]]) -> dict[str, Any]:
+        query = self.parse_filter(params.get('q', ['*:*'])[0])
+        matches = [doc for doc in self.filter_docs(params.get('fq', [])) if query(doc)]
+        for sort_field, direction in reversed(parse_sort(params.get('sort', [''])[0])):
+            matches.sort(key=lambda doc: doc.get(sort_field, ''), reverse=direction == 'desc')
+        rows = int(params.get('rows', ['10'])[0])
+        cursor_mark = params.get('cursorMark', [None])[0]
+        if cursor_mark is not None:
+            start = 0 if cursor_mark == '*' else int(base64.b64decode(cursor_mark))
+        else:
+            start = int(params.get('start', ['0'])[0])
+        page = matches[start:start + rows]
+        field_list = params.get('fl', [''])[0]
+        if field_list:
+            fields = field_list.split(',')
+            page = [{k: v for k, v in doc.items() if k in fields} for doc in page]
+        result = {'response': {'numFound': len(matches), 'start': start, 'docs': page}}
+        if cursor_mark is not None:
+            next_start = start + len(page)
+            result['nextCursorMark'] = base64.b64encode(str(next_start).encode()).decode() if page else cursor_mark
+        if 'json.facet' in params:
+            result['facets'] = self.facet(matches, json.loads(params['json.facet'][0]))
+        return result
+
+    def facet(self, matches: list[dict[str, Any]], facets: dict[str, Any]) -> dict[str, Any]:
+        results = {'count': len(matches)}
+        for name, facet in facets.items():
+            if facet['type'] == 'query':
+                matching = list(filter(self.parse_filter(facet['q']), matches))
+                results[name] = self.facet(matching, facet.get('facet', {}))
+            elif facet['type'] == 'terms':
+                counts = Counter(doc[facet['field']] for doc in matches if facet['field'] in doc)
+                buckets = [{'val': v, 'count': c} for v, c in counts.most_common(facet.get('limit', 10))]
+                results[name] = {'buckets': buckets}
+        return results
+
+
+def parse_sort(sort: str) -> list[tuple[str, str]]:
+    clauses = []
+    for clause in sort.split(','):
+        if clause.strip():
+            sort_field, _, direction = clause.strip().partition(' ')
+            clauses.append((sort_field, direction.strip() or 'asc'))
+    return clauses
+
+
+class StubServer:
+    """
+    HTTP server running in a background thread, with a fixed latency added
+    to every response, and a count of the requests it has handled.
+    """
+    def __init__(self, handle: Callable[[str, str, dict[str, str], bytes], tuple[int, dict[str, str], bytes]],
+                 latency: float = 0):
+        """
+        :param handle: function that takes the method, path (with query
+        string), headers, and body of a request, and returns the status,
+        headers, and body of the response
+        :param latency: number of seconds to wait before each response
+        """
+        self.requests = 0
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # keep connections alive, as fcrepo and Solr do
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written separately; without this, every
+            # response waits on a delayed acknowledgement
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self.respond()
+
+            def do_POST(self):
+                self.respond()
+
+            def respond(self):
+                with server._lock:
+                    server.requests += 1
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if latency:
+                    time.sleep(latency)
+                status, headers, content = handle(self.command, self.path, dict(self.headers), body)
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name='stub-server', daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def solr_handler(solr: FakeSolr) -> Callable[[str, str, dict[str, str], bytes], tuple[int, dict[str, str], bytes]]:
+    def handle(method: str, path: str, headers: dict[str, str], body: bytes) -> tuple[int, dict[str, str], bytes]:
+        params = parse_qs(urlsplit(path).query)
+        if body:
+            for key, values in parse_qs(body.decode()).items():
+                params.setdefault(key, []).extend(values)
+        try:
+            result = solr.select(params)
+        except ValueError as e:
+            return HTTPStatus.BAD_REQUEST, {}, json.dumps({'error': {'msg': str(e)}}).encode()
+        return HTTPStatus.OK, {'Content-Type': 'application/json'}, json.dumps(result).encode()
+    return handle
+
+
+def fcrepo_handle(method: str, path: str, headers: dict[str, str], body: bytes) -> tuple[int, dict[str, str], bytes]:
+    etag = f'W/"{zlib.crc32(path.encode())}"'
+    validators = {'ETag': etag, 'Last-Modified': 'Wed, 01 Jan 2020 00:00:00 GMT'}
+    if headers.get('If-None-Match') == etag:
+        return HTTPStatus.NOT_MODIFIED, validators, b''
+    rdf = generate_rdf(f'http://{headers["Host"]}{path}').encode()
+    return HTTPStatus.OK, {**validators, 'Content-Type': 'application/rdf+xml'}, rdf
+
+
+@dataclass
+class ScenarioResult:
+    name: str
+    requests: int = 0
+    records: int = 0
+    elapsed: float = 0.0
+    p50: float = 0.0
+    p99: float = 0.0
+    solr_calls: int = 0
+    fcrepo_calls: int = 0
+    filter_cache_hits: int = 0
+    filter_cache_misses: int = 0
+    filter_cache_size: int = 0
+    rss_growth_mb: float = 0.0
+    latencies: list[float] = field(default_factory=list, repr=False)
+
+    @property
+    def records_per_second(self) -> float:
+        return self.records / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def solr_calls_per_record(self) -> float:
+        return self.solr_calls / self.records if self.records else 0.0
+
+    @property
+    def fcrepo_calls_per_record(self) -> float:
+        return self.fcrepo_calls / self.records if self.records else 0.0
+
+    @property
+    def filter_cache_hit_ratio(self) -> float:
+        lookups = self.filter_cache_hits + self.filter_cache_misses
+        return self.filter_cache_hits / lookups if lookups else 0.0
+
+    def to_dict(self) -> dict[str, Any]:
+        result = asdict(self)
+        del result['latencies']
+        result['records_per_second'] = self.records_per_second
+        result['solr_calls_per_record'] = self.solr_calls_per_record
+        result['fcrepo_calls_per_record'] = self.fcrepo_calls_per_record
+        result['filter_cache_hit_ratio'] = self.filter_cache_hit_ratio
+        return result
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """Nearest-rank percentile of the given values."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def max_rss_mb() -> float:
+    """Peak resident set size of this process so far, in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in bytes on macOS, and in kilobytes elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+class Benchmark:
+    """
+    Runs harvests against an OAI-PMH app created by `oaipmh.web.create_app`,
+    with Solr and fcrepo replaced by in-process stub servers, and reports
+    the throughput, latency, upstream calls, and memory use of each.
+    """
+    def __init__(
+            self,
+            docs: int = 1000,
+            sets: int = 10,
+            solr_latency: float = 0,
+            fcrepo_latency: float = 0,
+            cursor_paging: bool = False,
+            harvesters: int = 1,
+    ):
+        """
+        :param docs: number of synthetic documents in the index
+        :param sets: number of sets to divide the documents between
+        :param solr_latency: seconds to add to every Solr response
+        :param fcrepo_latency: seconds to add to every fcrepo response
+        :param cursor_paging: whether to use Solr cursor mark paging
+        :param harvesters: number of harvests to run concurrently in each scenario
+        """
+        self.docs = docs
+        self.sets = sets
+        self.harvesters = harvesters
+        self.fcrepo = StubServer(fcrepo_handle, latency=fcrepo_latency)
+        self.solr_docs = generate_docs(docs, sets, self.fcrepo.url)
+        self.fake_solr = FakeSolr(self.solr_docs)
+        self.solr = StubServer(solr_handler(self.fake_solr), latency=solr_latency)
+        self.app = self.create_app(cursor_paging)
+
+    def create_app(self, cursor_paging: bool) -> Flask:
+        # imported here so that the environment is set before the app reads it
+        from oaipmh.web import create_app
+
+        os.environ['SOLR_URL'] = self.solr.url + '/solr/fcrepo'
+        for key, value in {
+            'ADMIN_EMAIL': 'benchmark@example.com',
+            'BASE_URL': 'http://localhost:5000/oai/api',
+            # oai_repo rejects "from" and "until" arguments with any other granularity
+            'DATESTAMP_GRANULARITY': 'YYYY-MM-DD',
+            'EARLIEST_DATESTAMP': '2020-01-01',
+            'FCREPO_JWT_TOKEN': 'benchmark',
+            'OAI_NAMESPACE_IDENTIFIER': 'fcrepo',
+            'OAI_REPOSITORY_NAME': 'Benchmark Repository',
+        }.items():
+            os.environ.setdefault(key, value)
+        return create_app(io.StringIO(yaml.safe_dump(get_solr_config(self.sets, cursor_paging))))
+
+    def close(self):
+        self.solr.close()
+        self.fcrepo.close()
+
+    def harvest(self, verb: str, **args) -> Iterator[tuple[float, int]]:
+        """
+        Run a complete list harvest, following resumption tokens.
+
+        :return: iterator of the latency and number of records of each response
+        """
+        client = self.app.test_client()
+        query = {'verb': verb, **args}
+        while True:
+            start = time.perf_counter()
+            response = client.get('/oai/api', query_string=query)
+            data = response.get_data()
+            elapsed = time.perf_counter() - start
+            if response.status_code == HTTPStatus.NOT_FOUND:
+                # noRecordsMatch
+                yield elapsed, 0
+                return
+            if response.status_code != HTTPStatus.OK:
+                raise RuntimeError(f'{verb} {query} -> {response.status_code}: {data[:500]!r}')
+            root = etree.fromstring(data)
+            records = len(root.findall(f'.//{OAI_NS}header'))
+            yield elapsed, records
+            token = root.find(f'.//{OAI_NS}resumptionToken')
+            if token is None or not token.text:
+                return
+            query = {'verb': verb, 'resumptionToken': token.text}
+
+    def get_records(self, handles: list[str], metadata_prefix: str) -> Iterator[tuple[float, int]]:
+        client = self.app.test_client()
+        for handle in handles:
+            start = time.perf_counter()
+            response = client.get('/oai/api', query_string={
+                'verb': 'GetRecord', 'identifier': f'oai:fcrepo:{handle}', 'metadataPrefix': metadata_prefix,
+            })
+            response.get_data()
+            if response.status_code != HTTPStatus.OK:
+                raise RuntimeError(f'GetRecord {handle} -> {response.status_code}')
+            yield time.perf_counter() - start, 1
+
+    def run_scenario(self, name: str, run: Callable[[int], Iterator[tuple[float, int]]]) -> ScenarioResult:
+        """
+        Run a scenario with the configured number of concurrent harvesters.
+
+        :param name: name of the scenario
+        :param run: function that takes the harvester number, and returns an
+        iterator of the latency and number of records of each response
+        """
+        self.solr.reset()
+        self.fcrepo.reset()
+        self.fake_solr.reset()
+        result = ScenarioResult(name)
+        # the peak is for the life of the process, so only its growth during
+        # this scenario can be attributed to it
+        rss_before = max_rss_mb()
+
+        def harvest(n: int) -> list[tuple[float, int]]:
+            return list(run(n))
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.harvesters) as executor:
+            for responses in executor.map(harvest, range(self.harvesters)):
+                for latency, records in responses:
+                    result.latencies.append(latency)
+                    result.records += records
+        result.elapsed = time.perf_counter() - start
+        result.requests = len(result.latencies)
+        result.p50 = percentile(result.latencies, 0.5)
+        result.p99 = percentile(result.latencies, 0.99)
+        result.solr_calls = self.solr.requests
+        result.fcrepo_calls = self.fcrepo.requests
+        result.filter_cache_hits = self.fake_solr.filter_cache_hits
+        result.filter_cache_misses = self.fake_solr.filter_cache_misses
+        result.filter_cache_size = len(self.fake_solr.filter_cache)
+        result.rss_growth_mb = max_rss_mb() - rss_before
+        return result
+
+    def run(
+            self,
+            scenarios: list[str],
+            metadata_prefix: str = 'oai_dc',
+            get_records: int = 100,
+    ) -> list[ScenarioResult]:
+        handles = [doc['handle'] for doc in self.solr_docs[:get_records]]
+        # harvest from the day of the middle document
+        from_date = self.solr_docs[len(self.solr_docs) // 2]['last_modified'][:10] if self.solr_docs else None
+        available = {
+            'ListIdentifiers': lambda n: self.harvest('ListIdentifiers', metadataPrefix=metadata_prefix),
+            'ListIdentifiers-from': lambda n: self.harvest(
+                'ListIdentifiers', metadataPrefix=metadata_prefix, **{'from': from_date}
+            ),
+            'ListRecords': lambda n: self.harvest('ListRecords', metadataPrefix=metadata_prefix),
+            'ListRecords-set': lambda n: self.harvest(
+                'ListRecords', metadataPrefix=metadata_prefix, set=f'collection_{n % max(self.sets, 1)}'
+            ),
+            'GetRecord': lambda n: self.get_records(handles, metadata_prefix),
+        }
+        results = []
+        for name in scenarios:
+            if (name == 'ListRecords-set' and not self.sets) or (name == 'ListIdentifiers-from' and not self.docs):
+                continue
+            result = self.run_scenario(name, available[name])
+            logger.info(f'{name}: {result.records} records in {result.elapsed:.2f}s')
+            results.append(result)
+        return results
+
+
+SCENARIOS = ['ListIdentifiers', 'ListIdentifiers-from', 'ListRecords', 'ListRecords-set', 'GetRecord']
+
+
+def format_results(results: list[ScenarioResult]) -> str:
+    header = (
+        f'{"scenario":<20} {"requests":>8} {"records":>8} {"rec/s":>9} {"p50 ms":>8} {"p99 ms":>8} '
+        f'{"solr/rec":>9} {"fcrepo/rec":>10} {"fq hit %":>8} {"fq size":>7} {"RSS +MiB":>9}'
+    )
+    lines = [header, '-' * len(header)]
+    for r in results:
+        lines.append(
+            f'{r.name:<20} {r.requests:>8} {r.records:>8} {r.records_per_second:>9.1f} {r.p50 * 1000:>8.1f} '
+            f'{r.p99 * 1000:>8.1f} {r.solr_calls_per_record:>9.3f} {r.fcrepo_calls_per_record:>10.3f} '
+            f'{r.filter_cache_hit_ratio * 100:>8.1f} {r.filter_cache_size:>7} {r.rss_growth_mb:>9.1f}'
+        )
+    return '\n'.join(lines)
+
+
+def compare(results: list[ScenarioResult], baseline: dict[str, Any], tolerance: float) -> list[str]:
+    """
+    Compare results to a baseline, as written by `--output`.
+
+    :return: descriptions of the regressions: scenarios whose throughput
+    dropped, or whose upstream calls per record rose, by more than the
+    tolerance (a fraction)
+    """
+    regressions = []
+    previous = {r['name']: r for r in baseline.get('results', [])}
+    for result in results:
+        before = previous.get(result.name)
+        if before is None:
+            continue
+        if result.records_per_second < before['records_per_second'] * (1 - tolerance):
+            regressions.append(
+                f'{result.name}: {result.records_per_second:.1f} records/s '
+                f'(baseline {before["records_per_second"]:.1f})'
+            )
+        for key in ('solr_calls_per_record', 'fcrepo_calls_per_record'):
+            if getattr(result, key) > before[key] * (1 + tolerance) + 1e-9:
+                regressions.append(f'{result.name}: {getattr(result, key):.3f} {key} (baseline {before[key]:.3f})')
+    return regressions
+
+
+@click.command()
+@click.option('--docs', type=int, default=1000, help='Number of synthetic documents. Default is 1000.')
+@click.option('--sets', type=int, default=10, help='Number of sets to divide the documents between. Default is 10.')
+@click.option('--solr-latency', type=float, default=0, help='Seconds to add to every Solr response. Default is 0.')
+@click.option('--fcrepo-latency', type=float, default=0, help='Seconds to add to every fcrepo response. Default is 0.')
+@click.option('--cursor-paging', is_flag=True, help='Use Solr cursor mark paging.')
+@click.option(
+    '--harvesters', type=int, default=1,
+    help='Number of harvests to run concurrently in each scenario. Default is 1.',
+)
+@click.option(
+    '--scenario', 'scenarios', multiple=True, type=click.Choice(SCENARIOS),
+    help='Scenario to run. May be repeated. Defaults to all scenarios.',
+)
+@click.option('--metadata-prefix', default='oai_dc', help='Metadata prefix to harvest. Default is "oai_dc".')
+@click.option(
+    '--get-records', type=int, default=100,
+    help='Number of records to retrieve in the GetRecord scenario. Default is 100.',
+)
+@click.option('--output', '-o', type=click.File('w'), help='File to write the results to, as JSON.')
+@click.option('--baseline', type=click.File(), help='Results of an earlier run (from --output) to compare to.')
+@click.option(
+    '--tolerance', type=float, default=0.2,
+    help='Fraction by which a result may be worse than the baseline before it is a regression. Default is 0.2.',
+)
+@click.version_option(__version__, '--version', '-V')
+@click.help_option('--help', '-h')
+def main(
+        docs: int,
+        sets: int,
+        solr_latency: float,
+        fcrepo_latency: float,
+        cursor_paging: bool,
+        harvesters: int,
+        scenarios: tuple[str, ...],
+        metadata_prefix: str,
+        get_records: int,
+        output: Optional[TextIO],
+        baseline: Optional[TextIO],
+        tolerance: float,
+):
+    # configure logging before the data provider module does, since it
+    # logs every Solr query and fcrepo request at debug level
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+    benchmark = Benchmark(
+        docs=docs,
+        sets=sets,
+        solr_latency=solr_latency,
+        fcrepo_latency=fcrepo_latency,
+        cursor_paging=cursor_paging,
+        harvesters=harvesters,
+    )
+    try:
+        results = benchmark.run(list(scenarios) or SCENARIOS, metadata_prefix=metadata_prefix, get_records=get_records)
+    finally:
+        benchmark.close()
+    click.echo(format_results(results))
+    if output is not None:
+        settings = {
+            'docs': docs, 'sets': sets, 'solr_latency': solr_latency, 'fcrepo_latency': fcrepo_latency,
+            'cursor_paging': cursor_paging, 'harvesters': harvesters, 'metadata_prefix': metadata_prefix,
+        }
+        json.dump({'version': __version__, 'settings': settings, 'results': [r.to_dict() for r in results]},
+                  output, indent=2)
+    if baseline is not None:
+        regressions = compare(results, json.load(baseline), tolerance)
+        for regression in regressions:
+            click.echo(f'Regression: {regression}', err=True)
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteCache:
+    """
+    Base class for the caches that are stored in an SQLite database file, so
+    that they survive restarts. Each subclass stores its entries in its own
+    table, with an `accessed` column that is used to evict the least recently
+    used entries when there are more than `max_size` of them. Several caches
+    can share the same database file.
+
+    Rather than counting the entries after every insert, a cache keeps an
+    upper bound on the number of entries (a replaced entry is counted as a
+    new one), and only counts them when the bound goes over the maximum
+    size. It then evicts down to 1% below the maximum size, so that a full
+    cache is not counted on every insert.
+    """
+    table: str
+    columns: str
+
+    def __init__(self, path: str | Path, max_size: int = 100000):
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(f'CREATE TABLE IF NOT EXISTS {self.table} ({self.columns})')
+        self._connection.execute(f'CREATE INDEX IF NOT EXISTS {self.table}_accessed ON {self.table} (accessed)')
+        self._size = self._count() if max_size else 0
+        logger.info(f'{type(self).__name__}: {path} (max size {max_size})')
+
+    def __len__(self):
+        with self._lock:
+            return self._count()
+
+    def _count(self) -> int:
+        return self._connection.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+    def _evict(self):
+        """
+        Count an entry that was just stored, and if there may be more than
+        the maximum number of entries, remove the least recently used ones.
+        Caller must hold the lock.
+        """
+        self._size += 1
+        if self._size <= self.max_size:
+            return
+        self._connection.execute(
+            f'DELETE FROM {self.table} WHERE rowid IN ('
+            f' SELECT rowid FROM {self.table} ORDER BY accessed'
+            f' LIMIT MAX(0, (SELECT COUNT(*) FROM {self.table}) - ?)'
+            ')',
+            (self.max_size - self.max_size // 100,),
+        )
+        self._size = self._count()
+
+    def invalidate(self, uri: str):
+        """Remove all entries for the given URI."""
+        with self._lock:
+            deleted = self._connection.execute(f'DELETE FROM {self.table} WHERE uri = ?', (uri,)).rowcount
+            self._size = max(0, self._size - deleted)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class MetadataCache(SQLiteCache):
+    """
+    Persistent cache of transformed metadata records. Records are keyed by
+    the URI of the fcrepo resource and the metadata prefix, and are only
+    valid for the last modified timestamp they were stored with.
+    """
+    table = 'metadata'
+    columns = (
+        'uri TEXT NOT NULL,'
+        ' prefix TEXT NOT NULL,'
+        ' last_modified TEXT NOT NULL,'
+        ' content BLOB NOT NULL,'
+        ' accessed REAL NOT NULL,'
+        ' PRIMARY KEY (uri, prefix)'
+    )
+
+    def contains(self, uri: str, prefix: str, last_modified: str) -> bool:
+        """True if there is a current record for the URI and prefix, without counting as a use."""
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT 1 FROM metadata WHERE uri = ? AND prefix = ? AND last_modified = ?',
+                (uri, prefix, last_modified),
+            ).fetchone()
+        return row is not None
+
+    def get(self, uri: str, prefix: str, last_modified: str) -> Optional[bytes]:
+        """
+        Return the serialized record for the URI and prefix, if there is one
+        and it was stored with the given last modified timestamp.
+
+        :param uri: URI of the fcrepo resource
+        :param prefix: metadata prefix
+        :param last_modified: current last modified timestamp of the resource
+        :return: serialized metadata record, or None
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT content FROM metadata WHERE uri = ? AND prefix = ? AND last_modified = ?',
+                (uri, prefix, last_modified),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._connection.execute(
+                'UPDATE metadata SET accessed = ? WHERE uri = ? AND prefix = ?',
+                (time.time(), uri, prefix),
+            )
+            self.hits += 1
+            return row[0]
+
+    def put(self, uri: str, prefix: str, last_modified: str, content: bytes):
+        """
+        Store a serialized record, replacing any previous record for the
+        URI and prefix, and evict the least recently used records if the
+        cache is over its maximum size.
+        """
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO metadata (uri, prefix, last_modified, content, accessed)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (uri, prefix, last_modified, content, time.time()),
+            )
+            self._evict()
+
+
+class CachedResource(NamedTuple):
+    etag: Optional[str]
+    last_modified: Optional[str]
+    content: str
+
+
+class ResourceCache(SQLiteCache):
+    """
+    Persistent cache of the RDF/XML serializations of fcrepo resources,
+    along with the `ETag` and `Last-Modified` validators that fcrepo sent
+    with them, so that they can be re-requested conditionally. Hits count
+    the cached bodies reused after revalidation, and misses count the full
+    bodies stored.
+    """
+    table = 'resources'
+    columns = (
+        'uri TEXT NOT NULL PRIMARY KEY,'
+        ' etag TEXT,'
+        ' last_modified TEXT,'
+        ' content TEXT NOT NULL,'
+        ' accessed REAL NOT NULL'
+    )
+
+    def get(self, uri: str) -> Optional[CachedResource]:
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT etag, last_modified, content FROM resources WHERE uri = ?', (uri,)
+            ).fetchone()
+        return CachedResource(*row) if row is not None else None
+
+    def touch(self, uri: str):
+        """Mark the entry for the URI as used, after it was revalidated."""
+        with self._lock:
+            self._connection.execute('UPDATE resources SET accessed = ? WHERE uri = ?', (time.time(), uri))
+            self.hits += 1
+
+    def put(self, uri: str, etag: Optional[str], last_modified: Optional[str], content: str):
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO resources (uri, etag, last_modified, content, accessed)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (uri, etag, last_modified, content, time.time()),
+            )
+            self.misses += 1
+            self._evict()
+
+
+class RecordStore(SQLiteCache):
+    """
+    Persistent store of pre-materialized metadata records, written by the
+    `materialize-records` command and read by the server. Records are
+    keyed by handle and metadata prefix, and are only valid for the last
+    modified timestamp they were stored with. Unlike the caches, the store
+    is never trimmed to a maximum size. It also holds the checkpoint that
+    the `materialize-records` command resumes from.
+    """
+    table = 'records'
+    columns = (
+        'handle TEXT NOT NULL,'
+        ' prefix TEXT NOT NULL,'
+        ' uri TEXT NOT NULL,'
+        ' last_modified TEXT NOT NULL,'
+        ' content BLOB NOT NULL,'
+        ' accessed REAL NOT NULL,'
+        ' PRIMARY KEY (handle, prefix)'
+    )
+
+    def __init__(self, path: str | Path):
+        super().__init__(path, max_size=0)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS state (key TEXT NOT NULL PRIMARY KEY, value TEXT)')
+        self._connection.execute(f'CREATE INDEX IF NOT EXISTS {self.table}_uri ON {self.table} (uri)')
+
+    def contains(self, handle: str, prefix: str, last_modified: str) -> bool:
+        """True if there is a current record for the handle and prefix, without counting as a use."""
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT 1 FROM records WHERE handle = ? AND prefix = ? AND last_modified = ?',
+                (handle, prefix, last_modified),
+            ).fetchone()
+        return row is not None
+
+    def get(self, handle: str, prefix: str, last_modified: str) -> Optional[bytes]:
+        """
+        Return the serialized record for the handle and prefix, if there is
+        one and it was stored with the given last modified timestamp.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT content FROM records WHERE handle = ? AND prefix = ? AND last_modified = ?',
+                (handle, prefix, last_modified),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, handle: str, prefix: str, uri: str, last_modified: str, content: bytes):
+        """Store a serialized record, replacing any previous record for the handle and prefix."""
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO records (handle, prefix, uri, last_modified, content, accessed)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                (handle, prefix, uri, last_modified, content, time.time()),
+            )
+
+    def get_checkpoint(self) -> Optional[str]:
+        """Return the last modified timestamp that materialization should resume from, if any."""
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM state WHERE key = 'checkpoint'").fetchone()
+        return row[0] if row is not None else None
+
+    def set_checkpoint(self, last_modified: str):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO state (key, value) VALUES ('checkpoint', ?)", (last_modified,)
+            )
+
+
+class Tombstone(NamedTuple):
+    handle: str
+    uri: str
+    datestamp: str
+    setspecs: tuple[str, ...]
+
+
+class TombstoneStore(SQLiteCache):
+    """
+    Persistent store of the records that have been deleted, so that they
+    can be reported to harvesters. Each tombstone holds just the handle,
+    the URI, the deletion datestamp (in the "YYYY-MM-DDThh:mm:ssZ" format,
+    so that datestamps sort and compare as text), and the set specs the
+    record belonged to. Tombstones are listed in datestamp order, using an
+    index on the datestamp.
+    """
+    table = 'tombstones'
+    columns = (
+        'handle TEXT NOT NULL PRIMARY KEY,'
+        ' uri TEXT NOT NULL,'
+        ' datestamp TEXT NOT NULL,'
+        ' setspecs TEXT NOT NULL,'
+        ' accessed REAL NOT NULL'
+    )
+
+    def __init__(self, path: str | Path):
+        super().__init__(path, max_size=0)
+        self._connection.execute(
+            f'CREATE INDEX IF NOT EXISTS {self.table}_datestamp ON {self.table} (datestamp, handle)'
+        )
+        self._connection.execute(f'CREATE INDEX IF NOT EXISTS {self.table}_uri ON {self.table} (uri)')
+
+    @staticmethod
+    def _where(
+            filter_from: Optional[str],
+            filter_until: Optional[str],
+            filter_set: Optional[str],
+    ) -> tuple[str, list[str]]:
+        clauses, params = [], []
+        if filter_from:
+            clauses.append('datestamp >= ?')
+            params.append(filter_from)
+        if filter_until:
+            clauses.append('datestamp <= ?')
+            params.append(filter_until)
+        if filter_set:
+            # set specs are stored space-separated, with a space at either end
+            clauses.append('instr(setspecs, ?) > 0')
+            params.append(f' {filter_set} ')
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+    def get(self, handle: str) -> Optional[Tombstone]:
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT handle, uri, datestamp, setspecs FROM tombstones WHERE handle = ?', (handle,)
+            ).fetchone()
+        if row is None:
+            return None
+        return Tombstone(row[0], row[1], row[2], tuple(row[3].split()))
+
+    def put(self, tombstone: Tombstone):
+        """Store a tombstone, replacing any previous tombstone for the same handle."""
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO tombstones (handle, uri, datestamp, setspecs, accessed)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (
+                    tombstone.handle,
+                    tombstone.uri,
+                    tombstone.datestamp,
+                    ' ' + ' '.join(tombstone.setspecs) + ' ',
+                    time.time(),
+                ),
+            )
+
+    def count(
+            self,
+            filter_from: Optional[str] = None,
+            filter_until: Optional[str] = None,
+            filter_set: Optional[str] = None,
+    ) -> int:
+        """Return the number of tombstones within the datestamp range, and in the set, if given."""
+        where, params = self._where(filter_from, filter_until, filter_set)
+        with self._lock:
+            return self._connection.execute(f'SELECT COUNT(*) FROM tombstones{where}', params).fetchone()[0]
+
+    def find(
+            self,
+            filter_from: Optional[str] = None,
+            filter_until: Optional[str] = None,
+            filter_set: Optional[str] = None,
+            offset: int = 0,
+            limit: int = 25,
+    ) -> list[Tombstone]:
+        """
+        Return tombstones within the datestamp range, and in the set, if
+        given, in datestamp order (and then handle order, for tombstones with
+        the same datestamp).
+        """
+        where, params = self._where(filter_from, filter_until, filter_set)
+        with self._lock:
+            rows = self._connection.execute(
+                f'SELECT handle, uri, datestamp, setspecs FROM tombstones{where}'
+                ' ORDER BY datestamp, handle LIMIT ? OFFSET ?',
+                (*params, limit, offset),
+            ).fetchall()
+        return [Tombstone(handle, uri, datestamp, tuple(setspecs.split())) for handle, uri, datestamp, setspecs in rows]
+
+    def prune(self, before: str):
+        """Remove the tombstones with datestamps before the given datestamp."""
+        with self._lock:
+            self._connection.execute('DELETE FROM tombstones WHERE datestamp < ?', (before,))
@@ -0,0 +1,398 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Iterator, Optional
+from urllib.parse import unquote, urlparse
+
+from lxml import etree
+from oai_repo import OAIRepoExternalException, OAIRepoInternalException
+from oai_repo.helpers import datestamp_long
+
+from oaipmh.cache import Tombstone
+from oaipmh.config import EnvAttribute
+from oaipmh.dataprovider import DataProvider
+
+try:
+    import stomp
+except ImportError:
+    # only needed when a STOMP change feed is configured
+    stomp = None
+
+logger = logging.getLogger(__name__)
+
+# fcrepo resource types whose changes can change the list of sets
+COLLECTION_TYPES = {
+    'http://pcdm.org/models#Collection',
+}
+
+
+@dataclass
+class ChangeEvent:
+    """A change to an fcrepo resource, parsed from an fcrepo event message."""
+    uri: str
+    event_types: tuple[str, ...] = ()
+    resource_types: tuple[str, ...] = ()
+    published: Optional[str] = None
+    received: float = field(default_factory=time.monotonic)
+    # for a deleted record, the tombstone to record for it; see `ChangeFeedConsumer.read()`
+    tombstone: Optional[Tombstone] = None
+
+    @classmethod
+    def from_message(cls, message: dict[str, Any]) -> Optional['ChangeEvent']:
+        """
+        Parse an fcrepo event message body (an Activity Streams JSON-LD
+        object). Events for hash URIs are reported as events for the resource
+        they belong to.
+
+        :return: change event, or None if the message does not identify a resource
+        """
+        target = message.get('object')
+        if isinstance(target, str):
+            target = {'id': target}
+        if not isinstance(target, dict) or not target.get('id'):
+            return None
+        return cls(
+            uri=target['id'].split('#', 1)[0],
+            event_types=_as_tuple(message.get('type')),
+            resource_types=_as_tuple(target.get('type')),
+            published=message.get('published'),
+        )
+
+    @property
+    def is_collection(self) -> bool:
+        return not COLLECTION_TYPES.isdisjoint(self.resource_types)
+
+    @property
+    def is_delete(self) -> bool:
+        return 'Delete' in self.event_types
+
+
+def _as_tuple(value: Any) -> tuple[str, ...]:
+    if value is None:
+        return ()
+    if isinstance(value, str):
+        return (value,)
+    return tuple(value)
+
+
+class JSONLinesSource:
+    """
+    Reads fcrepo event messages from a file with one JSON message per line.
+    The whole file is replayed from the start, and then, if `follow` is
+    true, lines appended to it are read as they arrive. Lines that are not
+    valid JSON are logged and skipped.
+    """
+    def __init__(self, path: str, follow: bool = True, poll_interval: float = 1.0):
+        self.path = path
+        self.follow = follow
+        self.poll_interval = poll_interval
+        self._closed = threading.Event()
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        with open(self.path) as fh:
+            buffer = ''
+            while not self._closed.is_set():
+                line = fh.readline()
+                if not line:
+                    if not self.follow:
+                        break
+                    self._closed.wait(self.poll_interval)
+                    continue
+                buffer += line
+                if not buffer.endswith('\n') and self.follow:
+                    # partially written line; wait for the rest of it
+                    continue
+                line, buffer = buffer.strip(), ''
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as e:
+                    logger.error(f'Skipping invalid change feed message in {self.path}: {e}')
+
+    def close(self):
+        self._closed.set()
+
+
+class StompSource:
+    """
+    Reads fcrepo event messages from a STOMP queue or topic (for example,
+    the ActiveMQ broker that fcrepo publishes its JMS messages to),
+    reconnecting if the connection is lost. Requires the `stomp.py` package.
+    """
+    def __init__(self, url: str, reconnect_delay: float = 5.0):
+        """
+        :param url: URL of the form "stomp://[user:password@]host:port/queue/name";
+        use "stomp+ssl" as the scheme to connect using TLS
+        :param reconnect_delay: seconds to wait between connection attempts
+        """
+        if stomp is None:
+            raise OAIRepoInternalException('The stomp.py package is required for a STOMP change feed')
+        parsed = urlparse(url)
+        if not parsed.hostname or not parsed.path.strip('/'):
+            raise OAIRepoInternalException(f'Invalid STOMP change feed URL: {url}')
+        self.host = parsed.hostname
+        self.port = parsed.port or 61613
+        self.destination = parsed.path
+        self.username = unquote(parsed.username) if parsed.username else None
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.use_ssl = parsed.scheme == 'stomp+ssl'
+        self.reconnect_delay = reconnect_delay
+        self._messages: queue.Queue = queue.Queue()
+        self._closed = threading.Event()
+        self._connection = None
+
+    def connect(self):
+        source = self
+
+        class Listener(stomp.ConnectionListener):
+            def on_message(self, frame):
+                source._messages.put(frame.body)
+
+            def on_error(self, frame):
+                logger.error(f'STOMP error: {frame.body}')
+
+        connection = stomp.Connection([(self.host, self.port)])
+        if self.use_ssl:
+            connection.set_ssl(for_hosts=[(self.host, self.port)])
+        connection.set_listener('change-feed', Listener())
+        connection.connect(self.username, self.password, wait=True)
+        connection.subscribe(destination=self.destination, id='oaipmh-change-feed', ack='auto')
+        logger.info(f'Subscribed to {self.destination} on {self.host}:{self.port}')
+        self._connection = connection
+
+    def __iter__(self) -> Iterator[dict[str, Any]]:
+        while not self._closed.is_set():
+            if self._connection is None or not self._connection.is_connected():
+                try:
+                    self.connect()
+                except (OSError, stomp.exception.StompException) as e:
+                    logger.error(f'Unable to connect to STOMP broker {self.host}:{self.port}: {e}')
+                    self._connection = None
+                    self._closed.wait(self.reconnect_delay)
+                    continue
+            try:
+                body = self._messages.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                yield json.loads(body)
+            except json.JSONDecodeError as e:
+                logger.error(f'Skipping invalid change feed message from {self.destination}: {e}')
+
+    def close(self):
+        self._closed.set()
+        if self._connection is not None and self._connection.is_connected():
+            self._connection.disconnect()
+
+
+def get_source(url: str) -> JSONLinesSource | StompSource:
+    """
+    Create the message source for a change feed URL: "stomp://" and
+    "stomp+ssl://" URLs are STOMP destinations, and anything else (a
+    "file://" URL or a plain path) is a JSON lines file.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme in {'stomp', 'stomp+ssl'}:
+        return StompSource(url)
+    if parsed.scheme == 'file':
+        return JSONLinesSource(unquote(parsed.path))
+    return JSONLinesSource(url)
+
+
+@dataclass
+class ChangeFeedStats:
+    events: int = 0
+    invalidated_docs: int = 0
+    rewarmed: int = 0
+    errors: int = 0
+
+
+class ChangeFeedConsumer:
+    """
+    Applies fcrepo change events to the caches in front of Solr and fcrepo,
+    so that they can have long TTLs without serving stale data. For each
+    changed resource, it removes the cached Solr documents, RDF/XML, and
+    metadata records for that resource, and refreshes the set registry in the
+    background when a collection changes. If there is a tombstone store, it
+    also records a tombstone for each deleted record, and removes the
+    tombstone for a record that is changed (i.e., re-created) afterwards.
+
+    Since Solr is typically updated from the same events, each event is
+    applied `CHANGE_FEED_DELAY` seconds after it was received, to give Solr
+    time to index the change first. If `CHANGE_FEED_REWARM` is set, the
+    consumer then re-fetches and re-transforms the resource, so that the
+    next request for it is served from the caches.
+    """
+    delay: float = EnvAttribute('CHANGE_FEED_DELAY', 5)
+    rewarm = EnvAttribute('CHANGE_FEED_REWARM', '')
+
+    def __init__(self, data_provider: DataProvider, source: JSONLinesSource | StompSource):
+        self.data_provider = data_provider
+        self.index = data_provider.index
+        self.source = source
+        self.stats = ChangeFeedStats()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._pending: queue.Queue[Optional[ChangeEvent]] = queue.Queue()
+
+    def apply(self, event: ChangeEvent):
+        """Invalidate, and optionally re-warm, everything cached for the changed resource."""
+        handles = self.index.invalidate_uri(event.uri)
+        self.stats.invalidated_docs += len(handles)
+        for cache in (
+            self.data_provider.resource_cache,
+            self.data_provider.metadata_cache,
+            self.data_provider.record_store,
+        ):
+            if cache is not None:
+                cache.invalidate(event.uri)
+        if event.is_collection:
+            self.index.set_registry.refresh_in_background()
+        if event.tombstone is not None:
+            self.data_provider.add_tombstone(event.tombstone)
+        elif not event.is_delete and self.data_provider.tombstone_store is not None:
+            self.data_provider.tombstone_store.invalidate(event.uri)
+        logger.debug(f'Invalidated {event.uri} (handles {handles})')
+        if self.rewarm and not event.is_delete:
+            self.rewarm_resource(event.uri)
+
+    def rewarm_resource(self, uri: str):
+        """
+        Fetch the Solr document and the RDF/XML for the resource, and store
+        its metadata in each format that applies to it in the metadata cache
+        and the record store, whichever are enabled.
+        """
+        doc = self.index.get_doc_by_uri(uri)
+        if doc is None:
+            return
+        rdf_text = self.data_provider.fetch_rdf(uri)
+        stores = [s for s in (self.data_provider.metadata_cache, self.data_provider.record_store) if s is not None]
+        if not stores:
+            return
+        handle = doc[self.index.handle_field]
+        last_modified = doc[self.index.last_modified_field]
+        rdf = etree.fromstring(rdf_text)
+        for metadata_format in self.data_provider.get_metadata_formats():
+            prefix = metadata_format.metadata_prefix
+            if not self.index.has_format(doc, prefix):
+                continue
+            content = etree.tostring(self.data_provider.transform(prefix, rdf))
+            if self.data_provider.metadata_cache is not None:
+                self.data_provider.metadata_cache.put(uri, prefix, last_modified, content)
+            if self.data_provider.record_store is not None:
+                self.data_provider.record_store.put(handle, prefix, uri, last_modified, content)
+        self.stats.rewarmed += 1
+
+    def get_tombstone(self, event: ChangeEvent) -> Optional[Tombstone]:
+        """
+        Build the tombstone for a deleted resource, if it is a record: that
+        is, if Solr (or the document cache) still has a document for it. The
+        set specs are only known if Solr still has the document.
+        """
+        sets = {}
+        doc = self.index.get_doc_by_uri(event.uri)
+        if doc is not None:
+            sets = self.index.get_sets_for_handles([doc[self.index.handle_field]])
+        else:
+            docs = self.index.doc_cache.find_matching(self.index.uri_field, event.uri)
+            if not docs:
+                return None
+            doc = docs[0]
+        handle = doc[self.index.handle_field]
+        try:
+            deleted = datetime.fromisoformat(event.published) if event.published else None
+        except ValueError:
+            deleted = None
+        if deleted is None:
+            deleted = datetime.now(timezone.utc)
+        elif deleted.tzinfo is not None:
+            deleted = deleted.astimezone(timezone.utc)
+        return Tombstone(
+            handle=handle,
+            uri=event.uri,
+            datestamp=datestamp_long(deleted),
+            setspecs=tuple(sorted(sets.get(handle, {}).keys())),
+        )
+
+    def read(self):
+        """
+        Read events from the source into the pending queue, followed by None
+        when it is exhausted. Deleted records are looked up as soon as their
+        events are received, since Solr usually removes them soon after.
+        """
+        try:
+            for message in self.source:
+                event = ChangeEvent.from_message(message)
+                if event is None:
+                    continue
+                if event.is_delete and self.data_provider.tombstone_store is not None:
+                    try:
+                        event.tombstone = self.get_tombstone(event)
+                    except (OAIRepoExternalException, OAIRepoInternalException) as e:
+                        logger.error(f'Unable to look up deleted resource {event.uri}: {e}')
+                self._pending.put(event)
+        finally:
+            self._pending.put(None)
+
+    def run(self):
+        """
+        Consume the source until it is exhausted or the consumer is stopped.
+        fcrepo sends several events for a single change, so an event is
+        skipped if its resource has already been updated (or, for a deletion,
+        deleted) since the event was received.
+        """
+        threading.Thread(target=self.read, name='change-feed-reader', daemon=True).start()
+        applied: dict[tuple[str, bool], float] = {}
+        while not self._stopped.is_set():
+            if self._pending.empty():
+                # every event received from now on is newer than every update so far
+                applied.clear()
+            event = self._pending.get()
+            if event is None:
+                break
+            self.stats.events += 1
+            wait = event.received + self.delay - time.monotonic()
+            if wait > 0 and self._stopped.wait(wait):
+                break
+            key = (event.uri, event.is_delete)
+            if applied.get(key, 0) > event.received:
+                continue
+            applied[key] = time.monotonic()
+            try:
+                self.apply(event)
+            except (OAIRepoExternalException, OAIRepoInternalException, etree.LxmlError) as e:
+                self.stats.errors += 1
+                logger.error(f'Unable to apply change to {event.uri}: {e}')
+            except Exception as e:
+                # keep consuming, since an unexpected error stops the thread silently otherwise
+                self.stats.errors += 1
+                logger.exception(f'Unexpected error applying change to {event.uri}: {e}')
+
+    def start(self):
+        """Start consuming in a background thread."""
+        self._thread = threading.Thread(target=self.run, name='change-feed', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self.source.close()
+        self._pending.put(None)
+
+
+def start_change_feed(data_provider: DataProvider) -> Optional[ChangeFeedConsumer]:
+    """
+    Start a change feed consumer for the data provider, if `CHANGE_FEED` is set.
+    """
+    url = os.environ.get('CHANGE_FEED')
+    if not url:
+        return None
+    consumer = ChangeFeedConsumer(data_provider, get_source(url))
+    consumer.start()
+    logger.info(f'Consuming changes from {url}')
+    return consumer
@@ -1,49 +1,340 @@
+import atexit
 import logging
+import multiprocessing
 import os
-from dataclasses import MISSING
-from datetime import datetime
-from typing import Optional, Any
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from http import HTTPStatus
+from typing import Optional, Any, Callable, Mapping
 
 from lxml import etree
 # noinspection PyProtectedMember
 from lxml.etree import _Element
 from oai_repo import MetadataFormat, DataInterface, Identify, RecordHeader, Set, OAIRepoExternalException
 from oai_repo.exceptions import OAIErrorCannotDisseminateFormat
-from oai_repo.helpers import granularity_format
-from requests import Session
+from oai_repo.helpers import datestamp_long, granularity_format
+from requests import RequestException
 from requests_jwtauth import HTTPBearerAuth
 
+from oaipmh import tracing
+from oaipmh.cache import CachedResource, MetadataCache, RecordStore, ResourceCache, Tombstone, TombstoneStore
+from oaipmh.config import EnvAttribute
+from oaipmh.fcrepo import FcrepoClient
 from oaipmh.oai import OAIIdentifier
 from oaipmh.solr import Index
-from oaipmh.transformers import load_transformers
+from oaipmh.transformers import (
+    TransformStats, init_transform_worker, load_transformers, transform_serialized,
+)
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# tag of the placeholder element returned as the metadata of a deleted record; see `mark_deleted_records()`
+DELETED_METADATA = '{urn:x-umd-fcrepo-oaipmh:deleted}metadata'
 
-class EnvAttribute:
+
+class Page:
     """
-    Descriptor class that maps an attribute of a class to an environment variable.
+    One page of results from a list request. Holds the Solr documents and
+    set memberships for the page, keyed by handle, so that building the
+    record headers does not need any further Solr requests. The RDF/XML
+    for every resource on the page is fetched concurrently from fcrepo the
+    first time any record's metadata is requested.
+
+    When deleted records are reported, a page also holds the tombstones
+    for the deleted records listed on it, and the handles of all the records
+    on the page, live and deleted, in the order they are listed.
+
+    A page may also be prepared in advance of the request (see
+    `oaipmh.aio`), with the total number of hits, the next cursor mark, and
+    the RDF/XML already retrieved; `list_identifiers()` then uses it as-is.
     """
-    def __init__(self, env_var: str, default: Optional[Any] = MISSING):
-        self.env_var = env_var
-        self.default = default
+    def __init__(
+            self,
+            docs: dict[str, dict[str, Any]],
+            sets: dict[str, dict[str, dict[str, str]]],
+            hits: Optional[int] = None,
+            next_cursor_mark: Optional[str] = None,
+            tombstones: Optional[dict[str, Tombstone]] = None,
+            handles: Optional[list[str]] = None,
+            next_deleted_offset: Optional[int] = None,
+    ):
+        self.docs = docs
+        self.sets = sets
+        self.hits = hits
+        self.next_cursor_mark = next_cursor_mark
+        self.tombstones = tombstones or {}
+        self.handles = handles if handles is not None else list(docs.keys())
+        self.next_deleted_offset = next_deleted_offset
+        self._rdf: Optional[dict[str, Future]] = None
+        self._metadata: Optional[dict[str, Future]] = None
+        self._lock = threading.Lock()
+
+    def __contains__(self, handle: str) -> bool:
+        return handle in self.docs
+
+    def last_modified(self, field: str) -> Optional[datetime]:
+        """Return the latest last modified (or deletion) timestamp of the records on this page."""
+        timestamps = [doc[field] for doc in self.docs.values()]
+        timestamps.extend(tombstone.datestamp for tombstone in self.tombstones.values())
+        return max((datetime.fromisoformat(timestamp) for timestamp in timestamps), default=None)
+
+    def prefetch(
+            self,
+            fetch: Callable[[str], str],
+            executor: ThreadPoolExecutor,
+            get_uris: Callable[[], Mapping[str, str]],
+    ):
+        """
+        Submit a fetch for each of the resources to fetch to the executor,
+        unless the fetches for this page have already been started. The
+        resources to fetch are only determined the first time, since that
+        may mean a cache lookup for every record on the page.
+
+        :param fetch: callable that takes a URI and returns the RDF/XML text
+        :param executor: worker pool to run the fetches in
+        :param get_uris: callable that returns a dictionary mapping handles
+        to the URIs to fetch
+        """
+        with self._lock:
+            if self._rdf is None:
+                self._rdf = {handle: executor.submit(fetch, uri) for handle, uri in get_uris().items()}
+
+    def set_rdf(self, rdf: Mapping[str, str]):
+        """
+        Use already retrieved RDF/XML text for this page, instead of
+        fetching it when the first record's metadata is requested.
+
+        :param rdf: dictionary mapping handles to RDF/XML text
+        """
+        futures = {}
+        for handle, text in rdf.items():
+            futures[handle] = Future()
+            futures[handle].set_result(text)
+        with self._lock:
+            self._rdf = futures
+
+    def get_rdf(self, handle: str) -> Optional[str]:
+        """
+        Return the prefetched RDF/XML text for the given handle, waiting for
+        the fetch to complete if necessary. Returns None if no fetch was
+        submitted for the handle.
+        """
+        future = self._rdf.get(handle) if self._rdf is not None else None
+        return future.result() if future is not None else None
+
+    def prefetch_metadata(self, transform: Callable[[str], Future]):
+        """
+        Submit the transformation of each prefetched resource as soon as its
+        RDF/XML has been retrieved, unless the transformations for this page
+        have already been started. Does nothing if there is no prefetch.
+
+        :param transform: callable that takes RDF/XML text and returns a
+        future for the serialized metadata
+        """
+        with self._lock:
+            if self._metadata is not None or self._rdf is None:
+                return
+            self._metadata = {handle: _chain(future, transform) for handle, future in self._rdf.items()}
+
+    def get_metadata(self, handle: str) -> Optional[bytes]:
+        """
+        Return the serialized metadata for the given handle from the
+        prefetched transformations, waiting for it if necessary. Returns
+        None if no transformation was submitted for the handle.
+        """
+        future = self._metadata.get(handle) if self._metadata is not None else None
+        return future.result() if future is not None else None
+
 
-    def __set_name__(self, owner, name):
-        self.name = name
+def _chain(future: Future, then: Callable[[Any], Future]) -> Future:
+    """
+    Return a future for the result of calling `then` with the result of
+    `future` once it is done. If either step fails, so does the returned
+    future.
+    """
+    chained = Future()
 
-    def __get__(self, instance, owner):
-        if self.default is not MISSING:
-            value = os.environ.get(self.env_var, self.default)
+    def copy_result(f: Future):
+        if f.exception() is not None:
+            chained.set_exception(f.exception())
         else:
-            value = os.environ.get(self.env_var)
+            chained.set_result(f.result())
+
+    def submit_next(f: Future):
+        if f.exception() is not None:
+            chained.set_exception(f.exception())
+            return
+        try:
+            then(f.result()).add_done_callback(copy_result)
+        except Exception as e:
+            chained.set_exception(e)
+
+    future.add_done_callback(submit_next)
+    return chained
+
 
-        # if this attribute has a type annotation, use it to cast the
-        # string value from the environment variable to some other type
-        if getattr(instance, '__annotations__', False) and self.name in instance.__annotations__:
-            return instance.__annotations__[self.name](value)
+def merge_deleted(
+        docs: list[dict[str, Any]],
+        tombstones: list[Tombstone],
+        limit: int,
+        last_modified_field: str,
+) -> list[dict[str, Any] | Tombstone]:
+    """
+    Merge a page of live documents and a page of tombstones, each already
+    in datestamp order, into a single page of at most `limit` records in
+    datestamp order. A live document comes before a tombstone with the
+    same datestamp.
+    """
+    merged = []
+    i = j = 0
+    while len(merged) < limit and (i < len(docs) or j < len(tombstones)):
+        if j == len(tombstones) or (
+            i < len(docs)
+            and datetime.fromisoformat(docs[i][last_modified_field]) <= datetime.fromisoformat(tombstones[j].datestamp)
+        ):
+            merged.append(docs[i])
+            i += 1
+        else:
+            merged.append(tombstones[j])
+            j += 1
+    return merged
+
+
+class ListPaging:
+    """
+    The paging of one page of a ListIdentifiers or ListRecords response:
+    the Solr search for the live records, the merging of those records with
+    the deleted records (when they are reported), and the cursor mark and
+    deleted record offset for the next page. It runs no queries itself, so
+    that `DataProvider.list_identifiers()` and `AsyncDataProvider` (see
+    `oaipmh.aio`) share it, and differ only in how they run them:
+
+    1. get the page of tombstones at `deleted_offset`, if `with_deleted`
+    2. search for the live records with `search_params`
+    3. `merge()` the two
+    4. if `resume_params` is set, search with it, and set `next_cursor_mark`
+       to the cursor mark after its results
+    5. build the `page()`
+    """
+    def __init__(
+            self,
+            index: Index,
+            limit: int,
+            metadataprefix: str,
+            cursor: int,
+            cursor_mark: Optional[str] = None,
+            deleted_offset: int = 0,
+            with_deleted: bool = False,
+    ):
+        """
+        :param index: index to page through
+        :param limit: maximum number of records on a page
+        :param metadataprefix: metadata prefix of the request
+        :param cursor: number of records already listed
+        :param cursor_mark: Solr cursor mark from the request's resumption token
+        :param deleted_offset: number of deleted records already listed, from the request's resumption token
+        :param with_deleted: whether deleted records are merged into the list
+        """
+        self.index = index
+        self.limit = limit
+        self.metadataprefix = metadataprefix
+        self.with_deleted = with_deleted
+        self.deleted_offset = deleted_offset if with_deleted and cursor else 0
+        # the offset into the live records is the cursor minus the number of deleted records already listed
+        self.start = max(cursor - self.deleted_offset, 0)
+        if index.cursor_paging:
+            # fall back to offset paging for tokens without a cursor mark
+            self.cursor_mark = '*' if cursor == 0 else cursor_mark
         else:
-            return value
+            self.cursor_mark = None
+        self.merged: list[dict[str, Any] | Tombstone] = []
+        self.docs: dict[str, dict[str, Any]] = {}
+        self.deleted: dict[str, Tombstone] = {}
+        self.hits = 0
+        self.next_cursor_mark: Optional[str] = None
+        self.resume_params: Optional[dict[str, Any]] = None
+
+    @property
+    def search_params(self) -> dict[str, Any]:
+        """Keyword arguments (besides the filters) for `Index.get_docs()` to search for the live records."""
+        params = {'rows': self.limit, 'metadata_prefix': self.metadataprefix, 'by_datestamp': self.with_deleted}
+        if self.cursor_mark is not None:
+            params['cursor_mark'] = self.cursor_mark
+        else:
+            params['start'] = self.start
+        return params
+
+    def merge(
+            self,
+            docs: list[dict[str, Any]],
+            hits: int,
+            next_cursor_mark: Optional[str],
+            tombstones: list[Tombstone] = (),
+            deleted_hits: int = 0,
+    ):
+        """
+        Merge the results of the search with `search_params` with the page
+        of tombstones in datestamp order (see `merge_deleted()`).
+
+        :param docs: documents of this page of the results only
+        :param hits: total number of live records
+        :param next_cursor_mark: cursor mark after the results, if searching with a cursor mark
+        :param tombstones: page of tombstones starting at `deleted_offset`
+        :param deleted_hits: total number of deleted records
+        """
+        self.merged = merge_deleted(docs, list(tombstones), self.limit, self.index.last_modified_field)
+        self.docs = {doc[self.index.handle_field]: doc for doc in self.merged if not isinstance(doc, Tombstone)}
+        self.deleted = {tombstone.handle: tombstone for tombstone in self.merged if isinstance(tombstone, Tombstone)}
+        self.hits = hits + deleted_hits
+        self.next_cursor_mark = None
+        self.resume_params = None
+        if self.cursor_mark is None:
+            return
+        if len(self.docs) == len(docs):
+            self.next_cursor_mark = next_cursor_mark
+        elif not self.docs:
+            self.next_cursor_mark = self.cursor_mark
+        else:
+            # only some of the documents made it onto the page, so the next
+            # page has to start from the cursor mark after the last of them
+            self.resume_params = {
+                'rows': len(self.docs),
+                'cursor_mark': self.cursor_mark,
+                'fields': [self.index.unique_key_field],
+                'metadata_prefix': self.metadataprefix,
+                'by_datestamp': True,
+            }
+
+    @property
+    def handles(self) -> list[str]:
+        """The handles of all the records on the page, live and deleted, in the order they are listed."""
+        return [item.handle if isinstance(item, Tombstone) else item[self.index.handle_field] for item in self.merged]
+
+    @property
+    def next_deleted_offset(self) -> Optional[int]:
+        """The number of deleted records listed up to the end of the page, if deleted records are merged in."""
+        return self.deleted_offset + len(self.deleted) if self.with_deleted else None
+
+    def page(self, sets: dict[str, dict[str, dict[str, str]]], prepared: bool = False) -> Page:
+        """
+        :param sets: set memberships of the live records on the page
+        :param prepared: whether the page is prepared in advance of the
+        request, and so needs the total number of hits and the position of
+        the next page
+        """
+        if not prepared:
+            return Page(docs=self.docs, sets=sets, tombstones=self.deleted, handles=self.handles)
+        return Page(
+            docs=self.docs,
+            sets=sets,
+            hits=self.hits,
+            next_cursor_mark=self.next_cursor_mark,
+            tombstones=self.deleted,
+            handles=self.handles,
+            next_deleted_offset=self.next_deleted_offset,
+        )
 
 
 class DataProvider(DataInterface):
@@ -55,12 +346,145 @@ class DataProvider(DataInterface):
     oai_namespace_identifier = EnvAttribute('OAI_NAMESPACE_IDENTIFIER')
     report_deleted_records = EnvAttribute('REPORT_DELETED_RECORDS', 'no')
     limit: int = EnvAttribute('PAGE_SIZE', 25)
+    fetch_workers: int = EnvAttribute('FCREPO_FETCH_WORKERS', 8)
+    server_threads: int = EnvAttribute('SERVER_THREADS', 4)
+    metadata_cache_path = EnvAttribute('METADATA_CACHE_PATH', None)
+    metadata_cache_size: int = EnvAttribute('METADATA_CACHE_SIZE', 100000)
+    resource_cache_path = EnvAttribute('RESOURCE_CACHE_PATH', None)
+    resource_cache_size: int = EnvAttribute('RESOURCE_CACHE_SIZE', 100000)
+    transform_processes: int = EnvAttribute('TRANSFORM_PROCESSES', 0)
+    record_store_path = EnvAttribute('RECORD_STORE_PATH', None)
+    tombstone_store_path = EnvAttribute('TOMBSTONE_STORE_PATH', None)
+    deleted_record_retention: float = EnvAttribute('DELETED_RECORD_RETENTION', 30)
 
     def __init__(self, index: Index):
         self.index = index
-        self.session = Session()
+        # every server thread, plus every page prefetch worker, may be making a request at once
+        self.session = FcrepoClient(default_pool_size=self.server_threads + self.fetch_workers)
         self.session.auth = HTTPBearerAuth(os.environ.get('FCREPO_JWT_TOKEN'))
         self._transformers = load_transformers()
+        self._executor = ThreadPoolExecutor(max_workers=self.fetch_workers, thread_name_prefix='fcrepo-fetch')
+        self._local = threading.local()
+        if self.transform_processes > 0:
+            # spawn rather than fork, since this process already has threads running
+            self._process_pool = ProcessPoolExecutor(
+                max_workers=self.transform_processes,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_transform_worker,
+            )
+            # stop the worker processes at exit, if close() has not already
+            atexit.register(self._process_pool.shutdown)
+        else:
+            self._process_pool = None
+        if self.metadata_cache_path:
+            self.metadata_cache = MetadataCache(self.metadata_cache_path, max_size=self.metadata_cache_size)
+        else:
+            self.metadata_cache = None
+        if self.resource_cache_path:
+            self.resource_cache = ResourceCache(self.resource_cache_path, max_size=self.resource_cache_size)
+        else:
+            self.resource_cache = None
+        self.record_store = RecordStore(self.record_store_path) if self.record_store_path else None
+        self.tombstone_store = TombstoneStore(self.tombstone_store_path) if self.tombstone_store_path else None
+        if self.tombstone_store is not None and self.report_deleted_records == 'transient':
+            self.prune_tombstones()
+        if self.report_deleted_records != 'no' and self.tombstone_store is None:
+            logger.warning('REPORT_DELETED_RECORDS is set, but there is no TOMBSTONE_STORE_PATH to report them from')
+
+    @property
+    def page(self) -> Optional[Page]:
+        """The current page of list results for this thread, if any."""
+        return getattr(self._local, 'page', None)
+
+    @property
+    def next_cursor_mark(self) -> Optional[str]:
+        """The Solr cursor mark for the page after the current one, if any."""
+        return getattr(self._local, 'next_cursor_mark', None)
+
+    @property
+    def next_deleted_offset(self) -> Optional[int]:
+        """The number of deleted records listed up to the end of the current page, if any."""
+        return getattr(self._local, 'next_deleted_offset', None)
+
+    @property
+    def deleted_identifiers(self) -> set[str]:
+        """The identifiers of the deleted records whose headers were built for the current request."""
+        if not hasattr(self._local, 'deleted_identifiers'):
+            self._local.deleted_identifiers = set()
+        return self._local.deleted_identifiers
+
+    def begin_request(self, cursor_mark: Optional[str] = None, page: Optional[Page] = None, deleted_offset: int = 0):
+        """
+        Reset the per-request state for this thread.
+
+        :param cursor_mark: Solr cursor mark from the request's resumption token
+        :param page: page of results prepared in advance for the request, if any
+        :param deleted_offset: number of deleted records already listed, from
+        the request's resumption token
+        """
+        self._local.page = page
+        self._local.cursor_mark = cursor_mark
+        self._local.next_cursor_mark = None
+        self._local.deleted_offset = deleted_offset
+        self._local.next_deleted_offset = None
+        self._local.deleted_identifiers = set()
+
+    def end_request(self):
+        """Discard the per-request state for this thread."""
+        self.begin_request()
+
+    def close(self):
+        """Shut down the fetch worker threads and the transformation worker processes."""
+        self._executor.shutdown(wait=False)
+        if self._process_pool is not None:
+            atexit.unregister(self._process_pool.shutdown)
+            self._process_pool.shutdown()
+
+    def get_doc(self, handle: str) -> dict[str, Any]:
+        """
+        Return the Solr document for the given handle, from the current page
+        if it is on it, or from the index otherwise.
+        """
+        page = self.page
+        if page is not None and handle in page:
+            return page.docs[handle]
+        return self.index.get_doc(handle)
+
+    @property
+    def tombstones(self) -> Optional[TombstoneStore]:
+        """The tombstone store, if deleted records are being reported."""
+        if self.report_deleted_records in {'persistent', 'transient'}:
+            return self.tombstone_store
+        return None
+
+    def get_tombstone(self, handle: str) -> Optional[Tombstone]:
+        """
+        Return the tombstone for the given handle if the record has been
+        deleted and deleted records are being reported, from the current
+        page if it is on it, or from the tombstone store otherwise.
+        """
+        page = self.page
+        if page is not None and handle in page.tombstones:
+            return page.tombstones[handle]
+        if self.tombstones is None or (page is not None and handle in page):
+            return None
+        return self.tombstones.get(handle)
+
+    def add_tombstone(self, tombstone: Tombstone):
+        """
+        Record the deletion of a record. When the deleted records are
+        transient, this also removes any expired tombstones.
+        """
+        if self.tombstone_store is None:
+            return
+        self.tombstone_store.put(tombstone)
+        if self.report_deleted_records == 'transient':
+            self.prune_tombstones()
+
+    def prune_tombstones(self):
+        """Remove the tombstones older than `DELETED_RECORD_RETENTION` days."""
+        cutoff = datetime.now(timezone.utc) - timedelta(days=self.deleted_record_retention)
+        self.tombstone_store.prune(datestamp_long(cutoff))
 
     def get_oai_identifier(self, handle: str) -> OAIIdentifier:
         """
@@ -82,7 +506,7 @@ class DataProvider(DataInterface):
         :return: URI string
         """
         handle = OAIIdentifier.parse(identifier).local_identifier
-        return self.index.get_doc(handle)[self.index.uri_field]
+        return self.get_doc(handle)[self.index.uri_field]
 
     def get_last_modified(self, identifier: str) -> datetime:
         """
@@ -92,7 +516,10 @@ class DataProvider(DataInterface):
         :return: datetime object
         """
         handle = OAIIdentifier.parse(identifier).local_identifier
-        last_modified = self.index.get_doc(handle)[self.index.last_modified_field]
+        tombstone = self.get_tombstone(handle)
+        if tombstone is not None:
+            return datetime.fromisoformat(tombstone.datestamp)
+        last_modified = self.get_doc(handle)[self.index.last_modified_field]
         return datetime.fromisoformat(last_modified)
 
     def transform(self, target_format: str, xml_root: _Element) -> _Element:
@@ -113,6 +540,11 @@ class DataProvider(DataInterface):
             raise OAIErrorCannotDisseminateFormat
         return transform(xml_root)
 
+    @property
+    def transform_stats(self) -> dict[str, TransformStats]:
+        """Transformation counts and timings, keyed by metadata prefix."""
+        return {prefix: transformer.stats for prefix, transformer in self._transformers.items()}
+
     def get_identify(self) -> Identify:
         return Identify(
             base_url=self.base_url,
@@ -127,28 +559,201 @@ class DataProvider(DataInterface):
         return identifier.startswith(f'oai:{self.oai_namespace_identifier}:')
 
     def get_metadata_formats(self, identifier: str | None = None) -> list[MetadataFormat]:
-        return [transformer.metadata_format for transformer in self._transformers.values()]
+        """
+        Return the metadata formats for the repository, or for a single
+        record. The formats for a record are decided by the format rules in
+        the index configuration, using the record's Solr document, so this
+        never needs to retrieve the record from fcrepo.
+        """
+        formats = [transformer.metadata_format for transformer in self._transformers.values()]
+        if identifier is None or not self.index.format_rules:
+            return formats
+        handle = OAIIdentifier.parse(identifier).local_identifier
+        if self.get_tombstone(handle) is not None:
+            # there is no document left to decide the formats by
+            return formats
+        doc = self.get_doc(handle)
+        return [f for f in formats if self.index.has_format(doc, f.metadata_prefix)]
 
     def get_record_header(self, identifier: str) -> RecordHeader:
+        handle = OAIIdentifier.parse(identifier).local_identifier
+        tombstone = self.get_tombstone(handle)
+        if tombstone is not None:
+            # oai_repo does not add the status to the header, so it is added afterwards
+            self.deleted_identifiers.add(identifier)
+            return RecordHeader(
+                identifier=identifier,
+                datestamp=granularity_format(self.datestamp_granularity, datetime.fromisoformat(tombstone.datestamp)),
+                setspecs=list(tombstone.setspecs),
+                status='deleted',
+            )
         last_modified = self.get_last_modified(identifier)
-        oai_id = OAIIdentifier.parse(identifier)
-        handle = oai_id.local_identifier
+        page = self.page
+        if page is not None and handle in page:
+            setspecs = page.sets[handle]
+        else:
+            setspecs = self.index.get_sets_for_handle(handle)
         return RecordHeader(
             identifier=identifier,
             datestamp=granularity_format(self.datestamp_granularity, last_modified),
-            setspecs=self.index.get_sets_for_handle(handle),
+            setspecs=setspecs,
         )
 
-    def get_record_metadata(self, identifier: str, metadataprefix: str) -> _Element | None:
-        uri = self.get_uri(identifier)
-        response = self.session.get(uri, headers={'Accept': 'application/rdf+xml'})
+    def fetch_rdf(self, uri: str) -> str:
+        """
+        Retrieve the RDF/XML serialization of a resource from fcrepo. If the
+        resource cache is enabled and has a copy of the resource, this makes
+        a conditional request using the cached validators, and returns the
+        cached copy if fcrepo responds with "304 Not Modified".
+
+        :param uri: URI of the fcrepo resource
+        :return: RDF/XML text
+        :raises OAIRepoExternalException: if the resource could not be retrieved
+        """
+        cached = self.resource_cache.get(uri) if self.resource_cache is not None else None
+        try:
+            response = self.session.get(uri, headers=self.get_rdf_request_headers(cached))
+        except RequestException as e:
+            logger.error(f'GET {uri} -> {e}')
+            raise OAIRepoExternalException('Unable to retrieve resource from fcrepo') from e
+        if cached is not None and response.status_code == HTTPStatus.NOT_MODIFIED:
+            self.resource_cache.touch(uri)
+            return cached.content
         if response.ok:
-            rdf_xml = etree.fromstring(response.text)
-            return self.transform(metadataprefix, rdf_xml)
+            self.store_rdf(uri, response)
+            return response.text
         else:
             logger.error(f'GET {uri} -> {response.status_code} {response.reason}')
             raise OAIRepoExternalException('Unable to retrieve resource from fcrepo')
 
+    @staticmethod
+    def get_rdf_request_headers(cached: Optional[CachedResource]) -> dict[str, str]:
+        """
+        Return the headers for a request for the RDF/XML serialization of a
+        resource, including the conditional request headers if there is a
+        cached copy of it.
+        """
+        headers = {'Accept': 'application/rdf+xml'}
+        if cached is not None:
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+        return headers
+
+    def store_rdf(self, uri: str, response):
+        """
+        Store a successful response for the RDF/XML serialization of a
+        resource in the resource cache, if it is enabled and the response
+        has validators to revalidate it with.
+
+        :param uri: URI of the fcrepo resource
+        :param response: response object with `headers` and `text` attributes
+        """
+        if self.resource_cache is not None:
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            if etag or last_modified:
+                self.resource_cache.put(uri, etag, last_modified, response.text)
+
+    def get_record_metadata(self, identifier: str, metadataprefix: str) -> _Element | None:
+        handle = OAIIdentifier.parse(identifier).local_identifier
+        if self.get_tombstone(handle) is not None:
+            return etree.Element(DELETED_METADATA)
+        doc = self.get_doc(handle)
+        uri = doc[self.index.uri_field]
+        if self.record_store is not None:
+            content = self.record_store.get(handle, metadataprefix, doc[self.index.last_modified_field])
+            if content is not None:
+                return etree.fromstring(content)
+        if self.metadata_cache is not None:
+            last_modified = doc[self.index.last_modified_field]
+            content = self.metadata_cache.get(uri, metadataprefix, last_modified)
+            if content is not None:
+                return etree.fromstring(content)
+
+        rdf_text = None
+        content = None
+        page = self.page
+        if page is not None and handle in page:
+            page.prefetch(
+                tracing.propagate(self.fetch_rdf),
+                self._executor,
+                lambda: self._get_uncached_uris(page.docs, metadataprefix),
+            )
+            if self._process_pool is not None and metadataprefix in self._transformers:
+                parent_span = tracing.current_span()
+                page.prefetch_metadata(lambda text: self._submit_transform(metadataprefix, text, parent_span))
+                content = page.get_metadata(handle)
+            if content is None:
+                rdf_text = page.get_rdf(handle)
+
+        if content is not None:
+            metadata = etree.fromstring(content)
+        else:
+            if rdf_text is None:
+                rdf_text = self.fetch_rdf(uri)
+            metadata = self.transform(metadataprefix, etree.fromstring(rdf_text))
+            content = etree.tostring(metadata) if self.metadata_cache is not None else None
+
+        if self.metadata_cache is not None:
+            self.metadata_cache.put(uri, metadataprefix, last_modified, content)
+        return metadata
+
+    def _submit_transform(
+            self,
+            metadataprefix: str,
+            rdf_text: str,
+            parent_span: Optional[tracing.Span] = None,
+    ) -> Future:
+        """
+        Submit a transformation to the process pool, and return a future for
+        the serialized metadata. The transformation time is added to the
+        statistics for the format, and recorded as a child of `parent_span`,
+        if given.
+        """
+        stats = self._transformers[metadataprefix].stats
+        result = Future()
+
+        def record(f: Future):
+            if f.cancelled():
+                result.cancel()
+                return
+            if f.exception() is not None:
+                result.set_exception(f.exception())
+                return
+            content, elapsed = f.result()
+            # resolve the result first, so that a failure to record the
+            # statistics cannot leave the request waiting for it forever
+            result.set_result(content)
+            try:
+                stats.record(elapsed)
+                tracing.record_span(parent_span, f'xslt {metadataprefix}', elapsed, **{'oaipmh.process_pool': True})
+            except Exception as e:
+                logger.warning(f'Unable to record {metadataprefix} transformation statistics: {e}')
+
+        future = self._process_pool.submit(transform_serialized, metadataprefix, rdf_text.encode('utf-8'))
+        future.add_done_callback(record)
+        return result
+
+    def _get_uncached_uris(self, docs: Mapping[str, dict[str, Any]], metadataprefix: str) -> dict[str, str]:
+        """
+        Return a dictionary mapping handles to URIs for the documents whose
+        metadata in the given format is in neither the record store nor the
+        metadata cache.
+        """
+        uri_field, last_modified_field = self.index.uri_field, self.index.last_modified_field
+        return {
+            handle: doc[uri_field] for handle, doc in docs.items()
+            if (
+                self.record_store is None
+                or not self.record_store.contains(handle, metadataprefix, doc[last_modified_field])
+            ) and (
+                self.metadata_cache is None
+                or not self.metadata_cache.contains(doc[uri_field], metadataprefix, doc[last_modified_field])
+            )
+        }
+
     def get_record_abouts(self, identifier: str) -> list[_Element]:
         return []
 
@@ -180,6 +785,55 @@ class DataProvider(DataInterface):
             f'filter_set={filter_set}, '
             f'cursor={cursor})'
         )
-        results = self.index.get_docs(filter_from, filter_until, filter_set, start=cursor, rows=self.limit)
-        identifiers = [str(self.get_oai_identifier(doc[self.index.handle_field])) for doc in results]
-        return identifiers, results.hits, None
+        page = self.page
+        if page is not None and page.hits is not None:
+            # the page was prepared in advance for this request
+            self._local.next_cursor_mark = page.next_cursor_mark
+            self._local.next_deleted_offset = page.next_deleted_offset
+            identifiers = [str(self.get_oai_identifier(handle)) for handle in page.handles]
+            return identifiers, page.hits, None
+
+        # when deleted records are reported, the live records from Solr are merged
+        # with the deleted records from the tombstone store, in datestamp order
+        paging = ListPaging(
+            self.index, self.limit, metadataprefix, cursor,
+            cursor_mark=getattr(self._local, 'cursor_mark', None),
+            deleted_offset=getattr(self._local, 'deleted_offset', 0),
+            with_deleted=self.tombstones is not None,
+        )
+        filters = (filter_from, filter_until, filter_set)
+        if paging.with_deleted:
+            tombstones, deleted_hits = self.get_deleted(*filters, offset=paging.deleted_offset)
+        else:
+            tombstones, deleted_hits = [], 0
+        results = self.index.get_docs(*filters, **paging.search_params)
+        # iterating over pysolr results follows the cursor mark through every
+        # remaining page, so use only the documents of this page
+        paging.merge(results.docs, results.hits, results.nextCursorMark, tombstones, deleted_hits)
+        if paging.resume_params is not None:
+            paging.next_cursor_mark = self.index.get_docs(*filters, **paging.resume_params).nextCursorMark
+        self._local.next_cursor_mark = paging.next_cursor_mark
+        self._local.next_deleted_offset = paging.next_deleted_offset
+        # keep the documents for this page, so that the record headers and
+        # metadata can be built without going back to Solr for each record
+        self._local.page = paging.page(sets=self.index.get_sets_for_handles(list(paging.docs.keys())))
+        identifiers = [str(self.get_oai_identifier(handle)) for handle in paging.handles]
+        return identifiers, paging.hits, None
+
+    def get_deleted(
+            self,
+            filter_from: Optional[datetime],
+            filter_until: Optional[datetime],
+            filter_set: Optional[str],
+            offset: int,
+    ) -> tuple[list[Tombstone], int]:
+        """
+        Return a page of tombstones matching the filters, starting at the
+        given offset, and the total number of matching tombstones.
+        """
+        filters = (
+            datestamp_long(filter_from) if filter_from else None,
+            datestamp_long(filter_until) if filter_until else None,
+            filter_set,
+        )
+        return self.tombstones.find(*filters, offset=offset, limit=self.limit), self.tombstones.count(*filters)
@@ -0,0 +1,101 @@
+import logging
+import threading
+import time
+from collections import Counter
+from typing import Callable, Optional
+
+from requests import Session, Response, RequestException
+from requests.adapters import HTTPAdapter
+from urllib3 import Retry
+
+from oaipmh import tracing
+from oaipmh.config import EnvAttribute
+
+logger = logging.getLogger(__name__)
+
+
+class RequestStats:
+    """
+    Thread-safe running totals of the number, latency, and status codes of
+    HTTP requests. Each listener is also called with the latency and status
+    code of every request.
+    """
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.status_codes = Counter()
+        self.listeners: list[Callable[[float, Optional[int]], None]] = []
+        self._lock = threading.Lock()
+
+    def record(self, elapsed: float, status_code: Optional[int]):
+        """
+        :param elapsed: request latency, in seconds
+        :param status_code: HTTP status code, or None if no response was received
+        """
+        with self._lock:
+            self.count += 1
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+            self.status_codes[status_code] += 1
+        for listener in self.listeners:
+            listener(elapsed, status_code)
+
+    @property
+    def mean_time(self) -> float:
+        return self.total_time / self.count if self.count else 0.0
+
+
+class FcrepoClient(Session):
+    """
+    HTTP session for requests to fcrepo. It is shared by all the server's
+    threads. Its connection pool is sized for the number of concurrent
+    requests (with connections kept alive between requests). Every request
+    has connect and read timeouts. Connection errors and 5xx responses are
+    retried with exponential backoff.
+    """
+    pool_size = EnvAttribute('FCREPO_POOL_SIZE', None)
+    connect_timeout: float = EnvAttribute('FCREPO_CONNECT_TIMEOUT', 5)
+    read_timeout: float = EnvAttribute('FCREPO_READ_TIMEOUT', 60)
+    retries: int = EnvAttribute('FCREPO_RETRIES', 3)
+    retry_backoff: float = EnvAttribute('FCREPO_RETRY_BACKOFF', 0.5)
+
+    def __init__(self, default_pool_size: int = 10):
+        """
+        :param default_pool_size: maximum number of pooled connections to
+        keep per host, if `FCREPO_POOL_SIZE` is not set
+        """
+        super().__init__()
+        pool_size = int(self.pool_size) if self.pool_size else default_pool_size
+        retry = Retry(
+            total=self.retries,
+            backoff_factor=self.retry_backoff,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods={'GET', 'HEAD'},
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_maxsize=pool_size, pool_block=False, max_retries=retry)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self.stats = RequestStats()
+        logger.info(
+            f'fcrepo client: pool size {pool_size}, timeouts {self.connect_timeout}s/{self.read_timeout}s, '
+            f'{self.retries} retries'
+        )
+
+    def request(self, method: str, url: str, *args, **kwargs) -> Response:
+        kwargs.setdefault('timeout', (self.connect_timeout, self.read_timeout))
+        attributes = {'http.method': method, 'http.url': url}
+        with tracing.span(f'fcrepo {method}', kind=tracing.SPAN_KIND_CLIENT, **attributes) as span:
+            start = time.perf_counter()
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except RequestException:
+                self.stats.record(time.perf_counter() - start, None)
+                raise
+            elapsed = time.perf_counter() - start
+            self.stats.record(elapsed, response.status_code)
+            if span is not None:
+                span.set_attribute('http.status_code', response.status_code)
+        logger.debug(f'{method} {url} -> {response.status_code} ({elapsed:.3f}s)')
+        return response
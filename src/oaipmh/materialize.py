@@ -0,0 +1,212 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Iterator, Optional
+
+import click
+import pysolr
+from dotenv import load_dotenv
+from lxml import etree
+from oai_repo import OAIRepoExternalException, OAIRepoInternalException
+
+from oaipmh import __version__
+from oaipmh.dataprovider import DataProvider
+from oaipmh.solr import Index
+from oaipmh.web import get_config
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class MaterializeStats:
+    docs: int = 0
+    stored: int = 0
+    skipped: int = 0
+    excluded: int = 0
+    failed: int = 0
+
+
+class Materializer:
+    """
+    Walks the Solr index in last modified order, and stores the metadata
+    for every record, in every format that it is available in, in the data
+    provider's record store. Records that are already stored with their
+    current last modified timestamp are skipped, and formats that the format
+    rules do not allow for a record are counted as excluded. After each batch, the
+    last modified timestamp of the batch's last document is saved as the
+    checkpoint to resume from, unless a record has failed, in which case the
+    checkpoint stays before the failed record so that it is retried.
+    """
+    def __init__(
+            self,
+            data_provider: DataProvider,
+            prefixes: Optional[list[str]] = None,
+            batch_size: int = 100,
+            workers: int = 4,
+    ):
+        """
+        :param data_provider: data provider with a record store
+        :param prefixes: metadata prefixes to materialize; defaults to all formats
+        :param batch_size: number of Solr documents to retrieve at a time
+        :param workers: number of records to retrieve and transform concurrently
+        """
+        if data_provider.record_store is None:
+            raise OAIRepoInternalException('RECORD_STORE_PATH is not set')
+        self.data_provider = data_provider
+        self.index: Index = data_provider.index
+        self.store = data_provider.record_store
+        self.prefixes = prefixes or [f.metadata_prefix for f in data_provider.get_metadata_formats()]
+        self.batch_size = batch_size
+        self.workers = workers
+
+    def get_batches(self, since: Optional[str] = None) -> Iterator[list[dict[str, Any]]]:
+        """
+        Yield batches of Solr documents modified since the given timestamp
+        (inclusive), in last modified order, using a Solr cursor.
+        """
+        filter_from = datetime.fromisoformat(since) if since else None
+        cursor_mark = '*'
+        while True:
+            query = self.index.get_docs_query(
+                filter_from, rows=self.batch_size, cursor_mark=cursor_mark, by_datestamp=True
+            )
+            results = self.index.search(query_name='get_docs', **query)
+            if not results.docs:
+                return
+            yield results.docs
+            if results.nextCursorMark == cursor_mark:
+                return
+            cursor_mark = results.nextCursorMark
+
+    def materialize(self, doc: dict[str, Any]) -> tuple[int, int, int]:
+        """
+        Store the record for a document in every format that is missing or
+        out of date in the record store.
+
+        :return: tuple of the number of records stored, the number skipped
+        because they are up to date, and the number of formats excluded by
+        the format rules
+        :raises OAIRepoExternalException: if the resource could not be retrieved
+        """
+        handle = doc[self.index.handle_field]
+        uri = doc[self.index.uri_field]
+        last_modified = doc[self.index.last_modified_field]
+        allowed = [prefix for prefix in self.prefixes if self.index.has_format(doc, prefix)]
+        prefixes = [prefix for prefix in allowed if not self.store.contains(handle, prefix, last_modified)]
+        skipped = len(allowed) - len(prefixes)
+        excluded = len(self.prefixes) - len(allowed)
+        if not prefixes:
+            return 0, skipped, excluded
+        rdf = etree.fromstring(self.data_provider.fetch_rdf(uri))
+        for prefix in prefixes:
+            metadata = self.data_provider.transform(prefix, rdf)
+            self.store.put(handle, prefix, uri, last_modified, etree.tostring(metadata))
+        return len(prefixes), skipped, excluded
+
+    def run(self, since: Optional[str] = None) -> MaterializeStats:
+        """
+        Materialize every record modified since the given timestamp.
+
+        :param since: last modified timestamp to start from; defaults to the
+        store's checkpoint, or the beginning of the index if there is none
+        """
+        if since is None:
+            since = self.store.get_checkpoint()
+        logger.info(f'Materializing records modified since {since or "the beginning"}')
+        stats = MaterializeStats()
+        first_failure = None
+
+        def materialize(doc: dict[str, Any]) -> Optional[tuple[int, int, int]]:
+            try:
+                return self.materialize(doc)
+            except (OAIRepoExternalException, etree.LxmlError) as e:
+                logger.error(f'Unable to materialize {doc.get(self.index.handle_field)}: {e}')
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='materialize') as executor:
+            for batch in self.get_batches(since):
+                for doc, result in zip(batch, executor.map(materialize, batch)):
+                    stats.docs += 1
+                    if result is None:
+                        stats.failed += 1
+                        if first_failure is None:
+                            first_failure = doc[self.index.last_modified_field]
+                    else:
+                        stats.stored += result[0]
+                        stats.skipped += result[1]
+                        stats.excluded += result[2]
+                checkpoint = first_failure or batch[-1][self.index.last_modified_field]
+                self.store.set_checkpoint(checkpoint)
+                logger.info(
+                    f'{stats.docs} documents: {stats.stored} records stored, {stats.skipped} up to date, '
+                    f'{stats.excluded} excluded by format rules, {stats.failed} failed (checkpoint {checkpoint})'
+                )
+        return stats
+
+
+@click.command()
+@click.option(
+    '--solr-config', 'solr_config_file',
+    type=click.File(),
+    help='Configuration file for the Solr index.',
+)
+@click.option(
+    '--since',
+    help='Last modified timestamp to start from. Defaults to the checkpoint saved by the previous run.',
+    metavar='TIMESTAMP',
+)
+@click.option(
+    '--full',
+    is_flag=True,
+    help='Start from the beginning of the index, ignoring the saved checkpoint.',
+)
+@click.option(
+    '--prefix', 'prefixes',
+    multiple=True,
+    help='Metadata prefix to materialize. May be repeated. Defaults to all formats.',
+)
+@click.option(
+    '--batch-size',
+    type=int,
+    default=100,
+    help='Number of Solr documents to retrieve at a time. Default is 100.',
+)
+@click.option(
+    '--workers',
+    type=int,
+    default=4,
+    help='Number of records to retrieve and transform concurrently. Default is 4.',
+)
+@click.option(
+    '--interval',
+    type=float,
+    default=0,
+    help='Keep running, checking for changed records this many seconds after each run finishes. '
+         'Default is 0, which runs once.',
+)
+@click.version_option(__version__, '--version', '-V')
+@click.help_option('--help', '-h')
+def main(solr_config_file, since, full, prefixes, batch_size, workers, interval):
+    try:
+        index = Index(config=get_config(solr_config_file), solr_client=pysolr.Solr(os.environ['SOLR_URL']))
+        materializer = Materializer(
+            data_provider=DataProvider(index=index),
+            prefixes=list(prefixes),
+            batch_size=batch_size,
+            workers=workers,
+        )
+        while True:
+            stats = materializer.run(since='' if full else since)
+            logger.info(f'Finished: {stats}')
+            if not interval:
+                break
+            # later runs always resume from the checkpoint
+            since, full = None, False
+            time.sleep(interval)
+    except (KeyError, OSError, OAIRepoExternalException, OAIRepoInternalException) as e:
+        logger.error(f'Exiting: {e}')
+        raise SystemExit(1) from e
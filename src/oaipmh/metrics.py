@@ -0,0 +1,206 @@
+import logging
+import os
+import time
+from collections.abc import MutableMapping
+from functools import partial
+from typing import Iterator, Optional
+
+from flask import Flask, Response, g, request
+from oai_repo import OAIRepoInternalException
+
+from oaipmh.dataprovider import DataProvider
+from oaipmh.oai import decode_resumption_token
+
+try:
+    from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, Metric
+except ImportError:
+    # only needed when metrics are enabled
+    CollectorRegistry = None
+
+logger = logging.getLogger(__name__)
+
+OAI_VERBS = {'GetRecord', 'Identify', 'ListIdentifiers', 'ListMetadataFormats', 'ListRecords', 'ListSets'}
+
+
+class CacheCollector:
+    """
+    Reports the hit and miss counts, and the hit ratio, of each of the data
+    provider's caches at the time of collection.
+    """
+    def __init__(self, data_provider: DataProvider):
+        self.data_provider = data_provider
+
+    def get_caches(self) -> dict[str, object]:
+        caches = {
+            'documents': self.data_provider.index.doc_cache,
+            'metadata': self.data_provider.metadata_cache,
+            'resources': self.data_provider.resource_cache,
+            'records': self.data_provider.record_store,
+        }
+        return {name: cache for name, cache in caches.items() if cache is not None}
+
+    def collect(self) -> Iterator['Metric']:
+        hits = CounterMetricFamily('oaipmh_cache_hits', 'Number of cache hits.', labels=['cache'])
+        misses = CounterMetricFamily('oaipmh_cache_misses', 'Number of cache misses.', labels=['cache'])
+        ratio = GaugeMetricFamily(
+            'oaipmh_cache_hit_ratio', 'Fraction of cache lookups that were hits.', labels=['cache']
+        )
+        for name, cache in self.get_caches().items():
+            hits.add_metric([name], cache.hits)
+            misses.add_metric([name], cache.misses)
+            lookups = cache.hits + cache.misses
+            ratio.add_metric([name], cache.hits / lookups if lookups else 0.0)
+        yield hits
+        yield misses
+        yield ratio
+
+
+class Metrics:
+    """
+    Prometheus metrics for the OAI-PMH server: request counts, latencies,
+    and in-flight requests per verb and metadata prefix; Solr query counts
+    and latencies per `Index` method; fcrepo request latencies and status
+    codes; transformation times per metadata format; and cache hit ratios.
+    The upstream metrics are observed through the listeners on the data
+    provider's statistics objects, so they cover both the WSGI and the
+    ASGI servers.
+    """
+    def __init__(self, data_provider: DataProvider, registry: Optional['CollectorRegistry'] = None):
+        """
+        :param data_provider: data provider to observe
+        :param registry: registry to add the metrics to; defaults to a new registry
+        :raises OAIRepoInternalException: if prometheus-client is not installed
+        """
+        if CollectorRegistry is None:
+            raise OAIRepoInternalException('Metrics require the prometheus-client package')
+        self.registry = registry or CollectorRegistry()
+        self.prefixes = set(data_provider.transform_stats)
+        self.requests = Counter(
+            'oaipmh_requests', 'Number of OAI-PMH requests.',
+            ['verb', 'metadata_prefix', 'status'], registry=self.registry,
+        )
+        self.request_duration = Histogram(
+            'oaipmh_request_duration_seconds', 'Time to process an OAI-PMH request.',
+            ['verb', 'metadata_prefix'], registry=self.registry,
+        )
+        self.requests_in_progress = Gauge(
+            'oaipmh_requests_in_progress', 'Number of OAI-PMH requests being processed.',
+            ['verb'], registry=self.registry,
+        )
+        self.solr_query_duration = Histogram(
+            'oaipmh_solr_query_duration_seconds', 'Time to run a Solr query.',
+            ['method'], registry=self.registry,
+        )
+        self.solr_query_errors = Counter(
+            'oaipmh_solr_query_errors', 'Number of failed Solr queries.',
+            ['method'], registry=self.registry,
+        )
+        self.fcrepo_request_duration = Histogram(
+            'oaipmh_fcrepo_request_duration_seconds', 'Time to make a request to fcrepo.',
+            registry=self.registry,
+        )
+        self.fcrepo_responses = Counter(
+            'oaipmh_fcrepo_responses', 'Number of fcrepo requests, by response status code.',
+            ['status'], registry=self.registry,
+        )
+        self.transform_duration = Histogram(
+            'oaipmh_transform_duration_seconds', 'Time to transform a record to a metadata format.',
+            ['format'], registry=self.registry,
+        )
+        self.transform_errors = Counter(
+            'oaipmh_transform_errors', 'Number of failed transformations.',
+            ['format'], registry=self.registry,
+        )
+        self.registry.register(CacheCollector(data_provider))
+
+        data_provider.index.query_listeners.append(self.observe_query)
+        data_provider.session.stats.listeners.append(self.observe_fcrepo_request)
+        for prefix, stats in data_provider.transform_stats.items():
+            stats.listeners.append(partial(self.observe_transform, prefix))
+
+    def observe_query(self, method: str, elapsed: float, error: bool):
+        self.solr_query_duration.labels(method).observe(elapsed)
+        if error:
+            self.solr_query_errors.labels(method).inc()
+
+    def observe_fcrepo_request(self, elapsed: float, status_code: Optional[int]):
+        self.fcrepo_request_duration.observe(elapsed)
+        self.fcrepo_responses.labels(str(status_code) if status_code is not None else 'none').inc()
+
+    def observe_transform(self, prefix: str, elapsed: float, error: bool):
+        self.transform_duration.labels(prefix).observe(elapsed)
+        if error:
+            self.transform_errors.labels(prefix).inc()
+
+    def get_labels(self, args: MutableMapping[str, str]) -> tuple[str, str]:
+        """
+        Get the verb and metadata prefix labels for a request. Unknown verbs
+        and metadata prefixes are reported as "unknown" and "" respectively,
+        so that arbitrary request arguments cannot create new time series.
+        The metadata prefix of a request with a resumption token is taken from
+        the token.
+        """
+        verb = args.get('verb')
+        if verb not in OAI_VERBS:
+            verb = 'unknown'
+        prefix = args.get('metadataPrefix')
+        if prefix is None and 'resumptionToken' in args:
+            try:
+                prefix = decode_resumption_token(args['resumptionToken']).get('metadataPrefix')
+            except ValueError:
+                prefix = None
+        if prefix not in self.prefixes:
+            prefix = ''
+        return verb, prefix
+
+    def begin_request(self, args: MutableMapping[str, str]):
+        g.oaipmh_metrics = (self.get_labels(args), time.perf_counter())
+        self.requests_in_progress.labels(g.oaipmh_metrics[0][0]).inc()
+
+    def end_request(self, status_code: int):
+        (verb, prefix), start = g.oaipmh_metrics
+        self.request_duration.labels(verb, prefix).observe(time.perf_counter() - start)
+        self.requests.labels(verb, prefix, str(status_code)).inc()
+
+    def teardown_request(self):
+        labels = g.pop('oaipmh_metrics', None)
+        if labels is not None:
+            self.requests_in_progress.labels(labels[0][0]).dec()
+
+    def generate(self) -> bytes:
+        return generate_latest(self.registry)
+
+
+def init_metrics(app: Flask, data_provider: DataProvider) -> Optional[Metrics]:
+    """
+    If `METRICS` is set, add a `/metrics` endpoint to the app for
+    Prometheus, and record the request metrics for the OAI-PMH endpoint.
+    The duration of a streamed response is the time until its body
+    starts being sent.
+    """
+    if not os.environ.get('METRICS'):
+        return None
+    metrics = Metrics(data_provider)
+
+    @app.before_request
+    def begin_request():
+        if request.endpoint == 'endpoint':
+            metrics.begin_request(request.args)
+
+    @app.after_request
+    def end_request(response: Response) -> Response:
+        if 'oaipmh_metrics' in g:
+            metrics.end_request(response.status_code)
+        return response
+
+    @app.teardown_request
+    def teardown_request(_exc: Optional[BaseException]):
+        metrics.teardown_request()
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        return Response(metrics.generate(), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+    logger.info('Serving metrics at /metrics')
+    return metrics
@@ -1,5 +1,18 @@
+import base64
+import binascii
 import re
 import urllib.parse
+from typing import Collection, MutableMapping, Optional
+
+from lxml import etree
+# noinspection PyProtectedMember
+from lxml.etree import _Element
+
+# key in the resumption token that holds the Solr cursor mark
+CURSOR_MARK_KEY = 'm'
+
+# key in the resumption token that holds the number of deleted records already listed
+DELETED_OFFSET_KEY = 'd'
 
 
 def get_set_spec(name: str) -> str:
@@ -23,3 +36,107 @@ class OAIIdentifier:
 
     def __str__(self):
         return f'oai:{self.namespace_identifier}:{urllib.parse.quote(self.local_identifier)}'
+
+
+def decode_resumption_token(token: str) -> dict[str, str]:
+    """
+    Decode a resumption token in the format used by oai_repo (a Base64-encoded
+    URL query string) into a dictionary.
+
+    :raises ValueError: if the token cannot be decoded
+    """
+    try:
+        query = base64.b64decode(token, validate=True).decode('utf8')
+    except (binascii.Error, UnicodeDecodeError) as e:
+        raise ValueError(f'Invalid resumption token: {token}') from e
+    return dict(urllib.parse.parse_qsl(query))
+
+
+def encode_resumption_token(args: dict[str, str]) -> str:
+    """Encode a dictionary as a resumption token in the format used by oai_repo."""
+    return base64.b64encode(urllib.parse.urlencode(args).encode('utf8')).decode('ascii')
+
+
+def pop_token_value(args: MutableMapping[str, str], key: str) -> Optional[str]:
+    """
+    Remove the value with the given key (if any) from the resumption token
+    in the given request arguments, and return it. The resumption token in
+    the arguments is replaced with one that does not contain the value. If
+    there is no resumption token, or it cannot be decoded, the arguments
+    are left as-is and this returns None.
+    """
+    if 'resumptionToken' not in args:
+        return None
+    try:
+        token_args = decode_resumption_token(args['resumptionToken'])
+    except ValueError:
+        return None
+    value = token_args.pop(key, None)
+    if value is not None:
+        args['resumptionToken'] = encode_resumption_token(token_args)
+    return value
+
+
+def add_token_value(root: _Element, key: str, value: Optional[str]):
+    """
+    Add a value to the resumption token (if any) in the given OAI-PMH
+    response document. Does nothing if the value is None.
+    """
+    if value is None:
+        return
+    for token_element in root.iter('{*}resumptionToken'):
+        if token_element.text:
+            token_args = decode_resumption_token(token_element.text)
+            token_args[key] = value
+            token_element.text = encode_resumption_token(token_args)
+
+
+def pop_cursor_mark(args: MutableMapping[str, str]) -> Optional[str]:
+    """Remove the Solr cursor mark (if any) from the resumption token in the given request arguments."""
+    return pop_token_value(args, CURSOR_MARK_KEY)
+
+
+def add_cursor_mark(root: _Element, cursor_mark: Optional[str]):
+    """
+    Add the Solr cursor mark to the resumption token (if any) in the given
+    OAI-PMH response document.
+    """
+    add_token_value(root, CURSOR_MARK_KEY, cursor_mark)
+
+
+def pop_deleted_offset(args: MutableMapping[str, str]) -> int:
+    """
+    Remove the number of deleted records already listed (if any) from the
+    resumption token in the given request arguments, and return it.
+    """
+    value = pop_token_value(args, DELETED_OFFSET_KEY)
+    try:
+        return int(value) if value is not None else 0
+    except ValueError:
+        return 0
+
+
+def add_deleted_offset(root: _Element, offset: int):
+    """
+    Add the number of deleted records listed so far to the resumption token
+    (if any) in the given OAI-PMH response document, unless it is 0.
+    """
+    add_token_value(root, DELETED_OFFSET_KEY, str(offset) if offset else None)
+
+
+def mark_deleted_records(root: _Element, identifiers: Collection[str]):
+    """
+    Mark the headers for the given identifiers in the OAI-PMH response
+    document as deleted, and remove the metadata and about elements from
+    their records, as required for deleted records.
+    """
+    if not identifiers:
+        return
+    for header in list(root.iter('{*}header')):
+        identifier = header.find('{*}identifier')
+        if identifier is None or identifier.text not in identifiers:
+            continue
+        header.set('status', 'deleted')
+        for sibling in list(header.itersiblings()):
+            if etree.QName(sibling).localname in {'metadata', 'about'}:
+                header.getparent().remove(sibling)
@@ -1,4 +1,5 @@
 import logging
+import os
 
 import click
 from dotenv import load_dotenv
@@ -18,6 +19,13 @@ logger = logging.getLogger(__name__)
     help='Address and port to listen on. Default is "0.0.0.0:5000".',
     metavar='[ADDRESS]:PORT',
 )
+@click.option(
+    '--threads',
+    type=int,
+    default=4,
+    envvar='SERVER_THREADS',
+    help='Number of threads to handle requests with. Default is 4. May also be set using SERVER_THREADS.',
+)
 @click.option(
     '--solr-config', 'solr_config_file',
     type=click.File(),
@@ -25,12 +33,14 @@ logger = logging.getLogger(__name__)
 )
 @click.version_option(__version__, '--version', '-V')
 @click.help_option('--help', '-h')
-def run(listen, solr_config_file):
+def run(listen, threads, solr_config_file):
     server_identity = f'umd-fcrepo-oaipmh/{__version__}'
     logger.info(f'Starting {server_identity}')
+    # the fcrepo connection pool is sized to match the number of server threads
+    os.environ['SERVER_THREADS'] = str(threads)
     try:
         app = create_app(solr_config_file=solr_config_file)
-        serve(app, listen=listen, ident=server_identity)
+        serve(app, listen=listen, ident=server_identity, threads=threads)
     except (OSError, RuntimeError) as e:
         logger.error(f'Exiting: {e}')
         raise SystemExit(1) from e
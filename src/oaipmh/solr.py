@@ -1,12 +1,17 @@
+import json
 import logging
-from datetime import datetime
-from typing import Any, Optional
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Callable, Optional
 
 import pysolr
 from oai_repo import OAIRepoExternalException
 from oai_repo.exceptions import OAIErrorBadArgument, OAIRepoInternalException
 from oai_repo.helpers import datestamp_long
 
+from oaipmh import tracing
 from oaipmh.oai import get_set_spec
 
 logger = logging.getLogger(__name__)
@@ -18,6 +23,18 @@ DEFAULT_SOLR_CONFIG = {
     'last_modified_field': 'last_modified',
     'auto_create_sets': False,
     'sets': [],
+    'sets_ttl': 300,
+    'doc_cache_size': 1000,
+    'doc_cache_ttl': 60,
+    'cursor_paging': False,
+    'unique_key_field': 'id',
+    'format_rules': {},
+}
+
+# parameters sent with every search; the response header is never used
+SEARCH_PARAMS = {
+    'wt': 'json',
+    'omitHeader': 'true',
 }
 
 
@@ -25,6 +42,13 @@ class Index:
     def __init__(self, config: dict[str, Any], solr_client: pysolr.Solr):
         self.config = config
         self.solr = solr_client
+        self.set_registry = SetRegistry(index=self, ttl=self.sets_ttl)
+        self.doc_cache = DocumentCache(
+            max_size=self.config.get('doc_cache_size', DEFAULT_SOLR_CONFIG['doc_cache_size']),
+            ttl=self.config.get('doc_cache_ttl', DEFAULT_SOLR_CONFIG['doc_cache_ttl']),
+        )
+        # called with the name, duration, and error flag of every Solr query; see `record_query()`
+        self.query_listeners: list[Callable[[str, float, bool], None]] = []
         logger.info(f'Solr URL: {self.solr.url}')
         logger.debug(f'Index configuration: {config}')
 
@@ -36,6 +60,35 @@ class Index:
     def auto_set_config(self):
         return self.config.get('auto_set', {})
 
+    @property
+    def sets_ttl(self):
+        return self.config.get('sets_ttl', DEFAULT_SOLR_CONFIG['sets_ttl'])
+
+    @property
+    def cursor_paging(self):
+        return self.config.get('cursor_paging', DEFAULT_SOLR_CONFIG['cursor_paging'])
+
+    @property
+    def unique_key_field(self):
+        return self.config.get('unique_key_field', DEFAULT_SOLR_CONFIG['unique_key_field'])
+
+    @property
+    def format_rules(self) -> dict[str, dict[str, Any]]:
+        return self.config.get('format_rules', DEFAULT_SOLR_CONFIG['format_rules'])
+
+    @property
+    def doc_fields(self) -> list[str]:
+        """
+        Fields to retrieve for each document: everything that is needed to
+        build the record header, retrieve the record from fcrepo, and apply
+        the format rules.
+        """
+        fields = [self.handle_field, self.uri_field, self.last_modified_field]
+        for rule in self.format_rules.values():
+            if rule.get('field') and rule['field'] not in fields:
+                fields.append(rule['field'])
+        return fields
+
     @property
     def base_query(self):
         return self.config['base_query']
@@ -52,18 +105,76 @@ class Index:
     def last_modified_field(self):
         return self.config['last_modified_field']
 
-    def search(self, **kwargs):
-        try:
-            return self.solr.search(**kwargs)
-        except pysolr.SolrError as e:
-            logger.error(str(e))
-            raise OAIRepoExternalException('Unable to connect to Solr') from e
+    def search(self, query_name: str = 'search', **kwargs):
+        """
+        :param query_name: name to report the query's timing under, usually
+        the name of the calling method
+        """
+        with tracing.span(f'solr {query_name}', kind=tracing.SPAN_KIND_CLIENT, **{'solr.query': query_name}) as span:
+            start = time.perf_counter()
+            try:
+                results = self.solr.search(**{**SEARCH_PARAMS, **kwargs})
+            except pysolr.SolrError as e:
+                self.record_query(query_name, time.perf_counter() - start, error=True)
+                logger.error(str(e))
+                raise OAIRepoExternalException('Unable to connect to Solr') from e
+            self.record_query(query_name, time.perf_counter() - start)
+            if span is not None:
+                span.set_attribute('solr.hits', getattr(results, 'hits', None))
+            return results
+
+    def record_query(self, query_name: str, elapsed: float, error: bool = False):
+        """
+        :param query_name: name of the query
+        :param elapsed: duration of the query, in seconds
+        :param error: whether the query failed
+        """
+        for listener in self.query_listeners:
+            listener(query_name, elapsed, error)
 
     def get_sets(self) -> dict[str, dict[str, str]]:
+        return self.set_registry.sets
+
+    def get_format_rule(self, prefix: str) -> Optional[tuple[str, list[str]]]:
+        """
+        Return the field and the list of values that a document must have one
+        of for its record to be available in the format with the given
+        metadata prefix, or None if records are available in that format
+        regardless of their fields.
+        """
+        rule = self.format_rules.get(prefix)
+        if rule is None:
+            return None
+        try:
+            return rule['field'], rule['values']
+        except KeyError as e:
+            logger.error(f'Missing format_rules key {e} for {prefix}')
+            raise OAIRepoInternalException('Configuration error') from e
+
+    def has_format(self, doc: dict[str, Any], prefix: str) -> bool:
+        """True if the format rules allow the record for the document in the given format."""
+        rule = self.get_format_rule(prefix)
+        if rule is None:
+            return True
+        field, values = rule
+        allowed = {str(v) for v in values}
+        value = doc.get(field)
+        return any(str(v) in allowed for v in (value if isinstance(value, list) else [value]) if v is not None)
+
+    def load_sets(self) -> dict[str, dict[str, str]]:
+        """
+        Build the full dictionary of sets, keyed by set spec, from the
+        configured sets and (if enabled) the auto-created sets. This always
+        queries Solr when auto-created sets are enabled; request handling
+        code should use `get_sets()` instead, which is served from the
+        set registry.
+        """
         sets = {s['spec']: s for s in self.config['sets']}
         if self.auto_create_sets:
             try:
-                results = self.search(q=self.auto_set_config['query'], fl=self.auto_set_config['name_field'])
+                results = self.search(
+                    query_name='load_sets', q=self.auto_set_config['query'], fl=self.auto_set_config['name_field']
+                )
             except KeyError as e:
                 logger.error(f'Missing auto_set_config key {e}')
                 raise OAIRepoInternalException('Configuration error') from e
@@ -82,12 +193,83 @@ class Index:
         return self.get_sets()[spec]
 
     def get_sets_for_handle(self, handle: str) -> dict[str, dict[str, str]]:
-        sets = {}
-        for set_spec, set_conf in self.get_sets().items():
-            result = self.solr.search(q=f'{self.handle_field}:{handle}', fq=set_conf['filter'], fl=self.uri_field)
-            if len(result):
-                sets[set_spec] = set_conf
-        return sets
+        return self.get_sets_for_handles([handle])[handle]
+
+    def get_sets_for_handles(self, handles: list[str]) -> dict[str, dict[str, dict[str, str]]]:
+        """
+        Resolve the set membership of one or more handles using a single
+        Solr request. Each set filter becomes a JSON query facet, with a
+        nested terms facet on the handle field reporting which of the
+        given handles match that set.
+
+        :param handles: list of handles, e.g. ["1903.1/12345", ...]
+        :return: dictionary mapping each handle to a dictionary of its sets,
+        keyed by set spec
+        """
+        sets_by_handle = {handle: {} for handle in handles}
+        # the set registry may be refreshed at any time, so build the query and
+        # parse its results with the same list of sets
+        sets = self.get_sets()
+        query = self.get_sets_for_handles_query(handles, sets)
+        if query is None:
+            return sets_by_handle
+        results = self.search(query_name='get_sets_for_handles', **query)
+        return self.parse_set_facets(handles, results.raw_response.get('facets', {}), sets)
+
+    def get_sets_for_handles_query(
+            self,
+            handles: list[str],
+            sets: dict[str, dict[str, str]],
+    ) -> Optional[dict[str, Any]]:
+        """
+        Build the Solr search parameters for `get_sets_for_handles()`.
+        Returns None if there are no handles or no sets, in which case no
+        search is needed.
+
+        :param handles: list of handles
+        :param sets: the sets to facet on, from `get_sets()`
+        """
+        if not handles or not sets:
+            return None
+        facets = {
+            set_facet_name(spec): {
+                'type': 'query',
+                'q': set_conf['filter'],
+                'facet': {
+                    'handles': {'type': 'terms', 'field': self.handle_field, 'limit': len(handles)},
+                },
+            }
+            for spec, set_conf in sets.items()
+        }
+        return {
+            'q': '*:*',
+            # the list of handles is different for every page, so there is no point caching it
+            'fq': f'{{!terms f={self.handle_field} cache=false}}' + ','.join(handles),
+            'rows': 0,
+            'json.facet': json.dumps(facets),
+        }
+
+    def parse_set_facets(
+            self,
+            handles: list[str],
+            facet_results: dict[str, Any],
+            sets: dict[str, dict[str, str]],
+    ) -> dict[str, dict[str, dict[str, str]]]:
+        """
+        Convert the facets in the response to the search built by
+        `get_sets_for_handles_query()` into a dictionary mapping each handle
+        to a dictionary of its sets, keyed by set spec.
+
+        :param handles: list of handles
+        :param facet_results: the "facets" of the response
+        :param sets: the same sets that the search was built with
+        """
+        sets_by_handle = {handle: {} for handle in handles}
+        for spec, set_conf in sets.items():
+            for bucket in facet_results.get(set_facet_name(spec), {}).get('handles', {}).get('buckets', []):
+                if bucket['val'] in sets_by_handle:
+                    sets_by_handle[bucket['val']][set_conf['spec']] = set_conf
+        return sets_by_handle
 
     def get_docs(
             self,
@@ -96,33 +278,293 @@ class Index:
             filter_set: Optional[str] = None,
             start: Optional[int] = 0,
             rows: Optional[int] = 25,
+            cursor_mark: Optional[str] = None,
+            fields: Optional[list[str]] = None,
+            metadata_prefix: Optional[str] = None,
+            by_datestamp: bool = False,
     ):
-        filter_query = self.base_query
-        if filter_from or filter_until:
-            datetime_range = solr_date_range(filter_from, filter_until)
-            filter_query += f' AND {self.last_modified_field}:{datetime_range}'
+        """
+        Search for the documents matching the given filters. If a
+        `cursor_mark` is given, it is used for deep paging instead of
+        `start`, and the results are sorted by the unique key field.
+        Use "*" as the cursor mark for the first page; the cursor mark for
+        the next page is in the `nextCursorMark` attribute of the results.
+        Only the given `fields` (by default, `doc_fields`) are retrieved.
+        If a `metadata_prefix` is given, only documents whose records are
+        available in that format (according to the format rules) match.
+        If `by_datestamp` is true, the results are sorted by the last
+        modified field (and then the unique key field), with or without a
+        cursor mark.
+        """
+        return self.search(
+            query_name='get_docs',
+            **self.get_docs_query(
+                filter_from, filter_until, filter_set, start, rows, cursor_mark, fields, metadata_prefix, by_datestamp
+            )
+        )
+
+    def get_docs_query(
+            self,
+            filter_from: Optional[str] = None,
+            filter_until: Optional[str] = None,
+            filter_set: Optional[str] = None,
+            start: Optional[int] = 0,
+            rows: Optional[int] = 25,
+            cursor_mark: Optional[str] = None,
+            fields: Optional[list[str]] = None,
+            metadata_prefix: Optional[str] = None,
+            by_datestamp: bool = False,
+    ) -> dict[str, Any]:
+        """
+        Build the Solr search parameters for `get_docs()`. The base query,
+        the set filter, and the date range are separate filter queries, so
+        that Solr caches each of them independently: the base query and set
+        filters are shared by every harvest. The exact date range is
+        different for almost every harvest, so it is not cached; instead,
+        the date range rounded out to whole days is, since it is shared by
+        every harvest over the same days, and narrows down the documents
+        that the exact range is checked against.
+        """
+        field_list = ','.join(fields or self.doc_fields)
+        filter_query = [self.base_query]
         if filter_set:
             try:
-                filter_query += f' AND ({self.get_sets()[filter_set]["filter"]})'
+                filter_query.append(self.get_sets()[filter_set]['filter'])
             except KeyError:
                 raise OAIErrorBadArgument(f"'{filter_set}' is not a valid setSpec value")
-        logger.debug(f'Solr fq = "{filter_query}"')
+        rule = self.get_format_rule(metadata_prefix) if metadata_prefix else None
+        if rule is not None:
+            field, values = rule
+            filter_query.append(f'{field}:(' + ' OR '.join(solr_quoted(str(v)) for v in values) + ')')
+        if filter_from or filter_until:
+            rounded_range = solr_date_range(filter_from, filter_until, round_to_days=True)
+            filter_query.append(f'{self.last_modified_field}:{rounded_range}')
+            datetime_range = solr_date_range(filter_from, filter_until)
+            filter_query.append(f'{{!cache=false}}{self.last_modified_field}:{datetime_range}')
+        logger.debug(f'Solr fq = {filter_query}')
 
-        return self.search(q='*:*', fq=filter_query, start=start, rows=rows)
+        if by_datestamp:
+            sort = f'{self.last_modified_field} asc, {self.unique_key_field} asc'
+        else:
+            sort = f'{self.unique_key_field} asc'
+        if cursor_mark is not None:
+            return {
+                'q': '*:*',
+                'fq': filter_query,
+                'fl': field_list,
+                'rows': rows,
+                'sort': sort,
+                'cursorMark': cursor_mark,
+            }
+        query = {'q': '*:*', 'fq': filter_query, 'fl': field_list, 'start': start, 'rows': rows}
+        if by_datestamp:
+            query['sort'] = sort
+        return query
 
     def get_doc(self, handle: str) -> dict[str, Any]:
-        results = self.search(q=f'{self.handle_field}:{handle}')
+        doc = self.doc_cache.get(handle)
+        if doc is not None:
+            return doc
+        results = self.search(query_name='get_doc', **self.get_doc_query(handle))
         if not results:
             raise OAIRepoExternalException(f'Unable to find handle {handle} in Solr')
-        return results.docs[0]
+        doc = results.docs[0]
+        self.doc_cache.put(handle, doc)
+        return doc
+
+    def get_doc_query(self, handle: str) -> dict[str, Any]:
+        """Build the Solr search parameters for `get_doc()`."""
+        return {'q': f'{self.handle_field}:{handle}', 'fl': ','.join(self.doc_fields), 'rows': 1}
+
+    def get_doc_by_uri(self, uri: str) -> Optional[dict[str, Any]]:
+        """
+        Return the Solr document for the given resource URI, or None if there
+        is no such document. This always queries Solr, and adds the document
+        to the document cache.
+        """
+        results = self.search(
+            query_name='get_doc_by_uri',
+            q=f'{self.uri_field}:{solr_quoted(uri)}', fq=self.base_query, fl=','.join(self.doc_fields), rows=1
+        )
+        if not results:
+            return None
+        doc = results.docs[0]
+        self.doc_cache.put(doc[self.handle_field], doc)
+        return doc
+
+    def invalidate_uri(self, uri: str) -> list[str]:
+        """
+        Remove the cached documents for the given resource URI.
+
+        :return: handles of the removed documents
+        """
+        return self.doc_cache.invalidate_matching(self.uri_field, uri)
+
+
+class SetRegistry:
+    """
+    In-memory registry of the sets for an index. The sets are loaded from
+    the index the first time they are requested, and after that are served
+    from memory. Once they are older than the TTL, the next request triggers
+    a refresh in a background thread, and continues to be served the current
+    sets in the meantime.
+    """
+    def __init__(self, index: Index, ttl: float = 0):
+        self.index = index
+        self.ttl = ttl
+        self._sets: Optional[dict[str, dict[str, str]]] = None
+        self._loaded_at: float = 0
+        self._lock = threading.Lock()
+        self._refresh_thread: Optional[threading.Thread] = None
+
+    @property
+    def sets(self) -> dict[str, dict[str, str]]:
+        """
+        Dictionary of sets, keyed by set spec. Loads the sets synchronously
+        if they have never been loaded, or have been invalidated.
+        """
+        sets = self._sets
+        if sets is None:
+            with self._lock:
+                if self._sets is None:
+                    self._load()
+                sets = self._sets
+        elif self.is_stale:
+            self.refresh_in_background()
+        return sets
+
+    @property
+    def is_loaded(self) -> bool:
+        """True if the sets have been loaded, so that a lookup will not query Solr."""
+        return self._sets is not None
+
+    @property
+    def is_stale(self) -> bool:
+        """True if the TTL is enabled and has elapsed since the last load."""
+        return bool(self.ttl) and time.monotonic() - self._loaded_at > self.ttl
+
+    def invalidate(self):
+        """Discard the current sets, so that the next lookup reloads them."""
+        with self._lock:
+            self._sets = None
+
+    def refresh_in_background(self):
+        """Start a background refresh, unless one is already running."""
+        with self._lock:
+            if self._refresh_thread is not None and self._refresh_thread.is_alive():
+                return
+            self._refresh_thread = threading.Thread(target=self._refresh, name='set-registry-refresh', daemon=True)
+            self._refresh_thread.start()
+
+    def _load(self):
+        self._sets = self.index.load_sets()
+        self._loaded_at = time.monotonic()
+        logger.debug(f'Loaded {len(self._sets)} set(s) into the set registry')
+
+    def _refresh(self):
+        try:
+            self._load()
+        except (OAIRepoExternalException, OAIRepoInternalException) as e:
+            # keep serving the current sets; the next stale lookup retries
+            logger.error(f'Unable to refresh the set registry: {e}')
+
+
+class DocumentCache:
+    """
+    Thread-safe LRU cache of Solr documents, keyed by handle. Entries expire
+    after the TTL, so that a document is fetched from Solr at most once per
+    request without serving stale data for long. A `max_size` of 0 disables
+    the cache.
+    """
+    def __init__(self, max_size: int = 1000, ttl: float = 60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._docs: OrderedDict[str, tuple[float, dict[str, Any]]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def get(self, key: str) -> Optional[dict[str, Any]]:
+        with self._lock:
+            try:
+                expires, doc = self._docs[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires < time.monotonic():
+                del self._docs[key]
+                self.misses += 1
+                return None
+            self._docs.move_to_end(key)
+            self.hits += 1
+            return doc
+
+    def put(self, key: str, doc: dict[str, Any]):
+        if not self.max_size:
+            return
+        with self._lock:
+            self._docs[key] = (time.monotonic() + self.ttl, doc)
+            self._docs.move_to_end(key)
+            while len(self._docs) > self.max_size:
+                self._docs.popitem(last=False)
+
+    def invalidate(self, key: Optional[str] = None):
+        """Remove a single entry, or all entries if no key is given."""
+        with self._lock:
+            if key is None:
+                self._docs.clear()
+            else:
+                self._docs.pop(key, None)
+
+    def find_matching(self, field: str, value: Any) -> list[dict[str, Any]]:
+        """Return the unexpired documents that have the given value in the given field."""
+        now = time.monotonic()
+        with self._lock:
+            return [doc for expires, doc in self._docs.values() if expires >= now and doc.get(field) == value]
+
+    def invalidate_matching(self, field: str, value: Any) -> list[str]:
+        """
+        Remove the entries whose document has the given value in the given field.
+
+        :return: keys of the removed entries
+        """
+        with self._lock:
+            keys = [key for key, (_, doc) in self._docs.items() if doc.get(field) == value]
+            for key in keys:
+                del self._docs[key]
+        return keys
+
+
+def set_facet_name(spec: str) -> str:
+    """
+    Name of the JSON facet for the set with the given spec in the search built
+    by `Index.get_sets_for_handles_query()`. The spec is hex-encoded, since set
+    specs may contain characters that are not allowed in facet names.
+    """
+    return 's_' + spec.encode('utf-8').hex()
 
 
 def solr_quoted(value: str) -> str:
     return '"' + value.replace('"', '\\"') + '"'
 
 
-def solr_date_range(timestamp_from: Optional[datetime], timestamp_until: Optional[datetime]) -> str:
+def solr_date_range(
+        timestamp_from: Optional[datetime],
+        timestamp_until: Optional[datetime],
+        round_to_days: bool = False,
+) -> str:
+    """
+    :param round_to_days: if true, round the range out to whole days, so
+    that it includes every timestamp of the first and last days
+    """
     try:
+        if round_to_days:
+            midnight = {'hour': 0, 'minute': 0, 'second': 0, 'microsecond': 0}
+            timestamp_from = timestamp_from.replace(**midnight) if timestamp_from else None
+            timestamp_until = timestamp_until.replace(**midnight) + timedelta(days=1) if timestamp_until else None
         datestamp_from = datestamp_long(timestamp_from) if timestamp_from else '*'
         datestamp_until = datestamp_long(timestamp_until) if timestamp_until else '*'
     except AttributeError as e:
@@ -0,0 +1,89 @@
+import logging
+from io import BytesIO
+from typing import Callable, Iterable, Iterator
+
+from lxml import etree
+# noinspection PyProtectedMember
+from lxml.etree import _Element
+
+logger = logging.getLogger(__name__)
+
+# tag of the placeholder elements that stand in for record metadata until it is streamed
+DEFERRED_METADATA = '{urn:x-umd-fcrepo-oaipmh:deferred}metadata'
+
+# response body elements whose children are streamed one at a time
+STREAMED_ELEMENTS = {'ListIdentifiers', 'ListRecords'}
+
+
+class DeferredMetadata:
+    """
+    Wrapper around a data provider that returns a placeholder element from
+    `get_record_metadata()` instead of retrieving and transforming the record.
+    This lets oai_repo build the complete response (headers, resumption token,
+    and errors) without holding the metadata for every record in memory. All
+    other attributes are passed through to the wrapped data provider.
+    """
+    def __init__(self, data_provider):
+        self.data_provider = data_provider
+
+    def __getattr__(self, name):
+        return getattr(self.data_provider, name)
+
+    def get_record_metadata(self, identifier: str, metadataprefix: str) -> _Element:
+        return etree.Element(DEFERRED_METADATA, identifier=identifier, metadataprefix=metadataprefix)
+
+
+def stream_document(
+        root: _Element,
+        get_record_metadata: Callable[[str, str], _Element],
+        processing_instructions: Iterable[_Element] = (),
+) -> Iterator[bytes]:
+    """
+    Serialize an OAI-PMH response document incrementally. The children of a
+    ListIdentifiers or ListRecords element are written one at a time, with
+    any deferred metadata placeholders replaced by the real metadata just
+    before each record is written, and discarded afterwards. Memory use is
+    therefore bounded by the size of a single record rather than the page.
+
+    :param root: root element of the OAI-PMH response
+    :param get_record_metadata: callable that takes an identifier and a
+    metadata prefix and returns the metadata element for the record
+    :param processing_instructions: processing instructions to write
+    before the root element
+    :return: iterator of chunks of the serialized document
+    """
+    buffer = BytesIO()
+
+    def drain() -> bytes:
+        chunk = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return chunk
+
+    with etree.xmlfile(buffer, encoding='UTF-8') as xf:
+        xf.write_declaration()
+        for processing_instruction in processing_instructions:
+            xf.write(processing_instruction)
+        with xf.element(root.tag, attrib=dict(root.attrib), nsmap=root.nsmap):
+            for child in root:
+                if child.tag not in STREAMED_ELEMENTS:
+                    xf.write(child, pretty_print=True)
+                    continue
+                with xf.element(child.tag):
+                    for item in child:
+                        for placeholder in list(item.iter(DEFERRED_METADATA)):
+                            try:
+                                metadata = get_record_metadata(
+                                    placeholder.get('identifier'), placeholder.get('metadataprefix')
+                                )
+                            except Exception as e:
+                                # the response status has already been sent, so the best
+                                # we can do is log the error and abandon the response
+                                logger.error(f'Unable to stream {placeholder.get("identifier")}: {e}')
+                                raise
+                            placeholder.getparent().replace(placeholder, metadata)
+                        xf.write(item, pretty_print=True)
+                        item.clear()
+                        xf.flush()
+                        yield drain()
+    yield drain()
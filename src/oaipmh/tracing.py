@@ -0,0 +1,426 @@
+import json
+import logging
+import os
+import queue
+import random
+import secrets
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from functools import partial
+from pathlib import Path
+from types import FrameType
+from typing import Any, Callable, Iterator, Optional
+
+import requests
+from flask import Flask, Response, g, request
+
+from oaipmh import __version__
+from oaipmh.config import EnvAttribute
+
+logger = logging.getLogger(__name__)
+
+# OpenTelemetry span kinds and status codes
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+SPAN_KIND_CLIENT = 3
+STATUS_UNSET = 0
+STATUS_ERROR = 2
+
+# the innermost open span of the trace being recorded in the current context, if any
+_current_span: ContextVar[Optional['Span']] = ContextVar('oaipmh_current_span', default=None)
+
+
+class Span:
+    """A timed operation within a trace, with attributes and an optional parent."""
+    def __init__(
+            self,
+            trace: 'Trace',
+            name: str,
+            parent: Optional['Span'] = None,
+            kind: int = SPAN_KIND_INTERNAL,
+            attributes: Optional[dict[str, Any]] = None,
+            start_ns: Optional[int] = None,
+    ):
+        self.trace = trace
+        self.name = name
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.kind = kind
+        self.attributes = {k: v for k, v in (attributes or {}).items() if v is not None}
+        self.start_ns = start_ns if start_ns is not None else time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any):
+        if value is not None:
+            self.attributes[key] = value
+
+    def end(self, end_ns: Optional[int] = None):
+        self.end_ns = end_ns if end_ns is not None else time.time_ns()
+
+    @property
+    def duration(self) -> float:
+        """Duration of the span in seconds, or up to now if it has not ended."""
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+    def to_otlp(self) -> dict[str, Any]:
+        """Encode the span in the OTLP/JSON format."""
+        span = {
+            'traceId': self.trace.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns or self.start_ns),
+            'attributes': otlp_attributes(self.attributes),
+            'status': {'code': STATUS_ERROR, 'message': self.error} if self.error else {'code': STATUS_UNSET},
+        }
+        if self.parent_id is not None:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+class Trace:
+    """The tree of spans recorded for one request."""
+    def __init__(self, name: str, attributes: Optional[dict[str, Any]] = None):
+        self.trace_id = secrets.token_hex(16)
+        self.spans: list[Span] = []
+        self.root = self.add_span(name, kind=SPAN_KIND_SERVER, attributes=attributes)
+
+    def add_span(self, name: str, parent: Optional[Span] = None, **kwargs) -> Span:
+        span = Span(self, name, parent=parent, **kwargs)
+        # list.append is atomic, so spans can be added from any thread
+        self.spans.append(span)
+        return span
+
+    def to_otlp(self) -> dict[str, Any]:
+        """Encode the trace as an OTLP/JSON `ExportTraceServiceRequest`."""
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': otlp_attributes({'service.name': 'umd-fcrepo-oaipmh'})},
+                'scopeSpans': [{
+                    'scope': {'name': 'oaipmh', 'version': __version__},
+                    'spans': [span.to_otlp() for span in self.spans],
+                }],
+            }],
+        }
+
+
+def otlp_attributes(attributes: dict[str, Any]) -> list[dict[str, Any]]:
+    encoded = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            encoded_value = {'boolValue': value}
+        elif isinstance(value, int):
+            encoded_value = {'intValue': str(value)}
+        elif isinstance(value, float):
+            encoded_value = {'doubleValue': value}
+        else:
+            encoded_value = {'stringValue': str(value)}
+        encoded.append({'key': key, 'value': encoded_value})
+    return encoded
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+@contextmanager
+def span(name: str, kind: int = SPAN_KIND_INTERNAL, **attributes) -> Iterator[Optional[Span]]:
+    """
+    Record the enclosed block as a child of the current span. When no trace
+    is being recorded in the current context, this does nothing, and yields
+    None instead of a span.
+    """
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    child = parent.trace.add_span(name, parent=parent, kind=kind, attributes=attributes)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        child.end()
+        _current_span.reset(token)
+
+
+def record_span(parent: Optional[Span], name: str, elapsed: float, **attributes):
+    """
+    Record an operation that has just finished, and took `elapsed` seconds,
+    as a child of the given span. For work that runs outside of the context
+    of its trace, such as in another process. Does nothing if `parent` is None.
+    """
+    if parent is None:
+        return
+    end_ns = time.time_ns()
+    child = parent.trace.add_span(
+        name, parent=parent, attributes=attributes, start_ns=end_ns - int(elapsed * 1e9)
+    )
+    child.end(end_ns)
+
+
+def propagate(func: Callable) -> Callable:
+    """
+    Wrap a function that will be run in another thread (e.g., by an
+    executor), so that the spans it records are children of the current
+    span.
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return func
+
+    def run(*args, **kwargs):
+        token = _current_span.set(parent)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current_span.reset(token)
+
+    return run
+
+
+class FileExporter:
+    """Appends each trace to a file, as one line of OTLP/JSON."""
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, trace: Trace):
+        line = json.dumps(trace.to_otlp()) + '\n'
+        with self._lock, open(self.path, 'a') as fh:
+            fh.write(line)
+
+
+class OTLPHTTPExporter:
+    """
+    Sends each trace to an OTLP/HTTP collector's traces endpoint (e.g.,
+    `http://localhost:4318/v1/traces`) from a background thread, so that
+    requests never wait on the collector. Traces are dropped if the
+    collector falls too far behind.
+    """
+    def __init__(self, url: str, max_queued: int = 1000, timeout: float = 5):
+        self.url = url
+        self.timeout = timeout
+        self._queue: queue.Queue[Trace] = queue.Queue(maxsize=max_queued)
+        self._thread = threading.Thread(target=self._send, name='trace-exporter', daemon=True)
+        self._thread.start()
+
+    def export(self, trace: Trace):
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            logger.warning(f'Trace export queue is full; dropped trace {trace.trace_id}')
+
+    def _send(self):
+        while True:
+            trace = self._queue.get()
+            try:
+                response = requests.post(self.url, json=trace.to_otlp(), timeout=self.timeout)
+                if not response.ok:
+                    logger.warning(f'Trace export to {self.url} -> {response.status_code}')
+            except requests.RequestException as e:
+                logger.warning(f'Trace export to {self.url} failed: {e}')
+
+
+def get_exporter(destination: str) -> FileExporter | OTLPHTTPExporter:
+    """Get an exporter for an http(s) URL, a `file://` URL, or a file path."""
+    if destination.startswith(('http://', 'https://')):
+        return OTLPHTTPExporter(destination)
+    if destination.startswith('file://'):
+        destination = destination[len('file://'):]
+    return FileExporter(destination)
+
+
+class Tracer:
+    """
+    Starts a trace for each request (or a random sample of them, according
+    to `TRACE_SAMPLE_RATE`), and exports the trace when the request ends.
+    """
+    sample_rate: float = EnvAttribute('TRACE_SAMPLE_RATE', 1)
+
+    def __init__(self, exporter: FileExporter | OTLPHTTPExporter):
+        self.exporter = exporter
+
+    def start_trace(self, name: str, **attributes) -> Optional[Trace]:
+        """
+        Start a trace, and make its root span the current span in this
+        context. Returns None if the request is not sampled.
+        """
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            _current_span.set(None)
+            return None
+        trace = Trace(name, attributes=attributes)
+        _current_span.set(trace.root)
+        return trace
+
+    def end_trace(self, trace: Trace, **attributes):
+        for key, value in attributes.items():
+            trace.root.set_attribute(key, value)
+        trace.root.end()
+        _current_span.set(None)
+        self.exporter.export(trace)
+
+
+class ProfiledRequest:
+    """Stack samples of the thread that is handling a request."""
+    def __init__(self):
+        self.thread_id = threading.get_ident()
+        self.start = time.perf_counter()
+        self.samples: Counter[str] = Counter()
+
+
+class SlowRequestProfiler:
+    """
+    Sampling profiler for slow requests. While a request is being handled,
+    a background thread samples the stack of the request's thread every
+    `interval` seconds. If the request then turns out to have taken at least
+    `threshold` seconds, the samples are written to a file in `directory`
+    in the "collapsed stack" format (one "frame;frame;... count" line per
+    distinct stack, outermost frame first), which can be loaded into
+    flame graph tools such as speedscope or flamegraph.pl. Only the
+    request's own thread is sampled; time spent waiting for the fcrepo
+    fetch workers or transformation processes shows up as waits on their
+    futures.
+    """
+    def __init__(self, threshold: float, directory: str, interval: float = 0.005):
+        self.threshold = threshold
+        self.directory = Path(directory)
+        self.interval = interval
+        self._active: dict[int, ProfiledRequest] = {}
+        self._lock = threading.Lock()
+        self._busy = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self._thread.start()
+        logger.info(f'Profiling requests slower than {threshold}s to {directory}')
+
+    def start(self) -> ProfiledRequest:
+        """Start sampling the current thread."""
+        profiled = ProfiledRequest()
+        with self._lock:
+            self._active[profiled.thread_id] = profiled
+            self._busy.set()
+        return profiled
+
+    def stop(self, profiled: ProfiledRequest, name: str, description: Optional[str] = None) -> Optional[Path]:
+        """
+        Stop sampling a request, and write its profile if it was slow.
+
+        :param profiled: the request, as returned by `start()`
+        :param name: short name of the request, for the file name
+        :param description: description of the request for the log; defaults to the name
+        :return: path of the profile, or None if the request was not slow
+        """
+        with self._lock:
+            if self._active.get(profiled.thread_id) is profiled:
+                del self._active[profiled.thread_id]
+            if not self._active:
+                self._busy.clear()
+        elapsed = time.perf_counter() - profiled.start
+        if elapsed < self.threshold:
+            return None
+        timestamp = datetime.now().strftime('%Y%m%dT%H%M%S')
+        path = self.directory / f'{timestamp}-{safe_filename(name)}-{elapsed:.1f}s.collapsed'
+        with path.open('w') as fh:
+            for stack, count in profiled.samples.most_common():
+                fh.write(f'{stack} {count}\n')
+        logger.warning(f'Slow request ({elapsed:.1f}s): {description or name}; profile written to {path}')
+        return path
+
+    def _sample(self):
+        while True:
+            self._busy.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, profiled in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        profiled.samples[collapse_stack(frame)] += 1
+
+
+def collapse_stack(frame: FrameType) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def safe_filename(name: str) -> str:
+    return ''.join(c if c.isalnum() or c in '-_.' else '_' for c in name)[:100]
+
+
+def init_tracing(app: Flask) -> tuple[Optional[Tracer], Optional[SlowRequestProfiler]]:
+    """
+    If `TRACE_EXPORT` is set, record a trace of each request to the
+    OAI-PMH endpoint, and export it to the given destination. If
+    `PROFILE_SLOW_REQUESTS` is set, profile each request to the OAI-PMH
+    endpoint, and keep the profiles of those that take at least that many
+    seconds. A request's trace and profile end when its response has been
+    sent, so they include the time to write a streamed response body.
+    """
+    destination = os.environ.get('TRACE_EXPORT')
+    tracer = Tracer(get_exporter(destination)) if destination else None
+    threshold = os.environ.get('PROFILE_SLOW_REQUESTS')
+    profiler = SlowRequestProfiler(
+        threshold=float(threshold),
+        directory=os.environ.get('PROFILE_DIR', tempfile.gettempdir()),
+        interval=float(os.environ.get('PROFILE_INTERVAL', 0.005)),
+    ) if threshold else None
+    if tracer is None and profiler is None:
+        return None, None
+
+    def finish(trace: Optional[Trace], profiled: Optional[ProfiledRequest], target: str, status_code: int):
+        if trace is not None:
+            tracer.end_trace(trace, **{'http.status_code': status_code})
+        if profiled is not None:
+            verb = trace.root.name if trace is not None else 'request'
+            name = f'{verb}-{trace.trace_id}' if trace is not None else verb
+            profiler.stop(profiled, name, f'{target} -> {status_code}')
+
+    @app.before_request
+    def begin_request():
+        if request.endpoint != 'endpoint':
+            return
+        args = request.args
+        verb = args.get('verb', '')
+        trace = tracer.start_trace(
+            verb or 'OAI-PMH',
+            **{
+                'http.target': request.full_path,
+                'oai.verb': verb,
+                'oai.metadataPrefix': args.get('metadataPrefix'),
+                'oai.set': args.get('set'),
+                'oai.identifier': args.get('identifier'),
+                'oai.resumptionToken': args.get('resumptionToken'),
+            },
+        ) if tracer is not None else None
+        profiled = profiler.start() if profiler is not None else None
+        g.oaipmh_trace = (trace, profiled, request.full_path)
+
+    @app.after_request
+    def end_request(response: Response) -> Response:
+        state = g.pop('oaipmh_trace', None)
+        if state is not None:
+            response.call_on_close(partial(finish, *state, response.status_code))
+        return response
+
+    @app.teardown_request
+    def teardown_request(_exc: Optional[BaseException]):
+        # only reached with the state still set if the request failed before producing a response
+        state = g.pop('oaipmh_trace', None)
+        if state is not None:
+            finish(*state, 500)
+
+    return tracer, profiler
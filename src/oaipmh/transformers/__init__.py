@@ -1,37 +1,173 @@
+import logging
+import os
+import threading
+import time
+from importlib.metadata import entry_points
 from os.path import dirname
 from pathlib import Path
-from typing import Mapping
+from typing import Callable, Mapping, Optional
 
 from lxml import etree
 # noinspection PyProtectedMember
-from lxml.etree import _Element
+from lxml.etree import _Element, _ElementTree
 from oai_repo import OAIRepoInternalException, MetadataFormat
 
+from oaipmh import tracing
 
-def load_transformers() -> Mapping[str, 'Transformer']:
-    xsl_dir = Path(dirname(__file__))
-    return {
-        'rdf': Transformer(xsl_dir / 'rdf.xsl'),
-        'oai_dc': Transformer(xsl_dir / 'oai_dc.xsl'),
-    }
+logger = logging.getLogger(__name__)
+
+
+# entry point group for other packages to register stylesheets in
+ENTRY_POINT_GROUP = 'oaipmh.transformers'
+
+XSI_NAMESPACE = 'http://www.w3.org/2001/XMLSchema-instance'
+
+
+def find_stylesheets(xsl_dir: str | Path) -> dict[str, Path]:
+    """Return a dictionary mapping metadata prefixes to the paths of the stylesheets in a directory."""
+    return {path.stem: path for path in sorted(Path(xsl_dir).glob('*.xsl'))}
+
+
+def find_entry_point_stylesheets() -> dict[str, Path]:
+    """
+    Return a dictionary mapping metadata prefixes to the paths of the
+    stylesheets registered in the `oaipmh.transformers` entry point group.
+    The name of each entry point is the metadata prefix, and its value is
+    the path of the stylesheet, or a callable that returns the path.
+    """
+    stylesheets = {}
+    for entry_point in entry_points(group=ENTRY_POINT_GROUP):
+        value = entry_point.load()
+        stylesheets[entry_point.name] = Path(value() if callable(value) else value)
+    return stylesheets
+
+
+def load_transformers(xsl_dir: Optional[str | Path] = None) -> Mapping[str, 'Transformer']:
+    """
+    Build the transformers for all the available metadata formats, keyed by
+    metadata prefix. The stylesheets come from this package, then from the
+    `oaipmh.transformers` entry points, then from `xsl_dir` (by default, the
+    `TRANSFORMERS_DIR` environment variable); a stylesheet from a later
+    source replaces one for the same prefix from an earlier source. No
+    stylesheet is compiled until it is first used.
+
+    :param xsl_dir: directory of additional stylesheets, named "{prefix}.xsl"
+    """
+    stylesheets = find_stylesheets(dirname(__file__))
+    stylesheets.update(find_entry_point_stylesheets())
+    if xsl_dir is None:
+        xsl_dir = os.environ.get('TRANSFORMERS_DIR')
+    if xsl_dir:
+        stylesheets.update(find_stylesheets(xsl_dir))
+    transformers = {prefix: Transformer(path, prefix=prefix) for prefix, path in stylesheets.items()}
+    logger.info(f'Metadata formats: {", ".join(transformers.keys())}')
+    return transformers
+
+
+def read_schema_location(xsl_filepath: Path) -> Optional[str]:
+    """
+    Return the `xsi:schemaLocation` attribute of the root element of a
+    stylesheet, without parsing the rest of the stylesheet.
+    """
+    with xsl_filepath.open('rb') as fh:
+        for _, element in etree.iterparse(fh, events=('start',)):
+            return element.get(f'{{{XSI_NAMESPACE}}}schemaLocation')
+
+
+class TransformStats:
+    """
+    Thread-safe running totals of the number and duration of transformations.
+    Each listener is also called with the duration and error flag of every
+    transformation.
+    """
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.listeners: list[Callable[[float, bool], None]] = []
+        self._lock = threading.Lock()
+
+    def record(self, elapsed: float, error: bool = False):
+        """
+        :param elapsed: duration of the transformation, in seconds
+        :param error: whether the transformation failed
+        """
+        with self._lock:
+            self.count += 1
+            self.errors += int(error)
+            self.total_time += elapsed
+            self.max_time = max(self.max_time, elapsed)
+        for listener in self.listeners:
+            listener(elapsed, error)
+
+    @property
+    def mean_time(self) -> float:
+        return self.total_time / self.count if self.count else 0.0
 
 
 class Transformer:
+    """
+    XSLT transformation to a metadata format. Creating a transformer only
+    reads the root element of the stylesheet, for the metadata format
+    information; the stylesheet is parsed the first time it is used. Each
+    thread that uses the transformer gets its own compiled copy of the
+    stylesheet, so that the server's threads can transform records
+    concurrently without sharing an `etree.XSLT` object. lxml releases the
+    GIL while it applies the stylesheet, so these transformations run in
+    parallel.
+    """
     def __init__(self, xsl_filepath: Path, prefix: str = None):
+        self.path = xsl_filepath
         self.prefix = xsl_filepath.stem if prefix is None else prefix
 
-        with xsl_filepath.open() as fh:
-            xslt_doc = etree.parse(fh)
-        schema_location = xslt_doc.xpath(
-            '@xsi:schemaLocation', namespaces={'xsi': 'http://www.w3.org/2001/XMLSchema-instance'}
-        )
+        schema_location = read_schema_location(xsl_filepath)
         if not schema_location:
             raise OAIRepoInternalException(f'No @xsi:schemaLocation in {xsl_filepath}')
-        self.namespace, self.schema = schema_location[0].split(maxsplit=1)
-        self.xslt = etree.XSLT(xslt_doc)
+        self.namespace, self.schema = schema_location.split(maxsplit=1)
+        self.stats = TransformStats()
+        self._xslt_doc: Optional[_ElementTree] = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def xslt_doc(self) -> _ElementTree:
+        """The parsed stylesheet, shared by all threads."""
+        if self._xslt_doc is None:
+            with self._lock:
+                if self._xslt_doc is None:
+                    with self.path.open() as fh:
+                        self._xslt_doc = etree.parse(fh)
+        return self._xslt_doc
+
+    @property
+    def is_compiled(self) -> bool:
+        """True if the stylesheet has been compiled for the current thread."""
+        return getattr(self._local, 'xslt', None) is not None
+
+    @property
+    def xslt(self) -> etree.XSLT:
+        """The compiled stylesheet for the current thread."""
+        xslt = getattr(self._local, 'xslt', None)
+        if xslt is None:
+            start = time.perf_counter()
+            xslt = self._local.xslt = etree.XSLT(self.xslt_doc)
+            logger.debug(f'Compiled {self.prefix} stylesheet: {time.perf_counter() - start:.3f}s')
+        return xslt
 
     def __call__(self, *args, **kwargs) -> _Element:
-        return self.xslt(*args, **kwargs).getroot()
+        xslt = self.xslt
+        with tracing.span(f'xslt {self.prefix}'):
+            start = time.perf_counter()
+            try:
+                result = xslt(*args, **kwargs)
+            except etree.XSLTError:
+                self.stats.record(time.perf_counter() - start, error=True)
+                raise
+            elapsed = time.perf_counter() - start
+        self.stats.record(elapsed)
+        logger.debug(f'{self.prefix} transformation: {elapsed:.3f}s')
+        return result.getroot()
 
     @property
     def metadata_format(self) -> MetadataFormat:
@@ -40,3 +176,30 @@ class Transformer:
             metadata_namespace=self.namespace,
             schema=self.schema,
         )
+
+
+# transformers for a transformation worker process, loaded by init_transform_worker()
+_worker_transformers: Mapping[str, Transformer] = {}
+
+
+def init_transform_worker():
+    """Load the transformers in a transformation worker process."""
+    global _worker_transformers
+    _worker_transformers = load_transformers()
+
+
+def transform_serialized(prefix: str, rdf: bytes) -> tuple[bytes, float]:
+    """
+    Parse and transform a serialized RDF/XML document in a transformation
+    worker process.
+
+    :param prefix: metadata prefix of the target format
+    :param rdf: serialized RDF/XML document
+    :return: tuple of the serialized metadata, and the duration of the
+    transformation in seconds
+    """
+    transformer = _worker_transformers[prefix]
+    start = time.perf_counter()
+    metadata = transformer(etree.fromstring(rdf))
+    elapsed = time.perf_counter() - start
+    return etree.tostring(metadata), elapsed
@@ -1,18 +1,28 @@
+import hashlib
+import json
 import os
+from datetime import datetime
 from http import HTTPStatus
 from typing import Any, Optional, TextIO
 
 import pysolr
 import yaml
-from flask import Flask, request, abort, redirect, url_for
+from flask import Flask, Response, request, abort, redirect, url_for
 from lxml import etree
 # noinspection PyProtectedMember
 from lxml.etree import ElementTree, _ElementTree
 from oai_repo import OAIRepository, OAIRepoInternalException, OAIRepoExternalException
 from oai_repo.response import OAIResponse
+from werkzeug.http import is_resource_modified
 
-from oaipmh import __version__
+from oaipmh import __version__, tracing
+from oaipmh.changes import start_change_feed
 from oaipmh.dataprovider import DataProvider
+from oaipmh.metrics import init_metrics
+from oaipmh.oai import (
+    add_cursor_mark, add_deleted_offset, mark_deleted_records, pop_cursor_mark, pop_deleted_offset,
+)
+from oaipmh.streaming import DeferredMetadata, stream_document
 from oaipmh.solr import Index, DEFAULT_SOLR_CONFIG
 
 
@@ -30,6 +40,46 @@ def status(response: OAIResponse) -> int:
             return HTTPStatus.BAD_REQUEST
 
 
+# verbs whose responses only change when the configuration (or the list of sets) changes
+CONFIG_VERBS = {'Identify', 'ListMetadataFormats', 'ListSets'}
+LIST_VERBS = {'ListIdentifiers', 'ListRecords'}
+
+# WSGI environ key for a page of results prepared in advance for the request (see oaipmh.asgi)
+PREPARED_PAGE_KEY = 'oaipmh.prepared_page'
+
+
+def get_config_hash(data_provider: DataProvider) -> str:
+    """
+    Get a hash of everything that the responses to the Identify,
+    ListMetadataFormats, and ListSets verbs depend on.
+    """
+    state = {
+        'version': __version__,
+        'identify': repr(data_provider.get_identify()),
+        'index': data_provider.index.config,
+        'sets': sorted((spec, conf['name']) for spec, conf in data_provider.index.get_sets().items()),
+        'formats': sorted(repr(f) for f in data_provider.get_metadata_formats()),
+    }
+    return hashlib.sha256(json.dumps(state, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_etag(args: dict[str, str], validator: str) -> str:
+    """
+    Get a weak entity tag for the response to the request with the given
+    arguments. The tag is weak because every response has a different
+    responseDate, even when the rest of the response is the same.
+    """
+    key = json.dumps([sorted(args.items()), validator, __version__])
+    return 'W/"' + hashlib.sha256(key.encode()).hexdigest()[:32] + '"'
+
+
+def add_cache_headers(response: Response, etag: str, last_modified: Optional[datetime], cache_control: str):
+    response.headers['ETag'] = etag
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = cache_control
+
+
 def get_config(config_source: Optional[str | TextIO] = None) -> dict[str, Any]:
     if config_source is None:
         return DEFAULT_SOLR_CONFIG
@@ -51,8 +101,38 @@ def create_app(solr_config_file) -> Flask:
         solr_client=pysolr.Solr(os.environ['SOLR_URL']),
     )
     data_provider = DataProvider(index=index)
+    app.extensions['oaipmh.data_provider'] = data_provider
+    app.extensions['oaipmh.change_feed'] = start_change_feed(data_provider)
+    app.extensions['oaipmh.metrics'] = init_metrics(app, data_provider)
+    app.extensions['oaipmh.tracer'], app.extensions['oaipmh.profiler'] = tracing.init_tracing(app)
     app.logger.debug(f'Initialized the data provider: {data_provider.get_identify()}')
     use_xsl_stylesheet = bool(os.environ.get('XSL_STYLESHEET'))
+    cache_control = os.environ.get('CACHE_CONTROL', 'public, max-age=300')
+    stream_responses = bool(os.environ.get('STREAM_RESPONSES'))
+
+    def get_validators(args: dict[str, str]) -> tuple[Optional[str], Optional[datetime]]:
+        """
+        Get the entity tag and last modified time for the response to a
+        request, if they can be determined before processing the request.
+        """
+        verb = args.get('verb')
+        if verb in CONFIG_VERBS:
+            validator = get_config_hash(data_provider)
+            if verb == 'ListMetadataFormats' and 'identifier' in args and data_provider.index.format_rules:
+                # the formats for a record depend on its Solr document
+                try:
+                    validator += data_provider.get_last_modified(args['identifier']).isoformat()
+                except (ValueError, KeyError, OAIRepoExternalException):
+                    return None, None
+            return get_etag(args, validator), None
+        if verb == 'GetRecord' and 'identifier' in args:
+            try:
+                last_modified = data_provider.get_last_modified(args['identifier'])
+            except (ValueError, KeyError, OAIRepoExternalException):
+                # let the normal request processing report the error
+                return None, None
+            return get_etag(args, last_modified.isoformat()), last_modified
+        return None, None
 
     @app.route('/')
     def root():
@@ -74,28 +154,95 @@ def create_app(solr_config_file) -> Flask:
 
     @app.route('/oai/api')
     def endpoint():
+        args = request.args.copy()
+        data_provider.begin_request(
+            cursor_mark=pop_cursor_mark(args),
+            page=request.environ.get(PREPARED_PAGE_KEY),
+            deleted_offset=pop_deleted_offset(args),
+        )
+        # when streaming, the per-request state is needed until the response body has been written
+        streaming = stream_responses and args.get('verb') in LIST_VERBS
         try:
-            repo = OAIRepository(data_provider)
-            response = repo.process(request.args.copy())
+            etag, last_modified = get_validators(args)
+            if etag is not None and not is_resource_modified(request.environ, etag, last_modified=last_modified):
+                not_modified = Response(status=HTTPStatus.NOT_MODIFIED)
+                add_cache_headers(not_modified, etag, last_modified, cache_control)
+                return not_modified
+
+            repo = OAIRepository(DeferredMetadata(data_provider) if streaming else data_provider)
+            with tracing.span('process'):
+                response = repo.process(args.copy())
         except OAIRepoExternalException as e:
             # An API call timed out or returned a non-200 HTTP code.
             # Log the failure and abort with server HTTP 503.
+            streaming = False
             app.logger.error(f'Upstream error: {e}')
             abort(HTTPStatus.SERVICE_UNAVAILABLE, str(e))
         except OAIRepoInternalException as e:
             # There is a fault in how the DataInterface was implemented.
             # Log the failure and abort with server HTTP 500.
+            streaming = False
             app.logger.error(f'Internal error: {e}')
             abort(HTTPStatus.INTERNAL_SERVER_ERROR)
         else:
-            document: _ElementTree = ElementTree(response.root())
+            add_cursor_mark(response.root(), data_provider.next_cursor_mark)
+            add_deleted_offset(response.root(), data_provider.next_deleted_offset)
+            mark_deleted_records(response.root(), data_provider.deleted_identifiers)
+            if response and args.get('verb') in LIST_VERBS and data_provider.page is not None:
+                # list responses are only as new as the newest record on the page, and
+                # change whenever the records on the page or their set memberships change,
+                # or when the size of the complete list or the resumption token changes
+                page = data_provider.page
+                last_modified = page.last_modified(data_provider.index.last_modified_field)
+                if last_modified is not None:
+                    token = next(response.root().iter('{*}resumptionToken'), None)
+                    page_state = [
+                        last_modified.isoformat(),
+                        {h: sorted(sets) for h, sets in page.sets.items()},
+                        token.get('completeListSize') if token is not None else len(page.handles),
+                        token.text if token is not None else None,
+                    ]
+                    etag = get_etag(args, json.dumps(page_state))
+            stylesheets = []
             if use_xsl_stylesheet:
-                stylesheet = etree.ProcessingInstruction('xml-stylesheet', 'type="text/xsl" href="static/html.xsl"')
+                stylesheets.append(
+                    etree.ProcessingInstruction('xml-stylesheet', 'type="text/xsl" href="static/html.xsl"')
+                )
+
+            if streaming and response:
+                if etag is not None and not is_resource_modified(request.environ, etag, last_modified=last_modified):
+                    streaming = False
+                    not_modified = Response(status=HTTPStatus.NOT_MODIFIED)
+                    add_cache_headers(not_modified, etag, last_modified, cache_control)
+                    return not_modified
+
+                def generate():
+                    try:
+                        with tracing.span('serialize', **{'oaipmh.streamed': True}):
+                            yield from stream_document(response.root(), data_provider.get_record_metadata, stylesheets)
+                    finally:
+                        data_provider.end_request()
+
+                http_response = Response(generate(), status(response), {'Content-Type': 'application/xml'})
+                if etag is not None:
+                    add_cache_headers(http_response, etag, last_modified, cache_control)
+                return http_response
+
+            streaming = False
+            document: _ElementTree = ElementTree(response.root())
+            for stylesheet in stylesheets:
                 document.getroot().addprevious(stylesheet)
-            return (
-                etree.tostring(document, xml_declaration=True, encoding='UTF-8', pretty_print=True),
-                status(response),
-                {'Content-Type': 'application/xml'},
-            )
+            with tracing.span('serialize'):
+                body = etree.tostring(document, xml_declaration=True, encoding='UTF-8', pretty_print=True)
+            http_response = Response(body, status(response), {'Content-Type': 'application/xml'})
+            if response and etag is not None:
+                add_cache_headers(http_response, etag, last_modified, cache_control)
+                http_response.make_conditional(request)
+            return http_response
+        finally:
+            # the page of list results is only valid for this request; a streamed
+            # response discards it once the response body has been written
+            if not streaming:
+                data_provider.end_request()
 
     return app
@@ -1,11 +1,15 @@
+from concurrent.futures import Future
 from unittest.mock import MagicMock
 
+import pysolr
 import pytest
+import requests
 from lxml import etree
 from oai_repo import Set, RecordHeader
 from oai_repo.exceptions import OAIErrorCannotDisseminateFormat, OAIRepoExternalException
 
-from oaipmh.dataprovider import DataProvider
+from oaipmh.cache import Tombstone
+from oaipmh.dataprovider import DELETED_METADATA, DataProvider, ListPaging, merge_deleted
 from oaipmh.oai import OAIIdentifier
 from oaipmh.solr import Index, DEFAULT_SOLR_CONFIG
 
@@ -229,21 +233,25 @@ def test_get_record_metadata_not_found(provider):
 
 
 class MockSolrResult:
+    docs = [
+        {'handle': '1903.1/sample1'},
+        {'handle': '1903.1/sample2'},
+        {'handle': '1903.1/sample3'},
+    ]
+    nextCursorMark = None
+
     @property
     def hits(self):
-        return len(list(self))
+        return len(self.docs)
 
     def __iter__(self):
-        return iter([
-            {'handle': '1903.1/sample1'},
-            {'handle': '1903.1/sample2'},
-            {'handle': '1903.1/sample3'},
-        ])
+        return iter(self.docs)
 
 
 def test_list_identifiers(monkeypatch, provider, mock_solr_client):
     monkeypatch.setenv('OAI_NAMESPACE_IDENTIFIER', 'fcrepo')
     mock_solr_client.search = MagicMock(return_value=MockSolrResult())
+    provider.index.get_sets_for_handles = MagicMock(side_effect=lambda handles: {h: {} for h in handles})
     identifiers, hits, _ = provider.list_identifiers(metadataprefix='oai_dc')
     assert hits == 3
     assert identifiers == [
@@ -251,3 +259,351 @@ def test_list_identifiers(monkeypatch, provider, mock_solr_client):
         'oai:fcrepo:1903.1/sample2',
         'oai:fcrepo:1903.1/sample3',
     ]
+
+
+class MockPageResult:
+    hits = 2
+    nextCursorMark = None
+
+    def __init__(self):
+        self.docs = [
+            {'handle': '1903.1/sample1', 'id': 'http://example.com/1', 'last_modified': '2023-06-16T08:37:29Z'},
+            {'handle': '1903.1/sample2', 'id': 'http://example.com/2', 'last_modified': '2023-06-17T08:37:29Z'},
+        ]
+
+    def __iter__(self):
+        return iter(self.docs)
+
+
+def test_list_records_page_prefetch(monkeypatch, provider, prange_text):
+    monkeypatch.setenv('OAI_NAMESPACE_IDENTIFIER', 'fcrepo')
+    provider.index.get_docs = MagicMock(return_value=MockPageResult())
+    provider.index.get_doc = MagicMock()
+    provider.index.get_sets_for_handle = MagicMock()
+    provider.index.get_sets_for_handles = MagicMock(return_value={
+        '1903.1/sample1': {'foo': {'spec': 'foo', 'name': 'Foo', 'filter': 'title:Foo'}},
+        '1903.1/sample2': {},
+    })
+    provider.session.get = MagicMock(return_value=OKResponse(prange_text))
+    provider._get_uncached_uris = MagicMock(wraps=provider._get_uncached_uris)
+
+    identifiers, hits, _ = provider.list_identifiers(metadataprefix='oai_dc')
+    assert identifiers == ['oai:fcrepo:1903.1/sample1', 'oai:fcrepo:1903.1/sample2']
+
+    header = provider.get_record_header(identifiers[0])
+    assert header.datestamp == '2023-06-16T08:37:29Z'
+    assert list(header.setspecs) == ['foo']
+    assert provider.get_record_metadata(identifiers[0], 'oai_dc') is not None
+    assert provider.get_record_metadata(identifiers[1], 'oai_dc') is not None
+    # each resource on the page is fetched exactly once, and the caches are
+    # checked for the page only once
+    assert provider.session.get.call_count == 2
+    assert provider._get_uncached_uris.call_count == 1
+
+    # no additional Solr requests for the records on the page
+    provider.index.get_doc.assert_not_called()
+    provider.index.get_sets_for_handle.assert_not_called()
+    assert provider.index.get_sets_for_handles.call_count == 1
+
+    provider.end_request()
+    assert provider.page is None
+
+
+def test_list_records_transform_processes(monkeypatch, index_with_auto_sets, prange_text):
+    monkeypatch.setenv('OAI_NAMESPACE_IDENTIFIER', 'fcrepo')
+    monkeypatch.setenv('TRANSFORM_PROCESSES', '2')
+    provider = DataProvider(index=index_with_auto_sets)
+    provider.index.get_docs = MagicMock(return_value=MockPageResult())
+    provider.index.get_sets_for_handles = MagicMock(side_effect=lambda handles: {h: {} for h in handles})
+    provider.session.get = MagicMock(return_value=OKResponse(prange_text))
+    expected = etree.tostring(provider.transform('oai_dc', etree.fromstring(prange_text)))
+
+    try:
+        identifiers, _, _ = provider.list_identifiers(metadataprefix='oai_dc')
+        for identifier in identifiers:
+            assert etree.tostring(provider.get_record_metadata(identifier, 'oai_dc')) == expected
+        assert provider.session.get.call_count == 2
+        # the one transformation in this process, plus one in a worker process for each record
+        assert provider.transform_stats['oai_dc'].count == 3
+        provider.end_request()
+    finally:
+        provider.close()
+
+
+def test_submit_transform_resolves_when_recording_fails(monkeypatch, index_with_auto_sets):
+    provider = DataProvider(index=index_with_auto_sets)
+    done = Future()
+    done.set_result((b'<metadata/>', 0.01))
+    provider._process_pool = MagicMock(submit=MagicMock(return_value=done))
+    monkeypatch.setattr(provider.transform_stats['oai_dc'], 'record', MagicMock(side_effect=RuntimeError))
+
+    assert provider._submit_transform('oai_dc', '<rdf/>').result(timeout=1) == b'<metadata/>'
+
+
+def test_list_identifiers_cursor_paging(monkeypatch, mock_solr_client):
+    monkeypatch.setenv('OAI_NAMESPACE_IDENTIFIER', 'fcrepo')
+    index = Index(config={**DEFAULT_SOLR_CONFIG, 'cursor_paging': True}, solr_client=mock_solr_client)
+    results = MockPageResult()
+    results.nextCursorMark = 'AoE/next'
+    index.get_docs = MagicMock(return_value=results)
+    index.get_sets_for_handles = MagicMock(side_effect=lambda handles: {h: {} for h in handles})
+    provider = DataProvider(index=index)
+
+    provider.begin_request()
+    provider.list_identifiers(metadataprefix='oai_dc')
+    assert index.get_docs.call_args.kwargs['cursor_mark'] == '*'
+    assert provider.next_cursor_mark == 'AoE/next'
+
+    provider.begin_request(cursor_mark='AoE/next')
+    provider.list_identifiers(metadataprefix='oai_dc', cursor=25)
+    assert index.get_docs.call_args.kwargs['cursor_mark'] == 'AoE/next'
+
+    # a token without a cursor mark falls back to offset paging
+    provider.begin_request()
+    provider.list_identifiers(metadataprefix='oai_dc', cursor=25)
+    assert index.get_docs.call_args.kwargs['start'] == 25
+    assert 'cursor_mark' not in index.get_docs.call_args.kwargs
+
+
+def test_list_identifiers_cursor_paging_single_page(monkeypatch, mock_solr_client):
+    monkeypatch.setenv('OAI_NAMESPACE_IDENTIFIER', 'fcrepo')
+    monkeypatch.setenv('PAGE_SIZE', '2')
+    # iterating over real pysolr results would call this to fetch the next page
+    next_page_query = MagicMock(return_value=pysolr.Results({'response': {'numFound': 4, 'docs': []}}))
+    mock_solr_client.search = MagicMock(return_value=pysolr.Results(
+        {
+            'response': {'numFound': 4, 'docs': MockPageResult().docs},
+            'nextCursorMark': 'AoE/next',
+        },
+        next_page_query=next_page_query,
+    ))
+    index = Index(config={**DEFAULT_SOLR_CONFIG, 'cursor_paging': True}, solr_client=mock_solr_client)
+    index.get_sets_for_handles = MagicMock(side_effect=lambda handles: {h: {} for h in handles})
+    provider = DataProvider(index=index)
+
+    provider.begin_request()
+    identifiers, hits, _ = provider.list_identifiers(metadataprefix='oai_dc')
+    assert identifiers == ['oai:fcrepo:1903.1/sample1', 'oai:fcrepo:1903.1/sample2']
+    assert hits == 4
+    assert mock_solr_client.search.call_count == 1
+    next_page_query.assert_not_called()
+
+
+def test_list_identifiers_with_deleted(monkeypatch, tmp_path, mock_solr_client):
+    monkeypatch.setenv('OAI_NAMESPACE_IDENTIFIER', 'fcrepo')
+    monkeypatch.setenv('REPORT_DELETED_RECORDS', 'persistent')
+    monkeypatch.setenv('TOMBSTONE_STORE_PATH', str(tmp_path / 'tombstones.sqlite'))
+    monkeypatch.setenv('PAGE_SIZE', '2')
+    index = Index(config=DEFAULT_SOLR_CONFIG, solr_client=mock_solr_client)
+    index.get_docs = MagicMock(return_value=MockPageResult())
+    index.get_sets_for_handles = MagicMock(side_effect=lambda handles: {h: {} for h in handles})
+    provider = DataProvider(index=index)
+    provider.add_tombstone(Tombstone('1903.1/gone', 'http://example.com/gone', '2023-06-16T12:00:00Z', ('maps',)))
+
+    provider.begin_request()
+    identifiers, hits, _ = provider.list_identifiers(metadataprefix='oai_dc')
+    # merged in datestamp order, and cut off at the page size
+    assert identifiers == ['oai:fcrepo:1903.1/sample1', 'oai:fcrepo:1903.1/gone']
+    assert hits == 3
+    assert index.get_docs.call_args.kwargs['by_datestamp']
+    assert provider.next_deleted_offset == 1
+
+    header = provider.get_record_header('oai:fcrepo:1903.1/gone')
+    assert header.status == 'deleted'
+    assert header.setspecs == ['maps']
+    assert provider.deleted_identifiers == {'oai:fcrepo:1903.1/gone'}
+    assert provider.get_record_metadata('oai:fcrepo:1903.1/gone', 'oai_dc').tag == DELETED_METADATA
+
+    # the next page starts after the one live record listed so far
+    provider.begin_request(deleted_offset=1)
+    provider.list_identifiers(metadataprefix='oai_dc', cursor=2)
+    assert index.get_docs.call_args.kwargs['start'] == 1
+    provider.end_request()
+
+
+def test_list_identifiers_with_deleted_cursor_paging(monkeypatch, tmp_path, mock_solr_client):
+    monkeypatch.setenv('OAI_NAMESPACE_IDENTIFIER', 'fcrepo')
+    monkeypatch.setenv('REPORT_DELETED_RECORDS', 'transient')
+    monkeypatch.setenv('TOMBSTONE_STORE_PATH', str(tmp_path / 'tombstones.sqlite'))
+    monkeypatch.setenv('DELETED_RECORD_RETENTION', '100000')
+    monkeypatch.setenv('PAGE_SIZE', '2')
+    index = Index(config={**DEFAULT_SOLR_CONFIG, 'cursor_paging': True}, solr_client=mock_solr_client)
+    results = MockPageResult()
+    results.nextCursorMark = 'AoE/2'
+    partial = MagicMock(nextCursorMark='AoE/1')
+    index.get_docs = MagicMock(side_effect=[results, partial])
+    index.get_sets_for_handles = MagicMock(side_effect=lambda handles: {h: {} for h in handles})
+    provider = DataProvider(index=index)
+    provider.add_tombstone(Tombstone('1903.1/gone', 'http://example.com/gone', '2023-06-16T12:00:00Z', ()))
+
+    provider.begin_request()
+    provider.list_identifiers(metadataprefix='oai_dc')
+    # only one of the two documents fit on the page, so the cursor mark is after that one
+    assert index.get_docs.call_args.kwargs['rows'] == 1
+    assert index.get_docs.call_args.kwargs['cursor_mark'] == '*'
+    assert provider.next_cursor_mark == 'AoE/1'
+    provider.end_request()
+
+
+def test_list_identifiers_with_deleted_cursor_paging_single_page(monkeypatch, tmp_path, mock_solr_client):
+    monkeypatch.setenv('OAI_NAMESPACE_IDENTIFIER', 'fcrepo')
+    monkeypatch.setenv('REPORT_DELETED_RECORDS', 'persistent')
+    monkeypatch.setenv('TOMBSTONE_STORE_PATH', str(tmp_path / 'tombstones.sqlite'))
+    monkeypatch.setenv('PAGE_SIZE', '2')
+    # iterating over real pysolr results would call this to fetch the next page
+    next_page_query = MagicMock(return_value=pysolr.Results({'response': {'numFound': 4, 'docs': []}}))
+    mock_solr_client.search = MagicMock(return_value=pysolr.Results(
+        {
+            'response': {'numFound': 4, 'docs': MockPageResult().docs},
+            'nextCursorMark': 'AoE/next',
+        },
+        next_page_query=next_page_query,
+    ))
+    index = Index(config={**DEFAULT_SOLR_CONFIG, 'cursor_paging': True}, solr_client=mock_solr_client)
+    index.get_sets_for_handles = MagicMock(side_effect=lambda handles: {h: {} for h in handles})
+    provider = DataProvider(index=index)
+    provider.add_tombstone(Tombstone('1903.1/gone', 'http://example.com/gone', '2023-06-18T12:00:00Z', ()))
+
+    provider.begin_request()
+    identifiers, _, _ = provider.list_identifiers(metadataprefix='oai_dc')
+    assert identifiers == ['oai:fcrepo:1903.1/sample1', 'oai:fcrepo:1903.1/sample2']
+    assert provider.next_cursor_mark == 'AoE/next'
+    assert mock_solr_client.search.call_count == 1
+    next_page_query.assert_not_called()
+    provider.end_request()
+
+
+def test_merge_deleted():
+    docs = [
+        {'handle': 'a', 'last_modified': '2023-06-16T00:00:00Z'},
+        {'handle': 'b', 'last_modified': '2023-06-18T00:00:00Z'},
+    ]
+    tombstones = [Tombstone('c', 'http://example.com/c', '2023-06-16T00:00:00Z', ())]
+    assert merge_deleted(docs, tombstones, 25, 'last_modified') == [docs[0], tombstones[0], docs[1]]
+    assert merge_deleted(docs, tombstones, 2, 'last_modified') == [docs[0], tombstones[0]]
+
+
+def test_list_paging():
+    index = Index(config={**DEFAULT_SOLR_CONFIG, 'cursor_paging': True}, solr_client=MagicMock())
+    docs = [
+        {'handle': 'a', 'id': 'http://example.com/a', 'last_modified': '2023-06-16T00:00:00Z'},
+        {'handle': 'b', 'id': 'http://example.com/b', 'last_modified': '2023-06-18T00:00:00Z'},
+    ]
+    tombstones = [Tombstone('c', 'http://example.com/c', '2023-06-17T00:00:00Z', ())]
+
+    paging = ListPaging(index, 2, 'oai_dc', 4, cursor_mark='AoE', deleted_offset=1, with_deleted=True)
+    assert paging.deleted_offset == 1
+    assert paging.search_params == {'rows': 2, 'metadata_prefix': 'oai_dc', 'by_datestamp': True, 'cursor_mark': 'AoE'}
+
+    paging.merge(docs, 10, 'AoF', tombstones, 3)
+    assert paging.handles == ['a', 'c']
+    assert paging.hits == 13
+    assert paging.next_deleted_offset == 2
+    # only one of the two documents made it onto the page
+    assert paging.next_cursor_mark is None
+    assert paging.resume_params['rows'] == 1
+    assert paging.resume_params['cursor_mark'] == 'AoE'
+
+    paging.merge(docs, 10, 'AoF')
+    assert paging.handles == ['a', 'b']
+    assert paging.next_cursor_mark == 'AoF'
+    assert paging.resume_params is None
+
+
+def test_list_paging_offset():
+    index = Index(config=DEFAULT_SOLR_CONFIG, solr_client=MagicMock())
+
+    # a new list starts with no deleted records listed
+    paging = ListPaging(index, 2, 'oai_dc', 0, deleted_offset=3, with_deleted=True)
+    assert paging.search_params == {'rows': 2, 'metadata_prefix': 'oai_dc', 'by_datestamp': True, 'start': 0}
+
+    paging = ListPaging(index, 2, 'oai_dc', 4, deleted_offset=3, with_deleted=True)
+    assert paging.search_params['start'] == 1
+
+    paging = ListPaging(index, 2, 'oai_dc', 4, deleted_offset=3)
+    assert paging.search_params['start'] == 4
+    paging.merge([], 0, None)
+    assert paging.next_deleted_offset is None
+
+
+def test_get_record_metadata_cached(monkeypatch, tmp_path, index_with_defaults, prange_text):
+    monkeypatch.setenv('METADATA_CACHE_PATH', str(tmp_path / 'metadata.sqlite'))
+    index_with_defaults.get_doc = MagicMock(
+        return_value={'id': 'http://example.com/foo', 'handle': 'foo', 'last_modified': '2023-06-16T08:37:29Z'}
+    )
+    provider = DataProvider(index=index_with_defaults)
+    provider.session.get = MagicMock(return_value=OKResponse(prange_text))
+
+    first = provider.get_record_metadata('oai:fcrepo:foo', 'oai_dc')
+    second = provider.get_record_metadata('oai:fcrepo:foo', 'oai_dc')
+    assert etree.tostring(first) == etree.tostring(second)
+    assert provider.session.get.call_count == 1
+
+    # a new last modified timestamp means the record is fetched again
+    index_with_defaults.get_doc.return_value = {
+        'id': 'http://example.com/foo', 'handle': 'foo', 'last_modified': '2023-06-17T08:37:29Z'
+    }
+    provider.get_record_metadata('oai:fcrepo:foo', 'oai_dc')
+    assert provider.session.get.call_count == 2
+
+
+def test_get_record_metadata_from_record_store(monkeypatch, tmp_path, index_with_defaults):
+    monkeypatch.setenv('RECORD_STORE_PATH', str(tmp_path / 'records.sqlite'))
+    index_with_defaults.get_doc = MagicMock(
+        return_value={'id': 'http://example.com/foo', 'handle': 'foo', 'last_modified': '2023-06-16T08:37:29Z'}
+    )
+    provider = DataProvider(index=index_with_defaults)
+    provider.session.get = MagicMock()
+    provider.record_store.put('foo', 'oai_dc', 'http://example.com/foo', '2023-06-16T08:37:29Z', b'<dc/>')
+
+    assert etree.tostring(provider.get_record_metadata('oai:fcrepo:foo', 'oai_dc')) == b'<dc/>'
+    provider.session.get.assert_not_called()
+    # the stored record is not used once the resource has been modified
+    docs = {'foo': {'id': 'http://example.com/foo', 'handle': 'foo', 'last_modified': '2023-06-17T08:37:29Z'}}
+    assert provider._get_uncached_uris(docs, 'oai_dc') == {'foo': 'http://example.com/foo'}
+
+
+class ResourceResponse:
+    def __init__(self, status_code, text='', headers=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.reason = ''
+        self.text = text
+        self.headers = headers or {}
+
+
+def test_fetch_rdf_conditional(monkeypatch, tmp_path, index_with_defaults, prange_text):
+    monkeypatch.setenv('RESOURCE_CACHE_PATH', str(tmp_path / 'resources.sqlite'))
+    provider = DataProvider(index=index_with_defaults)
+    provider.session.get = MagicMock(return_value=ResourceResponse(
+        200, prange_text, {'ETag': 'W/"abc"', 'Last-Modified': 'Fri, 16 Jun 2023 08:37:29 GMT'}
+    ))
+    assert provider.fetch_rdf('http://example.com/foo') == prange_text
+    assert 'If-None-Match' not in provider.session.get.call_args.kwargs['headers']
+
+    provider.session.get = MagicMock(return_value=ResourceResponse(304))
+    assert provider.fetch_rdf('http://example.com/foo') == prange_text
+    headers = provider.session.get.call_args.kwargs['headers']
+    assert headers['If-None-Match'] == 'W/"abc"'
+    assert headers['If-Modified-Since'] == 'Fri, 16 Jun 2023 08:37:29 GMT'
+
+
+def test_fetch_rdf_connection_error(provider):
+    provider.session.get = MagicMock(side_effect=requests.ConnectionError)
+    with pytest.raises(OAIRepoExternalException):
+        provider.fetch_rdf('http://example.com/foo')
+
+
+def test_get_metadata_formats_for_record(monkeypatch, mock_solr_client):
+    monkeypatch.setenv('OAI_NAMESPACE_IDENTIFIER', 'fcrepo')
+    config = {**DEFAULT_SOLR_CONFIG, 'format_rules': {'oai_dc': {'field': 'component', 'values': ['Issue']}}}
+    index = Index(config=config, solr_client=mock_solr_client)
+    index.get_doc = MagicMock(return_value={'handle': 'foo', 'component': 'Page'})
+    provider = DataProvider(index=index)
+    provider.session.get = MagicMock()
+
+    prefixes = [f.metadata_prefix for f in provider.get_metadata_formats('oai:fcrepo:foo')]
+    assert 'rdf' in prefixes
+    assert 'oai_dc' not in prefixes
+    assert 'oai_dc' in [f.metadata_prefix for f in provider.get_metadata_formats()]
+    provider.session.get.assert_not_called()
@@ -1,6 +1,9 @@
+import time
+from unittest.mock import MagicMock
+
 import pytest
 
-from oaipmh.add_handles import extract_from_path
+from oaipmh.add_handles import Checkpoint, HandleMinter, RateLimiter, extract_from_path
 
 
 @pytest.mark.parametrize(
@@ -27,3 +30,112 @@ def test_extract(fcrepo_path, expected_relpath, expected_uuid):
 def test_extract_failure():
     with pytest.raises(RuntimeError):
         extract_from_path('/foo/bar/no/pairtree')
+
+
+CONFIG = {
+    'HANDLE_URL': 'http://handles.example.com/api/v1',
+    'BASE_URL': 'http://fcrepo.example.com/rest/',
+    'PUBLIC_BASE_URL': 'https://digital.example.com/result/id/',
+    'AUTH': 'token',
+}
+
+
+def repo_id(n):
+    return f'dc/2021/2/27/fb/47/4e/27fb474e-4fef-43f7-bb57-{n:012d}'
+
+
+def uri(n):
+    return CONFIG['BASE_URL'] + repo_id(n)
+
+
+def mock_post(url, json, headers, timeout):
+    n = int(json['repo_id'][-12:])
+    # finish the earlier rows last, to check that the output order is kept
+    time.sleep(0.01 * (5 - n) if n < 5 else 0)
+    if n == 7:
+        return MagicMock(status_code=500)
+    return MagicMock(status_code=200, json=lambda: {'handle_url': f'https://hdl.example.com/1903.1/{n}'})
+
+
+def mock_get(url, params, headers, timeout):
+    if params['repo_id'] == repo_id(3):
+        result = {'exists': True, 'handle_url': 'https://hdl.example.com/1903.1/3'}
+        return MagicMock(status_code=200, json=lambda: result)
+    return MagicMock(status_code=404, json=lambda: {'exists': False})
+
+
+@pytest.fixture
+def minter():
+    minter = HandleMinter(CONFIG, workers=4)
+    minter.session.post = MagicMock(side_effect=mock_post)
+    minter.session.get = MagicMock(side_effect=mock_get)
+    return minter
+
+
+def test_mint_in_order(minter):
+    minter.lookup = True
+    rows = [{'URI': uri(n), 'Handle': ''} for n in range(10)]
+    rows[2]['Handle'] = 'https://hdl.example.com/1903.1/existing'
+    output = list(minter.process(iter(rows)))
+
+    assert [row['URI'] for row in output] == [uri(n) for n in range(10)]
+    assert output[0]['Handle'] == 'https://hdl.example.com/1903.1/0'
+    assert output[2]['Handle'] == 'https://hdl.example.com/1903.1/existing'
+    assert output[3]['Handle'] == 'https://hdl.example.com/1903.1/3'
+    assert output[7]['Handle'] == ''
+    # the item with an existing handle is looked up, but not minted
+    assert minter.session.get.call_count == 9
+    assert minter.session.post.call_count == 8
+    assert (minter.minted, minter.found, minter.skipped, minter.failed) == (7, 1, 1, 1)
+    assert minter.session.post.call_args.kwargs['json']['repo_id'].startswith('dc/2021/2/')
+
+
+def test_checkpoint(tmp_path, minter):
+    path = str(tmp_path / 'checkpoint.csv')
+    with open(path, 'w') as fh:
+        fh.write(f'{repo_id(0)},https://hdl.example.com/1903.1/earlier\n')
+
+    minter.lookup = True
+    minter.checkpoint = Checkpoint(path)
+    output = list(minter.process({'URI': uri(n)} for n in range(3)))
+    minter.checkpoint.close()
+
+    assert output[0]['Handle'] == 'https://hdl.example.com/1903.1/earlier'
+    assert minter.session.get.call_count == 2
+    assert minter.session.post.call_count == 2
+    assert Checkpoint(path).handles == {
+        repo_id(0): 'https://hdl.example.com/1903.1/earlier',
+        repo_id(1): 'https://hdl.example.com/1903.1/1',
+        repo_id(2): 'https://hdl.example.com/1903.1/2',
+    }
+
+
+def test_no_lookup_by_default(minter):
+    output = list(minter.process({'URI': uri(n)} for n in range(4)))
+    assert output[3]['Handle'] == 'https://hdl.example.com/1903.1/3'
+    minter.session.get.assert_not_called()
+    assert minter.minted == 4
+
+
+def test_empty_handle_is_a_failure(tmp_path, minter):
+    path = str(tmp_path / 'checkpoint.csv')
+    minter.checkpoint = Checkpoint(path)
+    minter.session.post = MagicMock(return_value=MagicMock(status_code=200, json=lambda: {'handle_url': None}))
+    output = list(minter.process([{'URI': uri(1)}]))
+    minter.checkpoint.close()
+
+    assert output[0]['Handle'] == ''
+    assert minter.failed == 1
+    checkpoint = Checkpoint(path)
+    assert checkpoint.handles == {}
+    with pytest.raises(ValueError):
+        checkpoint.put(repo_id(1), '')
+    checkpoint.close()
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(rate=100)
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.wait()
+    assert time.monotonic() - start >= 0.04
@@ -0,0 +1,323 @@
+import asyncio
+import threading
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+
+httpx = pytest.importorskip('httpx')
+
+from oaipmh.aio import AsyncDataProvider  # noqa: E402
+from oaipmh.asgi import RESPONSE_QUEUE_SIZE, AsyncApp, get_args  # noqa: E402
+from oaipmh.cache import Tombstone  # noqa: E402
+from oaipmh.dataprovider import DataProvider  # noqa: E402
+from oaipmh.solr import Index, DEFAULT_SOLR_CONFIG  # noqa: E402
+from oaipmh.web import create_app  # noqa: E402
+
+SOLR_URL = 'http://localhost:8983/solr/fcrepo'
+
+RDF = '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"><rdf:Description/></rdf:RDF>'
+
+DOCS = [
+    {'handle': '1903.1/1', 'id': 'http://fcrepo.example.com/1', 'last_modified': '2023-06-16T08:37:29Z'},
+    {'handle': '1903.1/2', 'id': 'http://fcrepo.example.com/2', 'last_modified': '2023-06-17T08:37:29Z'},
+]
+
+
+class MockUpstream:
+    """Mock Solr and fcrepo that records the requests made to them."""
+    def __init__(self, fail_uris=()):
+        self.requests = []
+        self.fail_uris = set(fail_uris)
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests.append(request)
+        if str(request.url).startswith(SOLR_URL):
+            if 'json.facet' in request.url.params:
+                return httpx.Response(200, json={'response': {'numFound': 2, 'docs': []}, 'facets': {}})
+            q = request.url.params['q']
+            docs = [d for d in DOCS if q == '*:*' or q == f'handle:{d["handle"]}']
+            return httpx.Response(200, json={'response': {'numFound': len(docs), 'docs': docs}})
+        if str(request.url) in self.fail_uris:
+            return httpx.Response(500)
+        return httpx.Response(200, text=RDF, headers={'Content-Type': 'application/rdf+xml'})
+
+    @property
+    def fcrepo_requests(self):
+        return [r for r in self.requests if not str(r.url).startswith(SOLR_URL)]
+
+
+@pytest.fixture
+def env(monkeypatch):
+    monkeypatch.setenv('SOLR_URL', SOLR_URL)
+    monkeypatch.setenv('ADMIN_EMAIL', 'admin@example.com')
+    monkeypatch.setenv('BASE_URL', 'http://example.com/oai/api')
+    monkeypatch.setenv('OAI_NAMESPACE_IDENTIFIER', 'fcrepo')
+    monkeypatch.setenv('OAI_REPOSITORY_NAME', 'Test Repository')
+    monkeypatch.setenv('EARLIEST_DATESTAMP', '2014-01-01T00:00:00Z')
+
+
+def get_async_provider(data_provider, upstream):
+    client = httpx.AsyncClient(transport=httpx.MockTransport(upstream))
+    return AsyncDataProvider(data_provider, solr_url=SOLR_URL, client=client)
+
+
+def test_get_args():
+    assert get_args(b'verb=Identify&verb=ListSets&set=') == {'verb': 'Identify', 'set': ''}
+
+
+def test_prepare_list_records(env, mock_solr_client):
+    upstream = MockUpstream()
+    data_provider = DataProvider(index=Index(config=DEFAULT_SOLR_CONFIG, solr_client=mock_solr_client))
+    async_provider = get_async_provider(data_provider, upstream)
+
+    page = asyncio.run(async_provider.prepare({'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'}))
+
+    assert page.hits == 2
+    assert list(page.docs.keys()) == ['1903.1/1', '1903.1/2']
+    assert page.sets == {'1903.1/1': {}, '1903.1/2': {}}
+    assert page.get_rdf('1903.1/1') == RDF
+    assert page.get_rdf('1903.1/2') == RDF
+    assert len(upstream.fcrepo_requests) == 2
+    mock_solr_client.search.assert_not_called()
+
+
+def test_prepare_list_identifiers_does_not_fetch(env, mock_solr_client):
+    upstream = MockUpstream()
+    data_provider = DataProvider(index=Index(config=DEFAULT_SOLR_CONFIG, solr_client=mock_solr_client))
+    async_provider = get_async_provider(data_provider, upstream)
+
+    page = asyncio.run(async_provider.prepare({'verb': 'ListIdentifiers', 'metadataPrefix': 'oai_dc'}))
+
+    assert page.hits == 2
+    assert upstream.fcrepo_requests == []
+
+
+def test_prepare_invalid_request(env, mock_solr_client):
+    upstream = MockUpstream()
+    data_provider = DataProvider(index=Index(config=DEFAULT_SOLR_CONFIG, solr_client=mock_solr_client))
+    async_provider = get_async_provider(data_provider, upstream)
+
+    assert asyncio.run(async_provider.prepare({'verb': 'ListRecords'})) is None
+    assert asyncio.run(async_provider.prepare({'verb': 'Identify'})) is None
+    assert upstream.requests == []
+
+
+def test_prepare_leaves_out_failed_fetches(env, mock_solr_client):
+    upstream = MockUpstream(fail_uris={'http://fcrepo.example.com/2'})
+    data_provider = DataProvider(index=Index(config=DEFAULT_SOLR_CONFIG, solr_client=mock_solr_client))
+    async_provider = get_async_provider(data_provider, upstream)
+
+    page = asyncio.run(async_provider.prepare({'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'}))
+
+    assert page.get_rdf('1903.1/1') == RDF
+    assert page.get_rdf('1903.1/2') is None
+    assert data_provider.session.stats.status_codes[500] == 1
+
+
+def test_prepare_list_with_deleted(env, monkeypatch, tmp_path, mock_solr_client):
+    monkeypatch.setenv('REPORT_DELETED_RECORDS', 'persistent')
+    monkeypatch.setenv('TOMBSTONE_STORE_PATH', str(tmp_path / 'tombstones.sqlite'))
+    upstream = MockUpstream()
+    data_provider = DataProvider(index=Index(config=DEFAULT_SOLR_CONFIG, solr_client=mock_solr_client))
+    data_provider.add_tombstone(Tombstone('1903.1/0', 'http://fcrepo.example.com/0', '2023-06-16T12:00:00Z', ()))
+    async_provider = get_async_provider(data_provider, upstream)
+
+    page = asyncio.run(async_provider.prepare({'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'}))
+
+    assert page.hits == 3
+    assert page.handles == ['1903.1/1', '1903.1/0', '1903.1/2']
+    assert list(page.tombstones.keys()) == ['1903.1/0']
+    assert page.next_deleted_offset == 1
+    assert len(upstream.fcrepo_requests) == 2
+
+
+def test_prepare_keeps_sqlite_off_event_loop(env, monkeypatch, tmp_path, mock_solr_client):
+    monkeypatch.setenv('REPORT_DELETED_RECORDS', 'persistent')
+    monkeypatch.setenv('TOMBSTONE_STORE_PATH', str(tmp_path / 'tombstones.sqlite'))
+    monkeypatch.setenv('RESOURCE_CACHE_PATH', str(tmp_path / 'resources.sqlite'))
+    data_provider = DataProvider(index=Index(config=DEFAULT_SOLR_CONFIG, solr_client=mock_solr_client))
+    async_provider = get_async_provider(data_provider, MockUpstream())
+    threads = set()
+
+    def record_thread(method):
+        def wrapper(*args, **kwargs):
+            threads.add(threading.current_thread())
+            return method(*args, **kwargs)
+        return wrapper
+
+    data_provider.get_deleted = record_thread(data_provider.get_deleted)
+    data_provider.get_tombstone = record_thread(data_provider.get_tombstone)
+    data_provider.resource_cache.get = record_thread(data_provider.resource_cache.get)
+    data_provider.resource_cache.put = record_thread(data_provider.resource_cache.put)
+
+    asyncio.run(async_provider.prepare({'verb': 'ListRecords', 'metadataPrefix': 'oai_dc'}))
+    asyncio.run(async_provider.prepare({
+        'verb': 'GetRecord', 'identifier': 'oai:fcrepo:1903.1/1', 'metadataPrefix': 'oai_dc'
+    }))
+
+    assert threads
+    assert threading.main_thread() not in threads
+
+
+def test_asgi_list_records(env, monkeypatch, mock_solr_client):
+    monkeypatch.setattr('pysolr.Solr', MagicMock(return_value=mock_solr_client))
+    wsgi_app = create_app(solr_config_file=None)
+    data_provider = wsgi_app.extensions['oaipmh.data_provider']
+    data_provider.session.get = MagicMock()
+    upstream = MockUpstream()
+    app = AsyncApp(wsgi_app, get_async_provider(data_provider, upstream), threads=2)
+
+    async def get(url):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://testserver') as client:
+            return await client.get(url)
+
+    response = asyncio.run(get('/oai/api?verb=ListRecords&metadataPrefix=oai_dc'))
+
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == 'application/xml'
+    assert response.text.count('<record>') == 2
+    assert 'ETag' in response.headers
+    # all upstream requests were made by the async data provider
+    mock_solr_client.search.assert_not_called()
+    data_provider.session.get.assert_not_called()
+    assert sorted(str(r.url) for r in upstream.fcrepo_requests) == [
+        'http://fcrepo.example.com/1', 'http://fcrepo.example.com/2'
+    ]
+
+
+def test_asgi_get_record(env, monkeypatch, mock_solr_client):
+    monkeypatch.setattr('pysolr.Solr', MagicMock(return_value=mock_solr_client))
+    wsgi_app = create_app(solr_config_file=None)
+    data_provider = wsgi_app.extensions['oaipmh.data_provider']
+    upstream = MockUpstream()
+    app = AsyncApp(wsgi_app, get_async_provider(data_provider, upstream), threads=2)
+
+    async def get(url):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://testserver') as client:
+            return await client.get(url)
+
+    response = asyncio.run(get('/oai/api?verb=GetRecord&identifier=oai:fcrepo:1903.1/2&metadataPrefix=oai_dc'))
+
+    assert response.status_code == 200
+    assert '<identifier>oai:fcrepo:1903.1/2</identifier>' in response.text
+    mock_solr_client.search.assert_not_called()
+    assert [str(r.url) for r in upstream.fcrepo_requests] == ['http://fcrepo.example.com/2']
+
+
+def test_asgi_error_before_response_start():
+    def wsgi_app(environ, start_response):
+        raise RuntimeError('failed')
+
+    app = AsyncApp(wsgi_app, MagicMock(), threads=1)
+    scope = {
+        'type': 'http', 'method': 'GET', 'path': '/', 'query_string': b'', 'http_version': '1.1', 'headers': [],
+    }
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(app(scope, receive, send))
+
+    assert [m['type'] for m in messages] == ['http.response.start', 'http.response.body']
+    assert messages[0]['status'] == 500
+    assert messages[1]['more_body'] is False
+
+
+def test_asgi_conditional_request_is_not_prepared():
+    def wsgi_app(environ, start_response):
+        start_response('304 Not Modified', [])
+        return []
+
+    data_provider = MagicMock(prepare=AsyncMock())
+    app = AsyncApp(wsgi_app, data_provider, threads=1)
+    scope = {
+        'type': 'http', 'method': 'GET', 'path': '/oai/api', 'http_version': '1.1',
+        'query_string': b'verb=GetRecord&identifier=oai:fcrepo:1903.1/1&metadataPrefix=oai_dc',
+        'headers': [(b'if-none-match', b'"abc"')],
+    }
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(app(scope, receive, send))
+
+    assert messages[0]['status'] == 304
+    data_provider.prepare.assert_not_called()
+
+
+def test_asgi_response_queue_is_bounded():
+    produced = []
+
+    def wsgi_app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        for n in range(RESPONSE_QUEUE_SIZE * 4):
+            produced.append(n)
+            yield b'x'
+
+    app = AsyncApp(wsgi_app, MagicMock(), threads=1)
+    scope = {
+        'type': 'http', 'method': 'GET', 'path': '/', 'query_string': b'', 'http_version': '1.1', 'headers': [],
+    }
+    produced_when_sending = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.body':
+            # a slow client
+            await asyncio.sleep(0.01)
+            produced_when_sending.append(len(produced))
+
+    asyncio.run(app(scope, receive, send))
+
+    assert len(produced) == RESPONSE_QUEUE_SIZE * 4
+    # the worker never got more than a queue's worth of chunks ahead of the client
+    assert max(p - n for n, p in enumerate(produced_when_sending)) <= RESPONSE_QUEUE_SIZE + 2
+
+
+def test_asgi_client_disconnect_stops_worker():
+    produced = []
+    done = threading.Event()
+
+    def wsgi_app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        try:
+            for n in range(RESPONSE_QUEUE_SIZE * 100):
+                produced.append(n)
+                yield b'x'
+        finally:
+            done.set()
+
+    app = AsyncApp(wsgi_app, MagicMock(), threads=1)
+    scope = {
+        'type': 'http', 'method': 'GET', 'path': '/', 'query_string': b'', 'http_version': '1.1', 'headers': [],
+    }
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.body':
+            raise OSError('client disconnected')
+
+    async def run():
+        with pytest.raises(OSError):
+            await app(scope, receive, send)
+        await asyncio.to_thread(done.wait, 5)
+
+    asyncio.run(run())
+
+    assert done.is_set()
+    assert len(produced) < RESPONSE_QUEUE_SIZE * 100
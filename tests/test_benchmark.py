@@ -0,0 +1,108 @@
+import pytest
+
+from oaipmh.benchmark import Benchmark, FakeSolr, ScenarioResult, compare, generate_docs, percentile
+
+
+@pytest.fixture
+def solr():
+    return FakeSolr(generate_docs(10, 2, 'http://localhost:8080/fcrepo/rest'))
+
+
+def test_fake_solr_filters(solr):
+    result = solr.select({
+        'q': ['*:*'],
+        'fq': ['handle:*', 'collection:"Collection 1"', 'last_modified:[2020-01-01T00:02:00Z TO *]'],
+        'fl': ['handle'],
+        'rows': ['2'],
+        'start': ['1'],
+    })
+    assert result['response']['numFound'] == 4
+    assert result['response']['docs'] == [{'handle': '1903.1/5'}, {'handle': '1903.1/7'}]
+
+    with pytest.raises(ValueError):
+        solr.select({'q': ['title:(foo AND bar'], 'rows': ['1']})
+
+
+def test_fake_solr_cursor_mark(solr):
+    handles = []
+    cursor_mark = '*'
+    while True:
+        result = solr.select({'q': ['*:*'], 'rows': ['4'], 'sort': ['id asc'], 'cursorMark': [cursor_mark]})
+        handles.extend(doc['handle'] for doc in result['response']['docs'])
+        if result['nextCursorMark'] == cursor_mark:
+            break
+        cursor_mark = result['nextCursorMark']
+    assert handles == [f'1903.1/{n}' for n in range(10)]
+
+
+def test_fake_solr_filter_cache(solr):
+    params = {'q': ['*:*'], 'fq': ['handle:*', '{!cache=false}last_modified:[2020-01-01T00:02:00Z TO *]']}
+    assert solr.select(params)['response']['numFound'] == 8
+    assert solr.select(params)['response']['numFound'] == 8
+    # only the cacheable filter query is cached
+    assert list(solr.filter_cache.keys()) == ['handle:*']
+    assert (solr.filter_cache_hits, solr.filter_cache_misses) == (1, 1)
+
+    solr.reset()
+    assert solr.filter_cache == {}
+    assert solr.filter_cache_hits == 0
+
+
+def test_fake_solr_facets(solr):
+    result = solr.select({
+        'q': ['*:*'],
+        'fq': ['{!terms f=handle cache=false}1903.1/1,1903.1/2'],
+        'rows': ['0'],
+        'json.facet': [
+            '{"s0": {"type": "query", "q": "collection:\\"Collection 0\\"",'
+            ' "facet": {"handles": {"type": "terms", "field": "handle", "limit": 2}}}}'
+        ],
+    })
+    assert result['response']['docs'] == []
+    assert result['facets']['s0']['handles']['buckets'] == [{'val': '1903.1/2', 'count': 1}]
+
+
+def test_benchmark(monkeypatch):
+    for key in ('SOLR_URL', 'ADMIN_EMAIL', 'BASE_URL', 'EARLIEST_DATESTAMP', 'FCREPO_JWT_TOKEN',
+                'OAI_NAMESPACE_IDENTIFIER', 'OAI_REPOSITORY_NAME'):
+        monkeypatch.delenv(key, raising=False)
+    monkeypatch.setenv('SOLR_URL', '')
+    monkeypatch.setenv('DATESTAMP_GRANULARITY', 'YYYY-MM-DD')
+    monkeypatch.setenv('PAGE_SIZE', '10')
+    benchmark = Benchmark(docs=25, sets=2, cursor_paging=True)
+    try:
+        results = {r.name: r for r in benchmark.run(
+            ['ListIdentifiers', 'ListIdentifiers-from', 'ListRecords', 'ListRecords-set', 'GetRecord'], get_records=3
+        )}
+    finally:
+        benchmark.close()
+
+    assert results['ListIdentifiers'].records == 25
+    assert results['ListIdentifiers'].requests == 3
+    assert results['ListIdentifiers'].fcrepo_calls == 0
+    assert results['ListIdentifiers'].filter_cache_hit_ratio > 0
+    assert results['ListIdentifiers-from'].records == 25
+    assert results['ListRecords'].records == 25
+    assert results['ListRecords'].fcrepo_calls == 25
+    assert results['ListRecords-set'].records == 13
+    assert results['GetRecord'].records == 3
+    assert results['GetRecord'].p50 <= results['GetRecord'].p99
+    assert all(r.rss_growth_mb >= 0 for r in results.values())
+
+
+def test_compare():
+    result = ScenarioResult('ListRecords', records=100, elapsed=1.0, solr_calls=8, fcrepo_calls=100)
+    baseline = {'results': [result.to_dict()]}
+    assert compare([result], baseline, 0.2) == []
+
+    slower = ScenarioResult('ListRecords', records=100, elapsed=2.0, solr_calls=8, fcrepo_calls=200)
+    regressions = compare([slower], baseline, 0.2)
+    assert len(regressions) == 2
+    assert regressions[0].startswith('ListRecords: 50.0 records/s')
+
+
+def test_percentile():
+    values = [float(n) for n in range(1, 101)]
+    assert percentile(values, 0.5) == 50.0
+    assert percentile(values, 0.99) == 99.0
+    assert percentile([], 0.5) == 0.0
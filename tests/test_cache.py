@@ -0,0 +1,108 @@
+import pytest
+
+from oaipmh.cache import MetadataCache, RecordStore, ResourceCache, CachedResource, Tombstone, TombstoneStore
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = MetadataCache(tmp_path / 'metadata.sqlite', max_size=2)
+    yield cache
+    cache.close()
+
+
+def test_get_put(cache):
+    assert cache.get('http://example.com/foo', 'oai_dc', '2023-06-16T08:37:29Z') is None
+    cache.put('http://example.com/foo', 'oai_dc', '2023-06-16T08:37:29Z', b'<dc/>')
+    assert cache.get('http://example.com/foo', 'oai_dc', '2023-06-16T08:37:29Z') == b'<dc/>'
+    assert cache.get('http://example.com/foo', 'rdf', '2023-06-16T08:37:29Z') is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_modified_resource_is_a_miss(cache):
+    cache.put('http://example.com/foo', 'oai_dc', '2023-06-16T08:37:29Z', b'<dc/>')
+    assert cache.contains('http://example.com/foo', 'oai_dc', '2023-06-16T08:37:29Z')
+    assert not cache.contains('http://example.com/foo', 'oai_dc', '2023-06-17T08:37:29Z')
+    assert cache.get('http://example.com/foo', 'oai_dc', '2023-06-17T08:37:29Z') is None
+
+
+def test_lru_eviction(cache):
+    cache.put('http://example.com/a', 'oai_dc', '2023-06-16T08:37:29Z', b'<a/>')
+    cache.put('http://example.com/b', 'oai_dc', '2023-06-16T08:37:29Z', b'<b/>')
+    assert cache.get('http://example.com/a', 'oai_dc', '2023-06-16T08:37:29Z') == b'<a/>'
+    cache.put('http://example.com/c', 'oai_dc', '2023-06-16T08:37:29Z', b'<c/>')
+    assert len(cache) == 2
+    assert not cache.contains('http://example.com/b', 'oai_dc', '2023-06-16T08:37:29Z')
+    assert cache.contains('http://example.com/a', 'oai_dc', '2023-06-16T08:37:29Z')
+
+
+def test_eviction_batched(tmp_path):
+    cache = MetadataCache(tmp_path / 'metadata.sqlite', max_size=200)
+    statements = []
+    cache._connection.set_trace_callback(statements.append)
+    for n in range(300):
+        cache.put(f'http://example.com/{n}', 'oai_dc', '2023-06-16T08:37:29Z', b'<dc/>')
+    # evicted to 1% below the maximum size at a time, so not counted on every insert
+    assert sum('COUNT(*)' in statement for statement in statements) < 100
+    assert 198 <= len(cache) <= 200
+    assert not cache.contains('http://example.com/0', 'oai_dc', '2023-06-16T08:37:29Z')
+    assert cache.contains('http://example.com/299', 'oai_dc', '2023-06-16T08:37:29Z')
+    cache.close()
+
+
+def test_persistent(tmp_path):
+    cache = MetadataCache(tmp_path / 'metadata.sqlite')
+    cache.put('http://example.com/foo', 'oai_dc', '2023-06-16T08:37:29Z', b'<dc/>')
+    cache.close()
+    cache = MetadataCache(tmp_path / 'metadata.sqlite')
+    assert cache.get('http://example.com/foo', 'oai_dc', '2023-06-16T08:37:29Z') == b'<dc/>'
+    cache.invalidate('http://example.com/foo')
+    assert len(cache) == 0
+    cache.close()
+
+
+def test_resource_cache(tmp_path):
+    cache = ResourceCache(tmp_path / 'resources.sqlite')
+    assert cache.get('http://example.com/foo') is None
+    cache.put('http://example.com/foo', 'W/"abc"', 'Fri, 16 Jun 2023 08:37:29 GMT', '<rdf:RDF/>')
+    resource = cache.get('http://example.com/foo')
+    assert resource == CachedResource('W/"abc"', 'Fri, 16 Jun 2023 08:37:29 GMT', '<rdf:RDF/>')
+    cache.touch('http://example.com/foo')
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.close()
+
+
+def test_record_store(tmp_path):
+    store = RecordStore(tmp_path / 'records.sqlite')
+    assert store.get_checkpoint() is None
+    store.put('1903.1/1', 'oai_dc', 'http://example.com/foo', '2023-06-16T08:37:29Z', b'<dc/>')
+    assert store.contains('1903.1/1', 'oai_dc', '2023-06-16T08:37:29Z')
+    assert not store.contains('1903.1/1', 'oai_dc', '2023-06-17T08:37:29Z')
+    assert store.get('1903.1/1', 'oai_dc', '2023-06-16T08:37:29Z') == b'<dc/>'
+    assert store.get('1903.1/1', 'mods', '2023-06-16T08:37:29Z') is None
+    store.set_checkpoint('2023-06-16T08:37:29Z')
+    store.close()
+
+    store = RecordStore(tmp_path / 'records.sqlite')
+    assert store.get_checkpoint() == '2023-06-16T08:37:29Z'
+    assert store.get('1903.1/1', 'oai_dc', '2023-06-16T08:37:29Z') == b'<dc/>'
+    store.close()
+
+
+def test_tombstone_store(tmp_path):
+    store = TombstoneStore(tmp_path / 'tombstones.sqlite')
+    store.put(Tombstone('1903.1/3', 'http://example.com/3', '2023-06-18T00:00:00Z', ('maps',)))
+    store.put(Tombstone('1903.1/1', 'http://example.com/1', '2023-06-16T00:00:00Z', ('maps', 'prange')))
+    store.put(Tombstone('1903.1/2', 'http://example.com/2', '2023-06-17T00:00:00Z', ()))
+
+    assert [t.handle for t in store.find()] == ['1903.1/1', '1903.1/2', '1903.1/3']
+    assert [t.handle for t in store.find(offset=1, limit=1)] == ['1903.1/2']
+    assert [t.handle for t in store.find(filter_from='2023-06-17T00:00:00Z')] == ['1903.1/2', '1903.1/3']
+    assert [t.handle for t in store.find(filter_until='2023-06-17T00:00:00Z')] == ['1903.1/1', '1903.1/2']
+    assert [t.handle for t in store.find(filter_set='maps')] == ['1903.1/1', '1903.1/3']
+    assert store.count(filter_set='prange') == 1
+    assert store.get('1903.1/1').setspecs == ('maps', 'prange')
+
+    store.invalidate('http://example.com/3')
+    store.prune('2023-06-17T00:00:00Z')
+    assert [t.handle for t in store.find()] == ['1903.1/2']
+    store.close()
@@ -0,0 +1,140 @@
+import json
+from unittest.mock import MagicMock
+
+import pytest
+
+from oaipmh.changes import ChangeEvent, ChangeFeedConsumer, JSONLinesSource, get_source
+from oaipmh.dataprovider import DataProvider
+from oaipmh.solr import Index, DEFAULT_SOLR_CONFIG
+
+RDF = '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"><rdf:Description/></rdf:RDF>'
+
+DOC = {'handle': '1903.1/1', 'id': 'http://example.com/1', 'last_modified': '2023-06-16T08:37:29Z'}
+
+
+def message(uri, event_type='Update', resource_types=()):
+    return {
+        'id': 'urn:uuid:8f0b6c41-0000-0000-0000-000000000000',
+        'type': [event_type],
+        'object': {'id': uri, 'type': list(resource_types)},
+    }
+
+
+@pytest.fixture
+def provider(monkeypatch, tmp_path, mock_solr_client):
+    monkeypatch.setenv('CHANGE_FEED_DELAY', '0')
+    monkeypatch.setenv('METADATA_CACHE_PATH', str(tmp_path / 'cache.sqlite'))
+    monkeypatch.setenv('RESOURCE_CACHE_PATH', str(tmp_path / 'cache.sqlite'))
+    return DataProvider(index=Index(config=DEFAULT_SOLR_CONFIG, solr_client=mock_solr_client))
+
+
+def write_feed(path, messages):
+    with open(path, 'w') as fh:
+        for m in messages:
+            fh.write(json.dumps(m) + '\n')
+        fh.write('not json\n')
+    return JSONLinesSource(str(path), follow=False)
+
+
+def test_parse_event():
+    event = ChangeEvent.from_message(
+        message('http://example.com/1#title', 'Create', ['http://pcdm.org/models#Collection'])
+    )
+    assert event.uri == 'http://example.com/1'
+    assert event.is_collection
+    assert not event.is_delete
+    assert ChangeEvent.from_message({'type': 'Delete', 'object': 'http://example.com/2'}).is_delete
+    assert ChangeEvent.from_message({'type': 'Update'}) is None
+
+
+def test_get_source():
+    assert get_source('file:///var/log/fcrepo/events.jsonl').path == '/var/log/fcrepo/events.jsonl'
+    assert get_source('events.jsonl').path == 'events.jsonl'
+
+
+def test_invalidate(tmp_path, provider):
+    index = provider.index
+    index.doc_cache.put('1903.1/1', DOC)
+    index.doc_cache.put('1903.1/2', {**DOC, 'handle': '1903.1/2', 'id': 'http://example.com/2'})
+    provider.metadata_cache.put('http://example.com/1', 'oai_dc', DOC['last_modified'], b'<dc/>')
+    provider.resource_cache.put('http://example.com/1', 'W/"abc"', None, RDF)
+    index.set_registry.refresh_in_background = MagicMock()
+
+    consumer = ChangeFeedConsumer(provider, write_feed(tmp_path / 'events.jsonl', [
+        message('http://example.com/1'),
+        message('http://example.com/1#title'),
+    ]))
+    consumer.run()
+
+    assert index.doc_cache.get('1903.1/1') is None
+    assert index.doc_cache.get('1903.1/2') is not None
+    assert not provider.metadata_cache.contains('http://example.com/1', 'oai_dc', DOC['last_modified'])
+    assert provider.resource_cache.get('http://example.com/1') is None
+    index.set_registry.refresh_in_background.assert_not_called()
+    assert consumer.stats.events == 2
+    assert consumer.stats.invalidated_docs == 1
+
+
+def test_collection_change_refreshes_sets(tmp_path, provider):
+    provider.index.set_registry.refresh_in_background = MagicMock()
+    consumer = ChangeFeedConsumer(provider, write_feed(tmp_path / 'events.jsonl', [
+        message('http://example.com/c', resource_types=['http://pcdm.org/models#Collection']),
+    ]))
+    consumer.run()
+    provider.index.set_registry.refresh_in_background.assert_called_once()
+
+
+def test_rewarm(monkeypatch, tmp_path, provider, mock_solr_client):
+    monkeypatch.setenv('CHANGE_FEED_REWARM', 'yes')
+    # long enough for all the events to be received before the first is applied
+    monkeypatch.setenv('CHANGE_FEED_DELAY', '0.2')
+    mock_solr_client.search.return_value = MagicMock(docs=[DOC], __len__=lambda _: 1)
+    provider.fetch_rdf = MagicMock(return_value=RDF)
+
+    consumer = ChangeFeedConsumer(provider, write_feed(tmp_path / 'events.jsonl', [
+        message('http://example.com/1'),
+        message('http://example.com/1'),
+        message('http://example.com/2', 'Delete'),
+    ]))
+    consumer.run()
+
+    assert mock_solr_client.search.call_args.kwargs['q'] == 'id:"http://example.com/1"'
+    # the duplicate event for the same change is skipped, and deletions are not re-fetched
+    provider.fetch_rdf.assert_called_once_with('http://example.com/1')
+    assert consumer.stats.rewarmed == 1
+    assert provider.metadata_cache.contains('http://example.com/1', 'oai_dc', DOC['last_modified'])
+    assert provider.index.doc_cache.get('1903.1/1') == DOC
+
+
+def test_deletion_records_tombstone(monkeypatch, tmp_path, provider, mock_solr_client):
+    monkeypatch.setenv('TOMBSTONE_STORE_PATH', str(tmp_path / 'tombstones.sqlite'))
+    provider = DataProvider(index=provider.index)
+    mock_solr_client.search.return_value = MagicMock(docs=[DOC], __len__=lambda _: 1)
+    provider.index.get_sets_for_handles = MagicMock(return_value={'1903.1/1': {'maps': {}}})
+
+    consumer = ChangeFeedConsumer(provider, write_feed(tmp_path / 'events.jsonl', [
+        {**message('http://example.com/1', 'Delete'), 'published': '2023-06-20T10:00:00.123-04:00'},
+    ]))
+    consumer.run()
+    tombstone = provider.tombstone_store.get('1903.1/1')
+    assert tombstone.datestamp == '2023-06-20T14:00:00Z'
+    assert tombstone.setspecs == ('maps',)
+
+    # re-creating the resource removes its tombstone
+    consumer = ChangeFeedConsumer(provider, write_feed(tmp_path / 'events.jsonl', [
+        message('http://example.com/1', 'Create'),
+    ]))
+    consumer.run()
+    assert provider.tombstone_store.get('1903.1/1') is None
+
+
+def test_unexpected_error_does_not_stop_consumer(tmp_path, provider):
+    consumer = ChangeFeedConsumer(provider, write_feed(tmp_path / 'events.jsonl', [
+        message('http://example.com/1'),
+        message('http://example.com/2'),
+    ]))
+    consumer.apply = MagicMock(side_effect=[KeyError('handle'), None])
+    consumer.run()
+
+    assert consumer.apply.call_count == 2
+    assert consumer.stats.errors == 1
@@ -0,0 +1,53 @@
+from unittest.mock import MagicMock
+
+import pytest
+from requests import ConnectionError, Session
+
+from oaipmh.fcrepo import FcrepoClient, RequestStats
+
+
+def test_request_stats():
+    stats = RequestStats()
+    assert stats.mean_time == 0.0
+    stats.record(0.5, 200)
+    stats.record(1.5, 200)
+    stats.record(1.0, None)
+    assert stats.count == 3
+    assert stats.mean_time == 1.0
+    assert stats.max_time == 1.5
+    assert stats.status_codes == {200: 2, None: 1}
+
+
+def test_client_configuration(monkeypatch):
+    monkeypatch.setenv('FCREPO_POOL_SIZE', '20')
+    monkeypatch.setenv('FCREPO_RETRIES', '5')
+    client = FcrepoClient(default_pool_size=4)
+    adapter = client.get_adapter('http://fcrepo-local:8080/fcrepo/rest/')
+    assert adapter._pool_maxsize == 20
+    assert adapter.max_retries.total == 5
+    assert 503 in adapter.max_retries.status_forcelist
+
+
+def test_client_default_pool_size():
+    client = FcrepoClient(default_pool_size=12)
+    assert client.get_adapter('https://fcrepo.example.com/')._pool_maxsize == 12
+
+
+def test_client_request_timeout_and_stats(monkeypatch):
+    monkeypatch.setenv('FCREPO_CONNECT_TIMEOUT', '2')
+    monkeypatch.setenv('FCREPO_READ_TIMEOUT', '10')
+    response = MagicMock(status_code=200)
+    monkeypatch.setattr(Session, 'request', MagicMock(return_value=response))
+    client = FcrepoClient()
+    assert client.get('http://fcrepo-local:8080/fcrepo/rest/foo') is response
+    assert Session.request.call_args.kwargs['timeout'] == (2.0, 10.0)
+    assert client.stats.count == 1
+    assert client.stats.status_codes[200] == 1
+
+
+def test_client_request_error_stats(monkeypatch):
+    monkeypatch.setattr(Session, 'request', MagicMock(side_effect=ConnectionError))
+    client = FcrepoClient()
+    with pytest.raises(ConnectionError):
+        client.get('http://fcrepo-local:8080/fcrepo/rest/foo')
+    assert client.stats.status_codes[None] == 1
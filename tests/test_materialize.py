@@ -0,0 +1,97 @@
+from unittest.mock import MagicMock
+
+import pytest
+from lxml import etree
+from oai_repo import OAIRepoExternalException, OAIRepoInternalException
+
+from oaipmh.dataprovider import DataProvider
+from oaipmh.materialize import Materializer
+from oaipmh.solr import Index, DEFAULT_SOLR_CONFIG
+
+RDF = (
+    '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"'
+    ' xmlns:dcterms="http://purl.org/dc/terms/">'
+    '<rdf:Description><dcterms:title>Foo</dcterms:title></rdf:Description>'
+    '</rdf:RDF>'
+)
+
+DOCS = [
+    {'handle': '1903.1/1', 'id': 'http://example.com/1', 'last_modified': '2023-06-16T08:37:29Z'},
+    {'handle': '1903.1/2', 'id': 'http://example.com/2', 'last_modified': '2023-06-17T08:37:29Z'},
+    {'handle': '1903.1/3', 'id': 'http://example.com/3', 'last_modified': '2023-06-18T08:37:29Z'},
+]
+
+
+class SearchResults:
+    def __init__(self, docs, next_cursor_mark):
+        self.docs = docs
+        self.nextCursorMark = next_cursor_mark
+
+
+def search(**kwargs):
+    """Two documents per page, in the order they appear in DOCS."""
+    start = 0 if kwargs['cursorMark'] == '*' else int(kwargs['cursorMark'])
+    docs = DOCS[start:start + 2]
+    return SearchResults(docs, str(start + len(docs)))
+
+
+@pytest.fixture
+def provider(monkeypatch, tmp_path, mock_solr_client):
+    monkeypatch.setenv('RECORD_STORE_PATH', str(tmp_path / 'records.sqlite'))
+    mock_solr_client.search.side_effect = search
+    provider = DataProvider(index=Index(config=DEFAULT_SOLR_CONFIG, solr_client=mock_solr_client))
+    provider.fetch_rdf = MagicMock(return_value=RDF)
+    return provider
+
+
+def test_requires_record_store(mock_solr_client):
+    with pytest.raises(OAIRepoInternalException):
+        Materializer(DataProvider(index=Index(config=DEFAULT_SOLR_CONFIG, solr_client=mock_solr_client)))
+
+
+def test_materialize(provider, mock_solr_client):
+    materializer = Materializer(provider, prefixes=['oai_dc', 'rdf'], batch_size=2, workers=2)
+
+    stats = materializer.run()
+    assert (stats.docs, stats.stored, stats.skipped, stats.excluded, stats.failed) == (3, 6, 0, 0, 0)
+    assert provider.fetch_rdf.call_count == 3
+    record = etree.fromstring(provider.record_store.get('1903.1/2', 'oai_dc', '2023-06-17T08:37:29Z'))
+    assert record.tag == '{http://www.openarchives.org/OAI/2.0/oai_dc/}dc'
+    assert provider.record_store.get_checkpoint() == '2023-06-18T08:37:29Z'
+
+    query = mock_solr_client.search.call_args.kwargs
+    assert query['sort'] == 'last_modified asc, id asc'
+    assert query['rows'] == 2
+
+    # the next run resumes from the checkpoint, and skips what is already stored
+    stats = materializer.run()
+    assert '{!cache=false}last_modified:[2023-06-18T08:37:29Z TO *]' in mock_solr_client.search.call_args.kwargs['fq']
+    assert (stats.stored, stats.skipped, stats.excluded) == (0, 6, 0)
+    assert provider.fetch_rdf.call_count == 3
+
+
+def test_format_rule_exclusions_are_not_skips(provider):
+    format_rules = {'rdf': {'field': 'handle', 'values': ['1903.1/1']}}
+    provider.index.config = {**DEFAULT_SOLR_CONFIG, 'format_rules': format_rules}
+    materializer = Materializer(provider, prefixes=['oai_dc', 'rdf'], batch_size=2, workers=2)
+
+    stats = materializer.run()
+    assert (stats.docs, stats.stored, stats.skipped, stats.excluded) == (3, 4, 0, 2)
+
+    stats = materializer.run(since=DOCS[0]['last_modified'])
+    assert (stats.docs, stats.stored, stats.skipped, stats.excluded) == (3, 0, 4, 2)
+
+
+def test_checkpoint_stays_before_failure(provider):
+    def fetch_rdf(uri):
+        if uri == 'http://example.com/2':
+            raise OAIRepoExternalException('Unable to retrieve resource from fcrepo')
+        return RDF
+
+    provider.fetch_rdf = MagicMock(side_effect=fetch_rdf)
+    materializer = Materializer(provider, prefixes=['oai_dc'], batch_size=2, workers=2)
+
+    stats = materializer.run()
+    assert (stats.docs, stats.stored, stats.failed) == (3, 2, 1)
+    assert provider.record_store.contains('1903.1/3', 'oai_dc', '2023-06-18T08:37:29Z')
+    assert provider.record_store.get_checkpoint() == '2023-06-17T08:37:29Z'
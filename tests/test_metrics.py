@@ -0,0 +1,76 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from oaipmh.oai import encode_resumption_token
+from oaipmh.web import create_app
+
+pytest.importorskip('prometheus_client')
+
+
+@pytest.fixture
+def app(monkeypatch, mock_solr_client):
+    monkeypatch.setenv('METRICS', 'yes')
+    monkeypatch.setenv('SOLR_URL', mock_solr_client.url)
+    monkeypatch.setenv('ADMIN_EMAIL', 'admin@example.com')
+    monkeypatch.setenv('BASE_URL', 'http://example.com/oai/api')
+    monkeypatch.setenv('OAI_NAMESPACE_IDENTIFIER', 'fcrepo')
+    monkeypatch.setenv('OAI_REPOSITORY_NAME', 'Test Repository')
+    monkeypatch.setenv('EARLIEST_DATESTAMP', '2014-01-01T00:00:00Z')
+    monkeypatch.setattr('pysolr.Solr', MagicMock(return_value=mock_solr_client))
+    return create_app(solr_config_file=None)
+
+
+def get_sample(app, name, **labels):
+    return app.extensions['oaipmh.metrics'].registry.get_sample_value(name, labels)
+
+
+def test_metrics_disabled(monkeypatch, app):
+    monkeypatch.delenv('METRICS')
+    assert create_app(solr_config_file=None).extensions['oaipmh.metrics'] is None
+
+
+def test_request_metrics(app, mock_solr_client):
+    doc = {'handle': 'foo', 'id': 'http://example.com/foo', 'last_modified': '2023-06-16T08:37:29Z'}
+    results = MagicMock(docs=[doc])
+    mock_solr_client.search = MagicMock(return_value=results)
+    client = app.test_client()
+    client.get('/oai/api?verb=Identify')
+    client.get('/oai/api?verb=ListIdentifiers&metadataPrefix=oai_dc')
+    client.get('/oai/api?verb=NotAVerb&metadataPrefix=made_up')
+
+    assert get_sample(app, 'oaipmh_requests_total', verb='Identify', metadata_prefix='', status='200') == 1
+    assert get_sample(app, 'oaipmh_requests_total', verb='unknown', metadata_prefix='', status='400') == 1
+    assert get_sample(app, 'oaipmh_request_duration_seconds_count', verb='Identify', metadata_prefix='') == 1
+    assert get_sample(app, 'oaipmh_requests_in_progress', verb='Identify') == 0
+    assert get_sample(
+        app, 'oaipmh_request_duration_seconds_count', verb='ListIdentifiers', metadata_prefix='oai_dc'
+    ) == 1
+    assert get_sample(app, 'oaipmh_solr_query_duration_seconds_count', method='get_docs') == 1
+    assert get_sample(app, 'oaipmh_cache_hit_ratio', cache='documents') == 0
+
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert b'oaipmh_request_duration_seconds_bucket' in response.data
+    # the metrics endpoint does not count as an OAI-PMH request
+    assert get_sample(app, 'oaipmh_requests_total', verb='unknown', metadata_prefix='', status='200') is None
+
+
+def test_labels_from_resumption_token(app):
+    metrics = app.extensions['oaipmh.metrics']
+    token = encode_resumption_token({'metadataPrefix': 'oai_dc', 'cursor': '25'})
+    assert metrics.get_labels({'verb': 'ListRecords', 'resumptionToken': token}) == ('ListRecords', 'oai_dc')
+    assert metrics.get_labels({'verb': 'ListRecords', 'resumptionToken': '!!'}) == ('ListRecords', '')
+
+
+def test_upstream_metrics(app):
+    data_provider = app.extensions['oaipmh.data_provider']
+    data_provider.session.stats.record(0.2, 200)
+    data_provider.session.stats.record(1.5, None)
+    data_provider.transform_stats['oai_dc'].record(0.01, error=True)
+
+    assert get_sample(app, 'oaipmh_fcrepo_request_duration_seconds_count') == 2
+    assert get_sample(app, 'oaipmh_fcrepo_responses_total', status='200') == 1
+    assert get_sample(app, 'oaipmh_fcrepo_responses_total', status='none') == 1
+    assert get_sample(app, 'oaipmh_transform_duration_seconds_count', format='oai_dc') == 1
+    assert get_sample(app, 'oaipmh_transform_errors_total', format='oai_dc') == 1
@@ -1,6 +1,10 @@
 import pytest
+from lxml import etree
 
-from oaipmh.oai import OAIIdentifier, get_set_spec
+from oaipmh.oai import (
+    OAIIdentifier, get_set_spec, encode_resumption_token, decode_resumption_token, add_cursor_mark,
+    pop_cursor_mark, CURSOR_MARK_KEY, add_deleted_offset, pop_deleted_offset, mark_deleted_records,
+)
 
 
 def test_oai_identifier_parse_invalid():
@@ -33,3 +37,71 @@ def test_oai_identifier_parse(identifier_string, namespace_identifier, local_ide
 )
 def test_get_set_spec(title, expected):
     assert get_set_spec(title) == expected
+
+
+def test_resumption_token_round_trip():
+    token = encode_resumption_token({'metadataPrefix': 'oai_dc', 'c': '25'})
+    assert decode_resumption_token(token) == {'metadataPrefix': 'oai_dc', 'c': '25'}
+
+
+def test_decode_invalid_resumption_token():
+    with pytest.raises(ValueError):
+        decode_resumption_token('not a token!')
+
+
+def test_cursor_mark_in_resumption_token():
+    root = etree.fromstring(
+        '<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><ListIdentifiers>'
+        f'<resumptionToken cursor="0">{encode_resumption_token({"metadataPrefix": "oai_dc", "c": "0"})}'
+        '</resumptionToken></ListIdentifiers></OAI-PMH>'
+    )
+    add_cursor_mark(root, 'AoE/abc+123=')
+    token = root.find('.//{*}resumptionToken').text
+    assert decode_resumption_token(token)[CURSOR_MARK_KEY] == 'AoE/abc+123='
+
+    args = {'verb': 'ListIdentifiers', 'resumptionToken': token}
+    assert pop_cursor_mark(args) == 'AoE/abc+123='
+    assert decode_resumption_token(args['resumptionToken']) == {'metadataPrefix': 'oai_dc', 'c': '0'}
+
+
+@pytest.mark.parametrize(
+    'args',
+    [
+        {'verb': 'ListIdentifiers'},
+        {'verb': 'ListIdentifiers', 'resumptionToken': 'not a token!'},
+        {'verb': 'ListIdentifiers', 'resumptionToken': encode_resumption_token({'c': '0'})},
+    ]
+)
+def test_pop_cursor_mark_without_cursor_mark(args):
+    original = dict(args)
+    assert pop_cursor_mark(args) is None
+    assert args == original
+
+
+def test_deleted_offset():
+    args = {'resumptionToken': encode_resumption_token({'metadataPrefix': 'oai_dc', 'cursor': '25', 'd': '3'})}
+    assert pop_deleted_offset(args) == 3
+    assert decode_resumption_token(args['resumptionToken']) == {'metadataPrefix': 'oai_dc', 'cursor': '25'}
+    assert pop_deleted_offset(args) == 0
+
+    root = etree.fromstring(
+        '<OAI-PMH><ListIdentifiers><resumptionToken>'
+        + args['resumptionToken'] + '</resumptionToken></ListIdentifiers></OAI-PMH>'
+    )
+    add_deleted_offset(root, 5)
+    assert decode_resumption_token(root.find('.//resumptionToken').text)['d'] == '5'
+
+
+def test_mark_deleted_records():
+    root = etree.fromstring(
+        '<OAI-PMH><ListRecords>'
+        '<record><header><identifier>oai:fcrepo:1</identifier></header><metadata><dc/></metadata></record>'
+        '<record><header><identifier>oai:fcrepo:2</identifier></header><metadata><dc/></metadata></record>'
+        '</ListRecords></OAI-PMH>'
+    )
+    mark_deleted_records(root, {'oai:fcrepo:2'})
+    live, deleted = root.findall('.//record')
+    assert live.find('header').get('status') is None
+    assert live.find('metadata') is not None
+    assert deleted.find('header').get('status') == 'deleted'
+    assert deleted.find('metadata') is None
@@ -5,7 +5,7 @@ import pysolr
 import pytest
 from oai_repo import OAIRepoExternalException, OAIRepoInternalException
 
-from oaipmh.solr import solr_date_range, Index, DEFAULT_SOLR_CONFIG
+from oaipmh.solr import solr_date_range, set_facet_name, Index, DEFAULT_SOLR_CONFIG, DocumentCache
 
 
 @pytest.mark.parametrize(
@@ -41,6 +41,15 @@ def test_solr_date_range(timestamp_from, timestamp_until, expected):
     assert date_range == expected
 
 
+def test_solr_date_range_rounded():
+    assert solr_date_range(
+        datetime.fromisoformat('2023-01-31T12:34:56'), datetime.fromisoformat('2023-06-15T01:02:03'), round_to_days=True
+    ) == '[2023-01-31T00:00:00Z TO 2023-06-16T00:00:00Z]'
+    assert solr_date_range(datetime.fromisoformat('2023-01-31'), None, round_to_days=True) == (
+        '[2023-01-31T00:00:00Z TO *]'
+    )
+
+
 def test_index_with_solr_client(mock_solr_client):
     index = Index(config=DEFAULT_SOLR_CONFIG, solr_client=mock_solr_client)
     assert index.solr is mock_solr_client
@@ -104,9 +113,15 @@ def test_get_set(mock_solr_client):
     assert set_conf['filter'] == 'title:Foo'
 
 
-def test_get_sets_for_handle(mock_solr_client):
-    mock_solr_client.search = MagicMock(side_effect=[[], {'id': 'bar'}, []])
-    index = Index(
+def sets_facet_result(facets):
+    results = MagicMock()
+    results.raw_response = {'facets': facets}
+    return results
+
+
+@pytest.fixture
+def index_with_sets(mock_solr_client):
+    return Index(
         config={
             **DEFAULT_SOLR_CONFIG,
             'sets': [
@@ -117,6 +132,258 @@ def test_get_sets_for_handle(mock_solr_client):
         },
         solr_client=mock_solr_client,
     )
-    sets = index.get_sets_for_handle('some/handle')
+
+
+def test_get_sets_for_handle(mock_solr_client, index_with_sets):
+    mock_solr_client.search = MagicMock(return_value=sets_facet_result({
+        'count': 1,
+        set_facet_name('foo'): {'count': 0},
+        set_facet_name('bar'): {'count': 1, 'handles': {'buckets': [{'val': 'some/handle', 'count': 1}]}},
+        set_facet_name('baz'): {'count': 0},
+    }))
+    sets = index_with_sets.get_sets_for_handle('some/handle')
     assert len(sets) == 1
     assert sets.keys() == {'bar'}
+    assert mock_solr_client.search.call_count == 1
+
+
+def test_get_sets_for_handles(mock_solr_client, index_with_sets):
+    mock_solr_client.search = MagicMock(return_value=sets_facet_result({
+        'count': 3,
+        set_facet_name('foo'): {
+            'count': 2,
+            'handles': {'buckets': [{'val': 'a', 'count': 1}, {'val': 'b', 'count': 1}]},
+        },
+        set_facet_name('bar'): {'count': 1, 'handles': {'buckets': [{'val': 'b', 'count': 1}]}},
+        set_facet_name('baz'): {'count': 0},
+    }))
+    sets_by_handle = index_with_sets.get_sets_for_handles(['a', 'b', 'c'])
+    assert sets_by_handle['a'].keys() == {'foo'}
+    assert sets_by_handle['b'].keys() == {'foo', 'bar'}
+    assert sets_by_handle['c'] == {}
+    assert mock_solr_client.search.call_count == 1
+    assert mock_solr_client.search.call_args.kwargs['fq'] == '{!terms f=handle cache=false}a,b,c'
+
+
+def test_get_sets_for_handles_registry_refreshed(mock_solr_client, index_with_sets):
+    facets = {
+        'count': 1,
+        set_facet_name('foo'): {'count': 1, 'handles': {'buckets': [{'val': 'h', 'count': 1}]}},
+        set_facet_name('bar'): {'count': 0},
+        set_facet_name('baz'): {'count': 0},
+    }
+    index_with_sets.get_sets()
+
+    def search(**_kwargs):
+        # the set registry is refreshed while the search is running
+        index_with_sets.set_registry._sets = {
+            'new': {'spec': 'new', 'name': 'New!', 'filter': 'title:New'},
+            **{spec: conf for spec, conf in index_with_sets.set_registry._sets.items() if spec != 'foo'},
+        }
+        return sets_facet_result(facets)
+
+    mock_solr_client.search = MagicMock(side_effect=search)
+    assert index_with_sets.get_sets_for_handles(['h'])['h'].keys() == {'foo'}
+
+
+def test_get_sets_for_handles_no_sets(mock_solr_client):
+    index = Index(config=DEFAULT_SOLR_CONFIG, solr_client=mock_solr_client)
+    assert index.get_sets_for_handles(['a']) == {'a': {}}
+    mock_solr_client.search.assert_not_called()
+
+
+def test_set_registry_caches_sets(mock_solr_client):
+    mock_solr_client.search = MagicMock(return_value=[{'display_title': 'Foo Collection'}])
+    index = Index(
+        config={
+            **DEFAULT_SOLR_CONFIG,
+            'auto_create_sets': True,
+            'auto_set': {
+                'query': 'component:Collection',
+                'name_field': 'display_title',
+                'name_query_field': 'collection_title_facet',
+            }
+        },
+        solr_client=mock_solr_client,
+    )
+    assert index.get_sets().keys() == {'foo_collection'}
+    assert index.get_set('foo_collection')['name'] == 'Foo Collection'
+    assert mock_solr_client.search.call_count == 1
+
+    # invalidating forces a reload on the next lookup
+    mock_solr_client.search = MagicMock(return_value=[{'display_title': 'Bar Stuff'}])
+    index.set_registry.invalidate()
+    assert index.get_sets().keys() == {'bar_stuff'}
+    assert mock_solr_client.search.call_count == 1
+
+
+def test_set_registry_refresh_when_stale(mock_solr_client):
+    index = Index(config={**DEFAULT_SOLR_CONFIG, 'sets_ttl': 60}, solr_client=mock_solr_client)
+    index.load_sets = MagicMock(return_value={'foo': {'spec': 'foo', 'name': 'Foo', 'filter': 'title:Foo'}})
+    registry = index.set_registry
+    assert registry.sets.keys() == {'foo'}
+    assert not registry.is_stale
+
+    # pretend the sets were loaded long ago
+    registry._loaded_at -= 120
+    assert registry.is_stale
+    index.load_sets.return_value = {'bar': {'spec': 'bar', 'name': 'Bar', 'filter': 'title:Bar'}}
+    # stale sets are still served while the refresh happens in the background
+    assert registry.sets.keys() == {'foo'}
+    registry._refresh_thread.join()
+    assert registry.sets.keys() == {'bar'}
+    assert index.load_sets.call_count == 2
+
+
+def test_get_doc_cached(mock_solr_client):
+    results = MagicMock()
+    results.__len__.return_value = 1
+    results.docs = [{'handle': 'foo', 'id': 'http://example.com/foo'}]
+    mock_solr_client.search = MagicMock(return_value=results)
+    index = Index(config=DEFAULT_SOLR_CONFIG, solr_client=mock_solr_client)
+    assert index.get_doc('foo')['id'] == 'http://example.com/foo'
+    assert index.get_doc('foo')['id'] == 'http://example.com/foo'
+    assert mock_solr_client.search.call_count == 1
+    assert index.doc_cache.hits == 1
+    assert index.doc_cache.misses == 1
+
+
+def test_get_doc_not_found_is_not_cached(mock_solr_client):
+    mock_solr_client.search = MagicMock(return_value=[])
+    index = Index(config=DEFAULT_SOLR_CONFIG, solr_client=mock_solr_client)
+    for _ in range(2):
+        with pytest.raises(OAIRepoExternalException):
+            index.get_doc('foo')
+    assert mock_solr_client.search.call_count == 2
+    assert len(index.doc_cache) == 0
+
+
+def test_document_cache_lru():
+    cache = DocumentCache(max_size=2, ttl=60)
+    cache.put('a', {'id': 'a'})
+    cache.put('b', {'id': 'b'})
+    assert cache.get('a') == {'id': 'a'}
+    cache.put('c', {'id': 'c'})
+    # "b" was the least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') is not None
+    assert cache.get('c') is not None
+    cache.invalidate('a')
+    assert cache.get('a') is None
+    assert (cache.hits, cache.misses) == (3, 2)
+
+
+def test_document_cache_expiry():
+    cache = DocumentCache(max_size=10, ttl=-1)
+    cache.put('a', {'id': 'a'})
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_document_cache_disabled():
+    cache = DocumentCache(max_size=0)
+    cache.put('a', {'id': 'a'})
+    assert cache.get('a') is None
+
+
+def test_get_docs_cursor_mark(mock_solr_client):
+    index = Index(config={**DEFAULT_SOLR_CONFIG, 'cursor_paging': True}, solr_client=mock_solr_client)
+    index.get_docs(rows=10, cursor_mark='*')
+    kwargs = mock_solr_client.search.call_args.kwargs
+    assert kwargs['cursorMark'] == '*'
+    assert kwargs['sort'] == 'id asc'
+    assert 'start' not in kwargs
+
+
+def test_get_docs_field_list(mock_solr_client):
+    index = Index(config=DEFAULT_SOLR_CONFIG, solr_client=mock_solr_client)
+    index.get_docs()
+    kwargs = mock_solr_client.search.call_args.kwargs
+    assert kwargs['fl'] == 'handle,id,last_modified'
+    assert kwargs['omitHeader'] == 'true'
+    assert kwargs['wt'] == 'json'
+
+    index.get_docs(fields=['handle'])
+    assert mock_solr_client.search.call_args.kwargs['fl'] == 'handle'
+
+
+def test_get_doc_field_list(mock_solr_client):
+    index = Index(config=DEFAULT_SOLR_CONFIG, solr_client=mock_solr_client)
+    index.get_doc('foo')
+    kwargs = mock_solr_client.search.call_args.kwargs
+    assert kwargs['q'] == 'handle:foo'
+    assert kwargs['fl'] == 'handle,id,last_modified'
+    assert kwargs['rows'] == 1
+
+
+@pytest.mark.parametrize(
+    ('timestamp_from', 'timestamp_until', 'expected'),
+    [
+        (
+            datetime.fromisoformat('2023-01-31'),
+            None,
+            [
+                'last_modified:[2023-01-31T00:00:00Z TO *]',
+                '{!cache=false}last_modified:[2023-01-31T00:00:00Z TO *]',
+            ],
+        ),
+        (
+            datetime.fromisoformat('2023-01-31'),
+            datetime.fromisoformat('2023-06-15'),
+            [
+                'last_modified:[2023-01-31T00:00:00Z TO 2023-06-16T00:00:00Z]',
+                '{!cache=false}last_modified:[2023-01-31T00:00:00Z TO 2023-06-15T00:00:00Z]',
+            ],
+        ),
+        (
+            datetime.fromisoformat('2023-01-31T12:34:56'),
+            None,
+            [
+                'last_modified:[2023-01-31T00:00:00Z TO *]',
+                '{!cache=false}last_modified:[2023-01-31T12:34:56Z TO *]',
+            ],
+        ),
+    ]
+)
+def test_get_docs_filter_queries(mock_solr_client, timestamp_from, timestamp_until, expected):
+    config = {**DEFAULT_SOLR_CONFIG, 'sets': [{'spec': 'foo', 'name': 'Foo', 'filter': 'collection:foo'}]}
+    index = Index(config=config, solr_client=mock_solr_client)
+    index.get_docs(filter_from=timestamp_from, filter_until=timestamp_until, filter_set='foo')
+    assert mock_solr_client.search.call_args.kwargs['fq'] == ['handle:*', 'collection:foo', *expected]
+
+
+def test_get_docs_base_filter_query(mock_solr_client):
+    index = Index(config=DEFAULT_SOLR_CONFIG, solr_client=mock_solr_client)
+    index.get_docs()
+    assert mock_solr_client.search.call_args.kwargs['fq'] == ['handle:*']
+
+
+FORMAT_RULES = {'mods': {'field': 'component', 'values': ['Issue', 'Article']}}
+
+
+def test_format_rules(mock_solr_client):
+    index = Index(config={**DEFAULT_SOLR_CONFIG, 'format_rules': FORMAT_RULES}, solr_client=mock_solr_client)
+    assert index.doc_fields == ['handle', 'id', 'last_modified', 'component']
+    assert index.has_format({'component': 'Issue'}, 'mods')
+    assert index.has_format({'component': ['Page', 'Article']}, 'mods')
+    assert not index.has_format({'component': 'Page'}, 'mods')
+    assert not index.has_format({}, 'mods')
+    # formats without a rule are always available
+    assert index.has_format({}, 'oai_dc')
+
+
+def test_format_rules_filter_query(mock_solr_client):
+    index = Index(config={**DEFAULT_SOLR_CONFIG, 'format_rules': FORMAT_RULES}, solr_client=mock_solr_client)
+    index.get_docs(metadata_prefix='mods')
+    assert mock_solr_client.search.call_args.kwargs['fq'] == ['handle:*', 'component:("Issue" OR "Article")']
+    index.get_docs(metadata_prefix='oai_dc')
+    assert mock_solr_client.search.call_args.kwargs['fq'] == ['handle:*']
+
+
+def test_format_rules_invalid(mock_solr_client):
+    index = Index(
+        config={**DEFAULT_SOLR_CONFIG, 'format_rules': {'mods': {'field': 'component'}}},
+        solr_client=mock_solr_client,
+    )
+    with pytest.raises(OAIRepoInternalException):
+        index.has_format({}, 'mods')
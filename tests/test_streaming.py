@@ -0,0 +1,57 @@
+from unittest.mock import MagicMock
+
+import pytest
+from lxml import etree
+
+from oaipmh.streaming import DeferredMetadata, stream_document, DEFERRED_METADATA
+
+
+@pytest.fixture
+def response_root():
+    deferred = DeferredMetadata(MagicMock())
+    root = etree.Element('OAI-PMH', nsmap={None: 'http://www.openarchives.org/OAI/2.0/'})
+    etree.SubElement(root, 'responseDate').text = '2023-06-16T08:37:29Z'
+    list_records = etree.SubElement(root, 'ListRecords')
+    for n in range(3):
+        record = etree.SubElement(list_records, 'record')
+        etree.SubElement(etree.SubElement(record, 'header'), 'identifier').text = f'oai:fcrepo:{n}'
+        etree.SubElement(record, 'metadata').append(deferred.get_record_metadata(f'oai:fcrepo:{n}', 'oai_dc'))
+    etree.SubElement(list_records, 'resumptionToken', cursor='0')
+    return root
+
+
+def test_deferred_metadata():
+    data_provider = MagicMock()
+    data_provider.limit = 25
+    deferred = DeferredMetadata(data_provider)
+    assert deferred.limit == 25
+    placeholder = deferred.get_record_metadata('oai:fcrepo:foo', 'oai_dc')
+    assert placeholder.tag == DEFERRED_METADATA
+    assert placeholder.get('identifier') == 'oai:fcrepo:foo'
+    assert placeholder.get('metadataprefix') == 'oai_dc'
+    data_provider.get_record_metadata.assert_not_called()
+
+
+def test_stream_document(response_root):
+    def get_record_metadata(identifier, metadataprefix):
+        return etree.Element('{http://purl.org/dc/elements/1.1/}title', id=identifier, prefix=metadataprefix)
+
+    chunks = list(stream_document(response_root, get_record_metadata))
+    # one chunk per record and the resumption token, plus the end of the document
+    assert len(chunks) == 5
+    document = etree.fromstring(b''.join(chunks))
+    assert document.findtext('{*}responseDate') == '2023-06-16T08:37:29Z'
+    titles = document.findall('.//{http://purl.org/dc/elements/1.1/}title')
+    assert [title.get('id') for title in titles] == ['oai:fcrepo:0', 'oai:fcrepo:1', 'oai:fcrepo:2']
+    assert {title.get('prefix') for title in titles} == {'oai_dc'}
+    assert document.find('.//{*}resumptionToken') is not None
+    assert not document.findall(f'.//{DEFERRED_METADATA}')
+
+
+def test_stream_document_fetches_lazily(response_root):
+    get_record_metadata = MagicMock(return_value=etree.Element('dc'))
+    chunks = stream_document(response_root, get_record_metadata)
+    next(chunks)
+    assert get_record_metadata.call_count == 1
+    next(chunks)
+    assert get_record_metadata.call_count == 2
@@ -0,0 +1,107 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+
+import pytest
+
+from oaipmh import tracing
+from oaipmh.tracing import FileExporter, SlowRequestProfiler, Tracer, get_exporter
+from oaipmh.web import create_app
+
+
+def test_span_without_trace():
+    with tracing.span('solr get_doc') as span:
+        assert span is None
+    assert tracing.propagate(len) is len
+
+
+def test_span_tree(tmp_path):
+    tracer = Tracer(FileExporter(str(tmp_path / 'traces.jsonl')))
+    trace = tracer.start_trace('ListRecords', **{'oai.verb': 'ListRecords', 'oai.set': None})
+    with tracing.span('process') as process:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            def fetch():
+                with tracing.span('fcrepo GET', **{'http.status_code': 200}):
+                    pass
+            executor.submit(tracing.propagate(fetch)).result()
+        tracing.record_span(process, 'xslt oai_dc', 0.01)
+        with pytest.raises(ValueError):
+            with tracing.span('serialize'):
+                raise ValueError('bad')
+    tracer.end_trace(trace, **{'http.status_code': 200})
+    assert tracing.current_span() is None
+
+    with open(tmp_path / 'traces.jsonl') as fh:
+        exported = json.loads(fh.readline())
+    spans = {s['name']: s for s in exported['resourceSpans'][0]['scopeSpans'][0]['spans']}
+    root = spans['ListRecords']
+    assert 'parentSpanId' not in root
+    assert len(root['traceId']) == 32
+    assert {'key': 'http.status_code', 'value': {'intValue': '200'}} in root['attributes']
+    assert [a['key'] for a in root['attributes']] == ['oai.verb', 'http.status_code']
+    assert spans['process']['parentSpanId'] == root['spanId']
+    assert spans['fcrepo GET']['parentSpanId'] == spans['process']['spanId']
+    assert spans['xslt oai_dc']['parentSpanId'] == spans['process']['spanId']
+    assert spans['serialize']['status'] == {'code': 2, 'message': 'ValueError: bad'}
+
+
+def test_sample_rate(monkeypatch):
+    monkeypatch.setenv('TRACE_SAMPLE_RATE', '0')
+    exporter = MagicMock()
+    tracer = Tracer(exporter)
+    assert tracer.start_trace('Identify') is None
+    assert tracing.current_span() is None
+
+
+def test_get_exporter(tmp_path):
+    assert get_exporter(f'file://{tmp_path}/traces.jsonl').path == f'{tmp_path}/traces.jsonl'
+    assert isinstance(get_exporter('traces.jsonl'), FileExporter)
+
+
+def test_slow_request_profiler(tmp_path):
+    profiler = SlowRequestProfiler(threshold=0.05, directory=str(tmp_path), interval=0.001)
+
+    def slow_request():
+        time.sleep(0.1)
+
+    profiled = profiler.start()
+    slow_request()
+    path = profiler.stop(profiled, 'ListRecords')
+    assert path.parent == tmp_path
+    with path.open() as fh:
+        lines = fh.read().splitlines()
+    assert lines
+    assert any('slow_request (test_tracing.py:' in line for line in lines)
+    stack, count = lines[0].rsplit(' ', 1)
+    assert int(count) > 0
+
+    # fast requests are not kept
+    assert profiler.stop(profiler.start(), 'Identify') is None
+
+
+def test_request_trace(monkeypatch, tmp_path, mock_solr_client):
+    monkeypatch.setenv('TRACE_EXPORT', str(tmp_path / 'traces.jsonl'))
+    monkeypatch.setenv('PROFILE_SLOW_REQUESTS', '0')
+    monkeypatch.setenv('PROFILE_DIR', str(tmp_path))
+    monkeypatch.setenv('SOLR_URL', mock_solr_client.url)
+    monkeypatch.setenv('ADMIN_EMAIL', 'admin@example.com')
+    monkeypatch.setenv('BASE_URL', 'http://example.com/oai/api')
+    monkeypatch.setenv('OAI_NAMESPACE_IDENTIFIER', 'fcrepo')
+    monkeypatch.setenv('OAI_REPOSITORY_NAME', 'Test Repository')
+    monkeypatch.setenv('EARLIEST_DATESTAMP', '2014-01-01T00:00:00Z')
+    monkeypatch.setattr('pysolr.Solr', MagicMock(return_value=mock_solr_client))
+    app = create_app(solr_config_file=None)
+
+    response = app.test_client().get('/oai/api?verb=ListIdentifiers&metadataPrefix=oai_dc')
+    response.close()
+
+    with open(tmp_path / 'traces.jsonl') as fh:
+        exported = json.loads(fh.readline())
+    spans = exported['resourceSpans'][0]['scopeSpans'][0]['spans']
+    names = [span['name'] for span in spans]
+    assert names[0] == 'ListIdentifiers'
+    assert 'process' in names
+    assert 'solr get_docs' in names
+    trace_id = spans[0]['traceId']
+    assert list(tmp_path.glob(f'*-ListIdentifiers-{trace_id}-*.collapsed'))
@@ -0,0 +1,157 @@
+from unittest.mock import MagicMock
+
+import pysolr
+import pytest
+
+from oaipmh.cache import Tombstone
+from oaipmh.web import create_app, get_etag
+
+
+@pytest.fixture
+def app(monkeypatch, mock_solr_client):
+    monkeypatch.setenv('SOLR_URL', mock_solr_client.url)
+    monkeypatch.setenv('ADMIN_EMAIL', 'admin@example.com')
+    monkeypatch.setenv('BASE_URL', 'http://example.com/oai/api')
+    monkeypatch.setenv('OAI_NAMESPACE_IDENTIFIER', 'fcrepo')
+    monkeypatch.setenv('OAI_REPOSITORY_NAME', 'Test Repository')
+    monkeypatch.setenv('EARLIEST_DATESTAMP', '2014-01-01T00:00:00Z')
+    monkeypatch.setattr('pysolr.Solr', MagicMock(return_value=mock_solr_client))
+    return create_app(solr_config_file=None)
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def test_get_etag():
+    etag = get_etag({'verb': 'Identify'}, 'abc')
+    assert etag.startswith('W/"')
+    assert etag == get_etag({'verb': 'Identify'}, 'abc')
+    assert etag != get_etag({'verb': 'Identify'}, 'def')
+    assert etag != get_etag({'verb': 'ListSets'}, 'abc')
+
+
+def test_identify_not_modified(client):
+    response = client.get('/oai/api?verb=Identify')
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'public, max-age=300'
+    etag = response.headers['ETag']
+
+    response = client.get('/oai/api?verb=Identify', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert response.data == b''
+
+
+def test_get_record_not_modified(client, mock_solr_client):
+    results = MagicMock()
+    results.docs = [{'handle': 'foo', 'id': 'http://example.com/foo', 'last_modified': '2023-06-16T08:37:29Z'}]
+    mock_solr_client.search = MagicMock(return_value=results)
+    response = client.get(
+        '/oai/api?verb=GetRecord&identifier=oai:fcrepo:foo&metadataPrefix=oai_dc',
+        headers={'If-Modified-Since': 'Sat, 17 Jun 2023 00:00:00 GMT'},
+    )
+    assert response.status_code == 304
+    assert 'ETag' in response.headers
+
+
+def test_list_etag_changes_with_list_size(monkeypatch, app, client):
+    monkeypatch.setenv('PAGE_SIZE', '2')
+    data_provider = app.extensions['oaipmh.data_provider']
+    docs = [
+        {'handle': '1903.1/1', 'id': 'http://example.com/1', 'last_modified': '2023-06-16T08:37:29Z'},
+        {'handle': '1903.1/2', 'id': 'http://example.com/2', 'last_modified': '2023-06-17T08:37:29Z'},
+    ]
+    data_provider.index.get_sets_for_handles = MagicMock(side_effect=lambda handles: {h: {} for h in handles})
+
+    def list_identifiers(hits):
+        data_provider.index.get_docs = MagicMock(return_value=pysolr.Results({
+            'response': {'numFound': hits, 'docs': docs},
+        }))
+        response = client.get('/oai/api?verb=ListIdentifiers&metadataPrefix=oai_dc')
+        assert response.status_code == 200
+        return response.headers['ETag']
+
+    etag = list_identifiers(3)
+    assert list_identifiers(3) == etag
+    # a record added after the page changes the complete list size, but not the page
+    assert list_identifiers(4) != etag
+
+
+def test_error_response_has_no_cache_headers(client):
+    response = client.get('/oai/api?verb=NotAVerb')
+    assert response.status_code == 400
+    assert 'ETag' not in response.headers
+
+
+def test_get_record_format_rule(monkeypatch, mock_solr_client, tmp_path):
+    config_file = tmp_path / 'solr.yml'
+    config_file.write_text(
+        'base_query: "handle:*"\n'
+        'handle_field: handle\n'
+        'uri_field: id\n'
+        'last_modified_field: last_modified\n'
+        'auto_create_sets: false\n'
+        'sets: []\n'
+        'format_rules:\n'
+        '  oai_dc:\n'
+        '    field: component\n'
+        '    values: [Issue]\n'
+    )
+    for name, value in {
+        'SOLR_URL': mock_solr_client.url,
+        'ADMIN_EMAIL': 'admin@example.com',
+        'BASE_URL': 'http://example.com/oai/api',
+        'OAI_NAMESPACE_IDENTIFIER': 'fcrepo',
+        'OAI_REPOSITORY_NAME': 'Test Repository',
+        'EARLIEST_DATESTAMP': '2014-01-01T00:00:00Z',
+    }.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.setattr('pysolr.Solr', MagicMock(return_value=mock_solr_client))
+    results = MagicMock()
+    results.docs = [{
+        'handle': 'foo', 'id': 'http://example.com/foo', 'last_modified': '2023-06-16T08:37:29Z', 'component': 'Page',
+    }]
+    mock_solr_client.search = MagicMock(return_value=results)
+    app = create_app(solr_config_file=str(config_file))
+    app.extensions['oaipmh.data_provider'].session.get = MagicMock()
+    client = app.test_client()
+
+    response = client.get('/oai/api?verb=GetRecord&identifier=oai:fcrepo:foo&metadataPrefix=oai_dc')
+    assert response.status_code == 400
+    assert b'cannotDisseminateFormat' in response.data
+    response = client.get('/oai/api?verb=ListMetadataFormats&identifier=oai:fcrepo:foo')
+    assert response.status_code == 200
+    assert b'<metadataPrefix>oai_dc</metadataPrefix>' not in response.data
+    # one (cached) Solr lookup for the document, and no requests to fcrepo
+    assert mock_solr_client.search.call_count == 1
+    app.extensions['oaipmh.data_provider'].session.get.assert_not_called()
+
+
+def test_get_record_deleted(monkeypatch, tmp_path, mock_solr_client):
+    monkeypatch.setenv('REPORT_DELETED_RECORDS', 'persistent')
+    monkeypatch.setenv('TOMBSTONE_STORE_PATH', str(tmp_path / 'tombstones.sqlite'))
+    for name, value in {
+        'SOLR_URL': mock_solr_client.url,
+        'ADMIN_EMAIL': 'admin@example.com',
+        'BASE_URL': 'http://example.com/oai/api',
+        'OAI_NAMESPACE_IDENTIFIER': 'fcrepo',
+        'OAI_REPOSITORY_NAME': 'Test Repository',
+        'EARLIEST_DATESTAMP': '2014-01-01T00:00:00Z',
+    }.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.setattr('pysolr.Solr', MagicMock(return_value=mock_solr_client))
+    app = create_app(solr_config_file=None)
+    data_provider = app.extensions['oaipmh.data_provider']
+    data_provider.add_tombstone(Tombstone('foo', 'http://example.com/foo', '2023-06-16T08:37:29Z', ('maps',)))
+    data_provider.session.get = MagicMock()
+
+    response = app.test_client().get('/oai/api?verb=GetRecord&identifier=oai:fcrepo:foo&metadataPrefix=oai_dc')
+    assert response.status_code == 200
+    assert b'<header status="deleted">' in response.data
+    assert b'<setSpec>maps</setSpec>' in response.data
+    assert b'<metadata>' not in response.data
+    assert b'<deletedRecord>persistent</deletedRecord>' in app.test_client().get('/oai/api?verb=Identify').data
+    mock_solr_client.search.assert_not_called()
+    data_provider.session.get.assert_not_called()
@@ -1,9 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+
 import pytest
+from lxml import etree
 from oai_repo import OAIRepoInternalException
 
-from oaipmh.transformers import Transformer
+from oaipmh.transformers import ENTRY_POINT_GROUP, Transformer, load_transformers
 
 
 def test_bad_transformer(datadir):
     with pytest.raises(OAIRepoInternalException):
         Transformer(datadir / 'no_xsi-schemaLocation.xsl')
+
+
+def test_transformer_per_thread_xslt():
+    transformer = load_transformers()['oai_dc']
+    rdf = etree.XML('<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"/>')
+
+    def transform(_):
+        transformer(rdf)
+        return transformer.xslt
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        xslts = list(executor.map(transform, range(4)))
+    # every thread has its own compiled stylesheet, distinct from this thread's
+    assert all(transformer.xslt is not xslt for xslt in xslts)
+    assert transformer.stats.count == 4
+    assert transformer.stats.errors == 0
+    assert transformer.stats.max_time >= transformer.stats.mean_time > 0
+
+
+def test_load_transformers_from_directory(datadir):
+    transformers = load_transformers(xsl_dir=datadir / 'formats')
+    assert set(transformers.keys()) == {'rdf', 'oai_dc', 'mods'}
+    mods = transformers['mods']
+    assert mods.metadata_format.metadata_namespace == 'http://www.loc.gov/mods/v3'
+    assert mods.metadata_format.schema == 'http://www.loc.gov/standards/mods/v3/mods-3-8.xsd'
+
+
+def test_transformer_compiles_lazily(datadir):
+    transformer = Transformer(datadir / 'formats' / 'mods.xsl')
+    assert not transformer.is_compiled
+    assert transformer._xslt_doc is None
+
+    result = transformer(etree.XML('<foo/>'))
+    assert result.tag == '{http://www.loc.gov/mods/v3}mods'
+    assert transformer.is_compiled
+
+
+def test_load_transformers_from_entry_points(monkeypatch, datadir):
+    entry_point = MagicMock()
+    entry_point.name = 'mods'
+    entry_point.load.return_value = lambda: datadir / 'formats' / 'mods.xsl'
+    monkeypatch.setattr(
+        'oaipmh.transformers.entry_points',
+        lambda group: [entry_point] if group == ENTRY_POINT_GROUP else [],
+    )
+    transformers = load_transformers()
+    assert transformers['mods'].path == datadir / 'formats' / 'mods.xsl'